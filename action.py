@@ -45,10 +45,11 @@ from calibre_plugins.marvin_manager import MarvinManagerPlugin
 from calibre_plugins.marvin_manager.annotations_db import AnnotationsDB
 from calibre_plugins.marvin_manager.book_status import BookStatusDialog
 from calibre_plugins.marvin_manager.common_utils import (AbortRequestException,
-    Book, CommandHandler, CompileUI, IndexLibrary, Logger,
-    MoveBackup, MyBlockingBusy, PluginMetricsLogger,
+    Book, CachedIDevice, CommandHandler, CompileUI, DeviceRates, IndexLibrary, Logger,
+    MainDbLocalizer, MoveBackup, MyBlockingBusy, PluginMetricsLogger,
     ProgressBar, RestoreBackup, Struct,
-    from_json, get_icon, set_plugin_icon_resources, to_json, updateCalibreGUIView)
+    from_json, get_icon, resume_move_annotations, set_plugin_icon_resources, to_json,
+    updateCalibreGUIView)
 import calibre_plugins.marvin_manager.config as cfg
 #from calibre_plugins.marvin_manager.dropbox import PullDropboxUpdates
 
@@ -81,6 +82,117 @@ class MarvinManagerAction(InterfaceAction, Logger):
     def about_to_show_menu(self):
         self.rebuild_menus()
 
+    def benchmark_device_io(self):
+        '''
+        Measure AFC throughput, stat latency and command ACK latency for the
+        connected iDevice. Results are persisted per device by DeviceRates,
+        replacing the static estimates used for progress and timeouts.
+        '''
+        BLOCK_SIZES = [64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+        LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250]     # ms
+        STAT_SAMPLES = 50
+
+        def _histogram(latencies):
+            counts = [0] * (len(LATENCY_BUCKETS) + 1)
+            for latency in latencies:
+                ms = latency * 1000
+                for i, limit in enumerate(LATENCY_BUCKETS):
+                    if ms < limit:
+                        counts[i] += 1
+                        break
+                else:
+                    counts[-1] += 1
+            labels = ["< {0} ms".format(limit) for limit in LATENCY_BUCKETS]
+            labels.append(">= {0} ms".format(LATENCY_BUCKETS[-1]))
+            widest = max(counts) or 1
+            ans = ''
+            for label, count in zip(labels, counts):
+                ans += " {0:>10} {1:>5} {2}\n".format(label, count, '#' * int(40 * count / widest))
+            return ans
+
+        self._log_location(self.ios.device_name)
+        separator_width = 80
+        det_msg = ''
+        QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+
+        try:
+            if not self.ios.exists(self.REMOTE_CACHE_FOLDER, silent=True):
+                self.ios.mkdir(self.REMOTE_CACHE_FOLDER)
+            benchmark_path = b'/'.join([self.REMOTE_CACHE_FOLDER, 'io_benchmark.tmp'])
+
+            # AFC throughput
+            det_msg += '{0:-^{1}}\n'.format(" AFC throughput ", separator_width)
+            det_msg += " {0:>10} {1:>16} {2:>16}\n".format('block', 'write bytes/sec', 'read bytes/sec')
+            read_rates = []
+            write_rates = []
+            for block_size in BLOCK_SIZES:
+                payload = os.urandom(block_size)
+
+                start = time.time()
+                self.ios.write(payload, benchmark_path, mode='wb')
+                write_rate = block_size / max(time.time() - start, 0.001)
+
+                start = time.time()
+                self.ios.read(benchmark_path, mode='rb')
+                read_rate = block_size / max(time.time() - start, 0.001)
+
+                self.ios.remove(benchmark_path)
+                write_rates.append(write_rate)
+                read_rates.append(read_rate)
+                det_msg += " {0:>10,} {1:>16,.0f} {2:>16,.0f}\n".format(block_size, write_rate, read_rate)
+                Application.processEvents()
+
+            # Small blocks are dominated by per-call overhead, estimate from the largest
+            self.device_rates.record('afc_read_rate', read_rates[-1])
+            self.device_rates.record('afc_write_rate', write_rates[-1])
+
+            # Stat latency, bypassing the stat cache
+            stat_path = self.REMOTE_CACHE_FOLDER
+            latencies = []
+            for i in range(STAT_SAMPLES):
+                self.ios.invalidate(stat_path)
+                start = time.time()
+                self.ios.exists(stat_path, silent=True)
+                latencies.append(time.time() - start)
+            latencies.sort()
+            median = latencies[len(latencies) // 2]
+            self.device_rates.record('stat_latency', median)
+            det_msg += '\n{0:-^{1}}\n'.format(" Stat latency ", separator_width)
+            det_msg += " samples: {0}  median: {1:.1f} ms  max: {2:.1f} ms\n".format(
+                STAT_SAMPLES, median * 1000, latencies[-1] * 1000)
+            det_msg += _histogram(latencies)
+
+            # Command ACK latency
+            ch = CommandHandler(self)
+            ch.construct_general_command("BACKUPMANIFEST")
+            ch.issue_command(get_response="backup.xml")
+            det_msg += '\n{0:-^{1}}\n'.format(" Command ACK latency ", separator_width)
+            if ch.ack_latency is not None:
+                self.device_rates.record('command_ack_latency', ch.ack_latency)
+                det_msg += " {0:.3f} seconds\n".format(ch.ack_latency)
+            else:
+                det_msg += " unavailable: {0}\n".format(ch.results.get('status'))
+
+            self.device_rates.prefs.set('benchmarked', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        except:
+            import traceback
+            self._log(traceback.format_exc())
+            det_msg += '\n' + traceback.format_exc()
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        det_msg += '\n{0:-^{1}}\n'.format(" Estimates used by Marvin XD ", separator_width)
+        det_msg += self.device_rates.format_rates() + '\n'
+
+        # Present the results
+        title = "Marvin XD device benchmark"
+        msg = '<p>I/O benchmark completed for {0}.</p>'.format(self.ios.device_name)
+        dialog = info_dialog(self.gui, title, msg, det_msg=det_msg)
+        font = QFont('monospace')
+        font.setFixedPitch(True)
+        dialog.det_msg.setFont(font)
+        dialog.exec_()
+
     def compare_mainDb_profiles(self, stored_mainDb_profile):
         '''
         '''
@@ -119,9 +231,9 @@ class MarvinManagerAction(InterfaceAction, Logger):
         2) Get destination directory
         3) Move generated backup from /Documents/Backup to local storage
         '''
-        IOS_READ_RATE = 7500000  # 11.8 - 16 MB/sec OS X, Windows 6.6MB
+        IOS_READ_RATE = self.device_rates.get('afc_read_rate')
         TIMEOUT_PADDING_FACTOR = 1.5
-        WORST_CASE_ARCHIVE_RATE = 1800000   # MB/second
+        WORST_CASE_ARCHIVE_RATE = self.device_rates.get('archive_rate')
 
         backup_folder = b'/'.join(['/Documents', 'Backup'])
         backup_target = backup_folder + '/marvin.backup'
@@ -189,7 +301,7 @@ class MarvinManagerAction(InterfaceAction, Logger):
             estimated_size += books_size
 
             # Add size of mainDb
-            mdbs = os.stat(self.connected_device.local_db_path).st_size
+            mdbs = os.stat(self.mainDb.path()).st_size
             estimated_size += mdbs
 
             self._log("estimated size of uncompressed backup: {:,}".format(estimated_size))
@@ -278,6 +390,8 @@ class MarvinManagerAction(InterfaceAction, Logger):
             dialog.exec_()
             return
 
+        self.device_rates.record('archive_rate', estimated_size/actual_time)
+
         # Move backup to the specified location
         stats = self.ios.exists(backup_target)
         if stats:
@@ -387,6 +501,9 @@ class MarvinManagerAction(InterfaceAction, Logger):
 
                 transfer_size = int(stats['st_size'])
                 total_actual = time.time() - start_time
+                if move_operation.transfer_time:
+                    self.device_rates.record('afc_read_rate',
+                                             transfer_size/move_operation.transfer_time)
 
                 analytics.append((
                     '2. Destination folder\n'
@@ -458,7 +575,7 @@ class MarvinManagerAction(InterfaceAction, Logger):
 
         """
         # Get a list of files, covers from mainDb
-        con = sqlite3.connect(self.connected_device.local_db_path)
+        con = self.mainDb.connect()
         with con:
             con.row_factory = sqlite3.Row
             cur = con.cursor()
@@ -600,7 +717,7 @@ class MarvinManagerAction(InterfaceAction, Logger):
                 pb.increment()
 
                 # mainDb
-                zfw.write(self.connected_device.local_db_path, arcname='mainDb.sqlite')
+                zfw.write(self.mainDb.path(), arcname='mainDb.sqlite')
                 pb.increment()
 
                 # ePubs
@@ -739,8 +856,10 @@ class MarvinManagerAction(InterfaceAction, Logger):
     def dehydrate_installed_books(self, installed_books):
         '''
         Convert installed_books to JSON-serializable format
+        Lazy fields are fetched from mainDb on demand, so are not stored
         '''
-        all_mxd_keys = sorted(Book.mxd_standard_keys + Book.mxd_custom_keys)
+        all_mxd_keys = sorted(set(Book.mxd_standard_keys + Book.mxd_custom_keys) -
+                              set(Book.mxd_lazy_keys))
         dehydrated = {}
         for key in installed_books:
             dehydrated[key] = {}
@@ -757,7 +876,8 @@ class MarvinManagerAction(InterfaceAction, Logger):
                       'Delete calibre hash cache', 'Delete Marvin hash cache',
                       'Delete installed books cache', 'Delete all caches',
                       'Nuke annotations',
-                      'Reset column widths']:
+                      'Reset column widths', 'Run data structure benchmark',
+                      'Run Marvin simulator benchmark']:
             if action == 'Delete Marvin hashes':
                 rhc = b'/'.join([self.REMOTE_CACHE_FOLDER, BookStatusDialog.HASH_CACHE_FS])
 
@@ -821,6 +941,12 @@ class MarvinManagerAction(InterfaceAction, Logger):
                 # nuke_annotations() has its own dialog informing progress
                 self.nuke_annotations()
 
+            elif action == 'Run data structure benchmark':
+                self.run_data_structure_benchmark()
+
+            elif action == 'Run Marvin simulator benchmark':
+                self.run_simulator_benchmark()
+
             elif action == 'Reset column widths':
                 self._log("deleting marvin_library_column_widths")
                 self.prefs.pop('marvin_library_column_widths')
@@ -1045,6 +1171,20 @@ class MarvinManagerAction(InterfaceAction, Logger):
             device_profile['prefs'] = prefs
 
 
+        def _format_afc_metrics():
+            args = {'subtitle': " AFC operations ",
+                    'separator_width': separator_width}
+            ans = '\n{subtitle:-^{separator_width}}\n'.format(**args)
+            ans += self.ios.format_metrics() + '\n'
+            return ans
+
+        def _format_device_rates():
+            args = {'subtitle': " Device rates ",
+                    'separator_width': separator_width}
+            ans = '\n{subtitle:-^{separator_width}}\n'.format(**args)
+            ans += self.device_rates.format_rates() + '\n'
+            return ans
+
         def _format_cache_files_info():
             max_fs_width = max([len(v) for v in device_profile['cache_files'].keys()])
             max_size_width = 12
@@ -1282,6 +1422,8 @@ class MarvinManagerAction(InterfaceAction, Logger):
         det_msg += _format_installed_plugins_info()
         det_msg += _format_caching_info()
         det_msg += _format_cache_files_info()
+        det_msg += _format_afc_metrics()
+        det_msg += _format_device_rates()
         det_msg += _format_mainDb_profiles()
         det_msg += _format_prefs_info()
 
@@ -1398,11 +1540,13 @@ class MarvinManagerAction(InterfaceAction, Logger):
         self.blocking_busy = MyBlockingBusy(self.gui, "Updating Marvin Library…", size=50)
         self.connected_device = None
         self.current_location = 'library'
+        self.device_rates = None
         self.dialog_active = False
         self.dropbox_processed = False
         self.ios = None
         self.installed_books = None
         self.load_time = None
+        self.mainDb = None
         self.marvin_content_updated = False
         self.menus_lock = threading.RLock()
         self.sync_lock = threading.RLock()
@@ -1598,6 +1742,9 @@ class MarvinManagerAction(InterfaceAction, Logger):
         # Subscribe to device connection events
         device_signals.device_connection_changed.connect(self.on_device_connection_changed)
 
+        # Complete an annotations move interrupted in a previous session
+        QTimer.singleShot(0, partial(resume_move_annotations, self))
+
     def launch_library_scanner(self):
         '''
         Call IndexLibrary() to index current_db by uuid, title
@@ -1647,6 +1794,9 @@ class MarvinManagerAction(InterfaceAction, Logger):
         self.load_time = None
         self.virtual_library = None
 
+        # Complete an annotations move interrupted in this library
+        QTimer.singleShot(0, partial(resume_move_annotations, self))
+
     def library_index_complete(self):
         self._log_location()
         self.library_indexed = True
@@ -1699,6 +1849,13 @@ class MarvinManagerAction(InterfaceAction, Logger):
         command = cmd_dict['cmd']
 
         self._log_location(cmd_dict)
+
+        # The driver changes the iDevice through its own connection
+        if self.ios is not None:
+            self.ios.invalidate()
+        if self.mainDb is not None:
+            self.mainDb.invalidate()
+
         if command in ['delete_books', 'upload_books']:
             self.marvin_content_updated = True
 
@@ -1825,11 +1982,26 @@ class MarvinManagerAction(InterfaceAction, Logger):
 
                 self._log_location(self.connected_device.gui_name)
 
-                # Init libiMobileDevice
-                self.ios = libiMobileDevice(verbose=self.prefs.get('debug_libimobiledevice', False))
+                # Init libiMobileDevice, caching stats outside the folders Marvin manages
+                volatile_folders = []
+                for path in [getattr(self.connected_device, 'staging_folder', None),
+                             (getattr(self.connected_device, 'status_fs', None) or b'').rpartition(b'/')[0]]:
+                    if path:
+                        volatile_folders.append(path)
+                self.ios = CachedIDevice(
+                    libiMobileDevice(verbose=self.prefs.get('debug_libimobiledevice', False)),
+                    ttl=self.prefs.get('ios_stat_cache_ttl', CachedIDevice.DEFAULT_TTL),
+                    volatile_folders=volatile_folders,
+                    verbose=self.verbose)
                 self._log("mounting %s" % self.connected_device.app_id)
                 self.ios.mount_ios_app(app_id=self.connected_device.app_id)
 
+                # Measured throughput for this iDevice
+                self.device_rates = DeviceRates(self.ios.device_name, verbose=self.verbose)
+
+                # Local copy of mainDb, shared with the Marvin library dialog
+                self.mainDb = MainDbLocalizer(self)
+
                 # Change our icon
                 self.qaction.setIcon(get_icon("images/connected.png"))
 
@@ -1873,6 +2045,8 @@ class MarvinManagerAction(InterfaceAction, Logger):
                 # Close libiMobileDevice connection, reset references to mounted device
                 self.ios.disconnect_idevice()
                 self.ios = None
+                self.device_rates = None
+                self.mainDb = None
                 self.connected_device.marvin_device_signals.reader_app_status_changed.disconnect()
                 self.connected_device = None
 
@@ -1970,8 +2144,7 @@ class MarvinManagerAction(InterfaceAction, Logger):
         for key in ['FSFreeBytes', 'FSTotalBytes']:
             device_profile[key] = int(device_profile[key])
 
-        local_db_path = self.connected_device.local_db_path
-        device_profile['MarvinMainDbSize'] = os.stat(local_db_path).st_size
+        device_profile['MarvinMainDbSize'] = os.stat(self.mainDb.path()).st_size
 
         # Cribbed from calibre.debug:print_basic_debug_info()
         import platform
@@ -2016,7 +2189,7 @@ class MarvinManagerAction(InterfaceAction, Logger):
         if self.ios.device_name:
             profile = {'device': self.ios.device_name}
 
-            con = sqlite3.connect(self.connected_device.local_db_path)
+            con = self.mainDb.connect()
             with con:
                 con.row_factory = sqlite3.Row
                 cur = con.cursor()
@@ -2123,6 +2296,11 @@ class MarvinManagerAction(InterfaceAction, Logger):
             ac.triggered.connect(self.device_diagnostics)
             ac.setEnabled(enabled)
 
+            # Add 'Benchmark device I/O', enabled when connected device
+            ac = self.create_menu_item(m, 'Benchmark device I/O', image=I('dialog_information.png'))
+            ac.triggered.connect(self.benchmark_device_io)
+            ac.setEnabled(enabled and marvin_connected)
+
             """
             # Add 'Reset caches', enabled when connected device
             ac = self.create_menu_item(m, 'Reset Marvin XD caches', image=I('trash.png'))
@@ -2167,6 +2345,15 @@ class MarvinManagerAction(InterfaceAction, Logger):
                 ac = self.create_menu_item(self.developer_menu, action, image=I('trash.png'))
                 ac.triggered.connect(partial(self.developer_utilities, action))
 
+                action = 'Run data structure benchmark'
+                ac = self.create_menu_item(self.developer_menu, action, image=I('dialog_information.png'))
+                ac.triggered.connect(partial(self.developer_utilities, action))
+
+                action = 'Run Marvin simulator benchmark'
+                ac = self.create_menu_item(self.developer_menu, action, image=I('dialog_information.png'))
+                ac.triggered.connect(partial(self.developer_utilities, action))
+                ac.setEnabled(not marvin_connected)
+
                 self.developer_menu.addSeparator()
                 action = 'Create remote backup'
                 icon = QIcon(os.path.join(self.resources_path, 'icons', 'sync_collections.png'))
@@ -2188,7 +2375,8 @@ class MarvinManagerAction(InterfaceAction, Logger):
 
         rehydrated = None
         try:
-            all_mxd_keys = sorted(Book.mxd_standard_keys + Book.mxd_custom_keys)
+            all_mxd_keys = sorted(set(Book.mxd_standard_keys + Book.mxd_custom_keys) -
+                                  set(Book.mxd_lazy_keys))
             for key in ['title', 'authors']:
                 all_mxd_keys.remove(key)
 
@@ -2283,6 +2471,18 @@ class MarvinManagerAction(InterfaceAction, Logger):
                 self._log("no device cover hashes found")
                 det_msg += "no device cover hashes found\n"
 
+            # Delete word counts and epub TOCs
+            for fs, description in [("word_counts.json", "word counts"),
+                                    ("epub_tocs.json", "epub TOCs")]:
+                path = os.path.join(self.resources_path, fs)
+                if os.path.exists(path):
+                    self._log("deleting {}: {}".format(description, path))
+                    det_msg += "deleted:\n {}\n".format(path)
+                    os.remove(path)
+                else:
+                    self._log("no {} found".format(description))
+                    det_msg += "no {} found\n".format(description)
+
             # Delete _installed_books.zip archives
             pattern = os.path.join(self.resources_path, "*_installed_books.zip")
             if glob.glob(pattern):
@@ -2294,6 +2494,11 @@ class MarvinManagerAction(InterfaceAction, Logger):
                 self._log("no _installed_books.zip archives found")
                 det_msg += "no _installed_books.zip archives found\n"
 
+            # Compact the annotations db
+            self.opts.db.maintenance()
+            self._log("annotations db compacted")
+            det_msg += "annotations db compacted\n"
+
             # Delete calibre hashes from db
             self.gui.current_db.delete_all_custom_book_data('epub_hash')
             self._log("calibre epub hashes deleted from db")
@@ -2652,6 +2857,25 @@ class MarvinManagerAction(InterfaceAction, Logger):
             self._log("restoring self.installed_books from {}".format(os.path.basename(archive_path)))
             self.installed_books = self.rehydrate_installed_books(dehydrated)
 
+    def run_data_structure_benchmark(self):
+        '''
+        Time the plugin's data structures against synthetic data
+        '''
+        from calibre_plugins.marvin_manager.benchmarks import DataStructureBenchmark
+
+        self._log_location()
+        self._run_benchmark(DataStructureBenchmark(self), "Marvin XD data structure benchmark")
+
+    def run_simulator_benchmark(self):
+        '''
+        Time full scans and bulk commands against a simulated Marvin, without
+        a connected iDevice
+        '''
+        from calibre_plugins.marvin_manager.marvin_simulator import SimulatorBenchmark
+
+        self._log_location()
+        self._run_benchmark(SimulatorBenchmark(self), "Marvin XD simulator benchmark")
+
     def show_configuration(self):
         self.interface_action_base_plugin.do_user_config(self.gui)
 
@@ -2732,6 +2956,11 @@ class MarvinManagerAction(InterfaceAction, Logger):
 
             # MXD dialog closed
 
+            # Bring the local copy of mainDb current before profiling it
+            self.mainDb.ensure_current()
+            self.mainDb.refresh_method = None
+            self._log("AFC operations:\n" + self.ios.format_metrics())
+
             # Keep an in-memory snapshot of installed_books in case user reopens w/o disconnect
             self.installed_books = self.book_status_dialog.installed_books
 
@@ -2898,3 +3127,23 @@ class MarvinManagerAction(InterfaceAction, Logger):
             except Exception as e:
                 self._log("Plugin logger unreachable: {0}".format(e))
 
+    def _run_benchmark(self, benchmark, title):
+        '''
+        Run benchmark, report its results
+        '''
+        QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+        try:
+            det_msg = benchmark.run()
+        except:
+            import traceback
+            det_msg = traceback.format_exc()
+            self._log(det_msg)
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        msg = "<p>Benchmark completed.</p>"
+        dialog = info_dialog(self.gui, title, msg, det_msg=det_msg)
+        font = QFont('monospace')
+        font.setFixedPitch(True)
+        dialog.det_msg.setFont(font)
+        dialog.exec_()
@@ -10,7 +10,9 @@ __docformat__ = 'restructuredtext en'
 
 import hashlib, re
 
+from collections import OrderedDict
 from datetime import datetime
+from lxml import html
 from xml.sax.saxutils import escape
 
 from calibre.devices.usbms.driver import debug_print
@@ -172,6 +174,9 @@ class Annotations(Annotation, Logger):
 
                 comments_body += re.sub(r'>\s+<', r'><', ts_css)
 
+        # Record the appearance used, so merges know when to re-render
+        soup.div['css_signature'] = annotations_css_signature()
+
         if self.annotations:
             #soup = BeautifulSoup(ANNOTATIONS_HEADER)
             dtc = 0
@@ -371,163 +376,209 @@ class BookmarkNotes(object, Logger):
         return style
 
 
-def merge_annotations(parent, cid, old_soup, new_soup):
-    '''
-    old_soup, new_soup: BeautifulSoup()
-    Need to strip <hr>, re-sort based on location, build new merged_soup
-    with optional interleaved <hr> elements.
-    '''
-    TRANSIENT_DB = 'transient'
+class LocationSort(object):
+    """
+    Convert Marvin StartXPath values to the interior part of location_sort.
+    '/x:html[1]/x:body[1]/x:div[1]/x:div[1]/x:p[12]/x:span[3]/text()[1]'
+    becomes '0012.0003.0000.0000.0000.0000'. The format is unchanged from
+    earlier releases, as location_sort is stored with annotations in calibre
+    and compared when merging. Parsed steps and complete keys are memoized,
+    as highlights in the same paragraph share their StartXPath prefix.
+    """
+    CACHE_LIMIT = 50000
+    INTERIOR_RE = re.compile(r'\/x:html\[1\]\/x:body\[1\]\/x:div\[1\]\/x:div\[1\]\/x:(.*)\/text.*$')
+    STEP_RE = re.compile(r'.*\[(\d+)\]')
+
+    def __init__(self, max_depth):
+        self.cache = {}
+        self.fmt_str = '.'.join(["%04d"] * max_depth)
+        self.max_depth = max_depth
+        self.padding = (0,) * max_depth
+        self.step_cache = {}
+
+    def interior(self, xpath):
+        """
+        Return the interior location_sort for xpath, or False if unparseable
+        """
+        ans = self.cache.get(xpath)
+        if ans is None:
+            ans = self._parse(xpath)
+            if len(self.cache) >= self.CACHE_LIMIT:
+                self.cache.clear()
+            self.cache[xpath] = ans
+        return ans
+
+    def _parse(self, xpath):
+        try:
+            match = self.INTERIOR_RE.match(xpath)
+            ladder = []
+            for step in match.group(1).split('/x:'):
+                index = self.step_cache.get(step)
+                if index is None:
+                    index = self.step_cache[step] = int(self.STEP_RE.match(step).group(1))
+                ladder.append(index)
+            ladder = (tuple(ladder) + self.padding)[:self.max_depth]
+            return self.fmt_str % ladder
+        except:
+            return False
 
-    if False:
-        '''
-        Older technique: Use hashes to merge annotations
-        '''
-        #Get the hashes of any existing annotations
-        oiuas = old_soup.findAll('div', 'annotation')
-        old_hashes = set([ua['hash'] for ua in oiuas])
-
-        # Extract old user_annotations
-        ouas = old_soup.find('div', 'user_annotations')
-        if ouas:
-            ouas.extract()
-
-            # Capture existing annotations
-            parent.opts.db.capture_content(ouas, cid, TRANSIENT_DB)
-
-            # Regurgitate old_soup with current CSS
-            regurgitated_soup = BeautifulSoup(parent.opts.db.rerender_to_html(TRANSIENT_DB, cid))
-
-        # Find new annotations
-        uas = new_soup.findAll('div', 'annotation')
-        new_hashes = set([ua['hash'] for ua in uas])
-
-        updates = list(new_hashes.difference(old_hashes))
-        if len(updates) and ouas is not None:
-            # Append new to regurgitated
-            dtc = len(regurgitated_soup.div)
-            for new_annotation_id in updates:
-                new_annotation = new_soup.find('div', {'hash': new_annotation_id})
-                regurgitated_soup.div.insert(dtc, new_annotation)
-                dtc += 1
-            if old_soup:
-                merged_soup = unicode(old_soup) + unicode(sort_merged_annotations(regurgitated_soup))
-            else:
-                merged_soup = unicode(sort_merged_annotations(regurgitated_soup))
-        else:
-            if old_soup:
-                merged_soup = unicode(old_soup) + unicode(new_soup)
-            else:
-                merged_soup = unicode(new_soup)
-        return merged_soup
 
-    else:
-        '''
-        Newer technique: Use timestamps to merge annotations
-        '''
-        timestamps = {}
-        # Get the timestamps and hashes of the stored annotations
-        suas = old_soup.findAll('div', 'annotation')
-        for sua in suas:
-            #print("sua: %s" % sua.prettify())
-            timestamp = sua.find('td', 'timestamp')['uts']
-            timestamps[timestamp] = {'stored_hash': sua['hash']}
+class RenderCache(object):
+    """
+    LRU cache of rendered annotations HTML. Keys combine a digest of the
+    content with a digest of the appearance, so that an appearance change
+    re-renders a book only when it is next viewed.
+    """
+    LIMIT = 500
 
-        # Rerender stored annotations
-        ouas = old_soup.find('div', 'user_annotations')
-        if ouas:
-            ouas.extract()
+    def __init__(self, limit=LIMIT):
+        self.entries = OrderedDict()
+        self.limit = limit
 
-            # Capture existing annotations
-            parent.opts.db.capture_content(ouas, cid, TRANSIENT_DB)
+    def clear(self):
+        self.entries.clear()
 
-            # Regurgitate annotations with current CSS
-            rerendered_annotations = parent.opts.db.rerender_to_html(TRANSIENT_DB, cid)
-            regurgitated_soup = BeautifulSoup(rerendered_annotations)
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return None
+        self.entries[key] = value
+        return value
 
-        # Add device annotation timestamps and hashes
-        duas = new_soup.findAll('div', 'annotation')
-        for dua in duas:
-            timestamp = dua.find('td', 'timestamp')['uts']
-            if timestamp in timestamps:
-                timestamps[timestamp]['device_hash'] = dua['hash']
-            else:
-                timestamps[timestamp] = {'device_hash': dua['hash']}
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
 
-        merged_annotations = Tag(BeautifulSoup(), 'div',
-            [('class', "user_annotations"), ('style','margin:0')])
+# Shared by all dialogs for the session
+render_cache = RenderCache()
 
-        for ts in sorted(timestamps):
-            if 'stored_hash' in timestamps[ts] and not 'device_hash' in timestamps[ts]:
-                # Stored only - add from regurgitated_soup
-                annotation = regurgitated_soup.find('div', {'hash': timestamps[ts]['stored_hash']})
 
-            elif not 'stored_hash' in timestamps[ts] and 'device_hash' in timestamps[ts]:
-                # Device only - add from new_soup
-                annotation = new_soup.find('div', {'hash': timestamps[ts]['device_hash']})
+def _annotation_records(uas):
+    '''
+    Return {timestamp: <div class="annotation">} for a user_annotations element
+    '''
+    records = {}
+    if uas is not None:
+        for div in uas.xpath('./div[@class="annotation"]'):
+            timestamp = div.xpath('.//td[@class="timestamp"]/@uts')
+            if timestamp:
+                records[timestamp[0]] = div
+    return records
 
-            elif timestamps[ts]['stored_hash'] == timestamps[ts]['device_hash']:
-                # Stored matches device - add from regurgitated_soup, as user may have modified
-                annotation = regurgitated_soup.find('div', {'hash': timestamps[ts]['stored_hash']})
 
-            elif timestamps[ts]['stored_hash'] != timestamps[ts]['device_hash']:
-                # Device has been updated since initial capture - add from new_soup
-                annotation = new_soup.find('div', {'hash': timestamps[ts]['device_hash']})
+def _user_annotations(root):
+    uas = root.xpath('descendant-or-self::div[@class="user_annotations"]')
+    return uas[0] if uas else None
 
-            else:
-                continue
 
-            merged_annotations.append(annotation)
+def annotations_css_signature():
+    '''
+    Return a digest of the appearance settings applied by Annotations.to_HTML()
+    '''
+    from calibre_plugins.marvin_manager.appearance import default_elements, default_timestamp
+    m = hashlib.md5()
+    m.update(repr(plugin_prefs.get('appearance_css', default_elements)))
+    m.update(repr(plugin_prefs.get('appearance_timestamp_format', default_timestamp)))
+    m.update(repr(plugin_prefs.get('appearance_hr_checkbox', False)))
+    m.update(repr(plugin_prefs.get('HORIZONTAL_RULE', '<hr width="80%" />')))
+    return m.hexdigest()
 
-        merged_annotations = sort_merged_annotations(merged_annotations)
 
-        # Update new_soup with merged_annotations
-        new_soup_uas = new_soup.find('div', 'user_annotations')
-        new_soup_uas.replaceWith(merged_annotations)
+def merge_annotation_html(parent, cid, old_html, new_html):
+    '''
+    old_html: stored annotations, new_html: formatted device annotations
+    Annotations are matched by timestamp in a single pass over both sets:
+    stored only, or unchanged on the device, keeps the stored annotation, as
+    the user may have modified it. Device only, or changed on the device,
+    takes the device annotation. Stored annotations are re-rendered through
+    the transient table only if the appearance changed since they were
+    rendered. Return new_html with user_annotations replaced by the merge.
+    '''
+    TRANSIENT_DB = 'transient'
 
-        return unicode(new_soup)
+    new_root = html.fromstring(new_html)
+    new_uas = _user_annotations(new_root)
+    if new_uas is None:
+        return new_html
+
+    old_uas = _user_annotations(html.fromstring(old_html)) if old_html else None
+    stored = _annotation_records(old_uas)
+    if stored and old_uas.get('css_signature') != annotations_css_signature():
+        # Regurgitate stored annotations with current CSS
+        ouas = BeautifulSoup(html.tostring(old_uas, encoding='unicode')).find('div', 'user_annotations')
+        parent.opts.db.capture_content(ouas, cid, TRANSIENT_DB)
+        rerendered = html.fromstring(parent.opts.db.rerender_to_html(TRANSIENT_DB, cid))
+        stored = _annotation_records(_user_annotations(rerendered))
+    device = _annotation_records(new_uas)
+
+    merged = []
+    for timestamp in set(stored) | set(device):
+        stored_annotation = stored.get(timestamp)
+        device_annotation = device.get(timestamp)
+        if (device_annotation is None or
+                (stored_annotation is not None and
+                 stored_annotation.get('hash') == device_annotation.get('hash'))):
+            merged.append(stored_annotation)
+        else:
+            merged.append(device_annotation)
+    merged.sort(key=lambda annotation: annotation.get('location_sort') or '')
+
+    # Replace the device annotations with the merged set
+    for child in list(new_uas):
+        new_uas.remove(child)
+    new_uas.text = None
+    include_hr = plugin_prefs.get('appearance_hr_checkbox', False)
+    for i, annotation in enumerate(merged):
+        annotation.tail = None
+        new_uas.append(annotation)
+        if include_hr and i < len(merged) - 1:
+            new_uas.append(html.fragment_fromstring(
+                plugin_prefs.get('HORIZONTAL_RULE', '<hr width="80%" />')))
+
+    return html.tostring(new_root, encoding='unicode')
 
 
 def merge_annotations_with_comments(parent, cid, comments_soup, new_soup):
     '''
     comments_soup: comments potentially with user_annotations
+    Comments are split from their annotations with lxml, then merged by
+    merge_annotation_html()
     '''
 
     # Prepare a new COMMENTS_DIVIDER
     comments_divider = '<div class="comments_divider"><p style="text-align:center;margin:1em 0 1em 0">{0}</p></div>'.format(
         plugin_prefs.get('COMMENTS_DIVIDER', '&middot;  &middot;  &bull;  &middot;  &#x2726;  &middot;  &bull;  &middot; &middot;'))
 
+    root = html.fragment_fromstring(unicode(comments_soup), create_parent='div')
+
     # Remove the old comments_divider
-    cds = comments_soup.find('div', 'comments_divider')
+    cds = root.xpath('.//div[@class="comments_divider"]')
     if cds:
-        cds.extract()
+        cds[0].drop_tree()
 
     # Existing annotations?
-    uas = comments_soup.find('div', 'user_annotations')
-    if uas:
-        # Save the existing annotations to old_soup
-        old_soup = BeautifulSoup(unicode(uas))
-
-        # Remove any hrs from old_soup
-        hrs = old_soup.findAll('hr')
-        if hrs:
-            for hr in hrs:
-                hr.extract()
-
-        # Remove the existing annotations from comments_soup
-        uas.extract()
-
-        # Merge old_soup with new_soup
-        merged_soup = unicode(comments_soup) + \
-                      unicode(comments_divider) + \
-                      unicode(merge_annotations(parent, cid, old_soup, new_soup))
+    uas = _user_annotations(root)
+    if uas is not None:
+        # Remove any hrs from the existing annotations
+        for hr in uas.xpath('.//hr'):
+            hr.drop_tree()
+
+        # Remove the existing annotations from comments
+        old_html = html.tostring(uas, encoding='unicode')
+        uas.drop_tree()
+
+        # Merge the existing annotations with new_soup
+        merged_annotations = merge_annotation_html(parent, cid, old_html, unicode(new_soup))
     else:
-        # No existing, just merge comments_soup with already sorted new_soup
-        merged_soup = unicode(comments_soup) + \
-                      unicode(comments_divider) + \
-                      unicode(new_soup)
+        # No existing, just merge comments with already sorted new_soup
+        merged_annotations = unicode(new_soup)
 
-    return merged_soup
+    comments = escape(root.text or '') + ''.join(
+        [html.tostring(child, encoding='unicode') for child in root])
+    return comments + unicode(comments_divider) + merged_annotations
 
 
 def sort_merged_annotations(merged_soup):
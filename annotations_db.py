@@ -6,6 +6,7 @@ __copyright__ = '2013, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
 import os, sqlite3, sys
+from contextlib import contextmanager
 from datetime import datetime
 
 from calibre.devices.usbms.driver import debug_print
@@ -21,12 +22,60 @@ class AnnotationsDB(Logger):
     """
     version = 1
 
+    ANNOTATION_COLUMNS = ('book_id', 'annotation_id', 'epubcfi', 'highlight_text',
+                          'note_text', 'location', 'location_sort',
+                          'last_modification', 'highlight_color')
+    BOOK_COLUMNS = ('active', 'author', 'author_sort', 'book_id', 'genre', 'path',
+                    'title', 'title_sort', 'uuid')
+    BOOK_NOTE_COLUMNS = ('book_id', 'note_text')
+    BOOKMARK_NOTE_COLUMNS = ('book_id', 'highlight_color', 'location', 'note_text',
+                             'section_number')
+    TRANSIENT_COLUMNS = ('book_id', 'genre', 'hash', 'highlight_color',
+                         'highlight_text', 'location', 'location_sort',
+                         'last_modification', 'note_text', 'reader')
+
     def __init__(self, opts, path):
         self.conn = None
         self.db_version = None
         self.opts = opts
         self.path = path
 
+    def add_many_to_annotations_db(self, annotations_db, annotations):
+        '''
+        Store a sequence of annotations in a single transaction
+        Return the number of rows written
+        '''
+        with self.transaction():
+            return self._insert(annotations_db, self.ANNOTATION_COLUMNS, annotations)
+
+    def add_many_to_book_notes_db(self, book_notes_db, notes):
+        '''
+        Store a sequence of book notes in a single transaction
+        '''
+        with self.transaction():
+            return self._insert(book_notes_db, self.BOOK_NOTE_COLUMNS, notes)
+
+    def add_many_to_bookmark_notes_db(self, bookmark_note_db, notes):
+        '''
+        Store a sequence of bookmark notes in a single transaction
+        '''
+        with self.transaction():
+            return self._insert(bookmark_note_db, self.BOOKMARK_NOTE_COLUMNS, notes)
+
+    def add_many_to_books_db(self, books_db, books):
+        '''
+        Store a sequence of books in a single transaction
+        '''
+        with self.transaction():
+            return self._insert(books_db, self.BOOK_COLUMNS, books)
+
+    def add_many_to_transient_db(self, transient_db, annotations):
+        '''
+        Store a sequence of captured annotations in a single transaction
+        '''
+        with self.transaction():
+            return self._insert(transient_db, self.TRANSIENT_COLUMNS, annotations)
+
     def add_to_annotations_db(self, annotations_db, annotation):
         '''
         annotation is a dict containing the metadata describing the annotation:
@@ -40,92 +89,27 @@ class AnnotationsDB(Logger):
          last_modification
          highlight_color
         '''
-        self.conn.execute('''
-            INSERT OR REPLACE INTO {0}
-             (book_id,
-              annotation_id,
-              epubcfi,
-              highlight_text,
-              note_text,
-              location,
-              location_sort,
-              last_modification,
-              highlight_color)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(annotations_db),
-              (annotation['book_id'],
-              annotation['annotation_id'],
-              annotation['epubcfi'],
-              annotation['highlight_text'],
-              annotation['note_text'],
-              annotation['location'],
-              annotation['location_sort'],
-              annotation['last_modification'],
-              annotation['highlight_color'])
-             )
+        self._insert(annotations_db, self.ANNOTATION_COLUMNS, [annotation])
 
     def add_to_book_notes_db(self, book_notes_db, note):
         '''
         note is a dict containing the book_id and note_text to be stored
         '''
-        self.conn.execute('''
-            INSERT OR REPLACE INTO {0}
-             (book_id,
-              note_text)
-            VALUES(?, ?)'''.format(book_notes_db),
-             (note['book_id'],
-              note['note_text'])
-            )
+        self._insert(book_notes_db, self.BOOK_NOTE_COLUMNS, [note])
 
     def add_to_bookmark_notes_db(self, bookmark_note_db, note):
         '''
         note is a dict containing:
         book_id, highlight_color, location, note_text, section_number
         '''
-        self.conn.execute('''
-            INSERT OR REPLACE INTO {0}
-             (book_id,
-              highlight_color,
-              location,
-              note_text,
-              section_number)
-            VALUES(?, ?, ?, ?, ?)'''.format(bookmark_note_db),
-             (note['book_id'],
-              note['highlight_color'],
-              note['location'],
-              note['note_text'],
-              note['section_number'])
-            )
+        self._insert(bookmark_note_db, self.BOOKMARK_NOTE_COLUMNS, [note])
 
     def add_to_books_db(self, books_db, book):
         '''
         book is a dict containing the metadata describing the book:
          book_id - unique per book for the reader app
         '''
-        self.conn.execute('''INSERT OR REPLACE INTO {0}
-                                   (
-                                    active,
-                                    author,
-                                    author_sort,
-                                    book_id,
-                                    genre,
-                                    path,
-                                    title,
-                                    title_sort,
-                                    uuid
-                                    )
-                                   VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(books_db),
-                                   (
-                                    book['active'],
-                                    book['author'],
-                                    book['author_sort'],
-                                    book['book_id'],
-                                    book['genre'],
-                                    book['path'],
-                                    book['title'],
-                                    book['title_sort'],
-                                    book['uuid']
-                                    )
-                                )
+        self._insert(books_db, self.BOOK_COLUMNS, [book])
 
     def add_to_transient_db(self, transient_db, annotation):
         '''
@@ -141,31 +125,7 @@ class AnnotationsDB(Logger):
             note_text
             reader
         '''
-        self.conn.execute('''
-            INSERT OR REPLACE INTO {0}
-             (book_id,
-              genre,
-              hash,
-              highlight_color,
-              highlight_text,
-              location,
-              location_sort,
-              last_modification,
-              note_text,
-              reader)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(transient_db),
-             (annotation['book_id'],
-              annotation['genre'],
-              annotation['hash'],
-              annotation['highlight_color'],
-              annotation['highlight_text'],
-              annotation['location'],
-              annotation['location_sort'],
-              annotation['last_modification'],
-              annotation['note_text'],
-              annotation['reader']
-              )
-             )
+        self._insert(transient_db, self.TRANSIENT_COLUMNS, [annotation])
         self.commit()
 
     def annotations_to_html(self, annotations_db, book_mi):
@@ -257,6 +217,7 @@ class AnnotationsDB(Logger):
         Store a set of annotations to the transient table
         '''
         self.create_annotations_transient_table(transient_db)
+        captured = []
         for ua in uas:
             if isinstance(ua, NavigableString):
                 continue
@@ -293,7 +254,9 @@ class AnnotationsDB(Logger):
             except:
                 pass
 
-            self.add_to_transient_db(transient_db, this_ua)
+            captured.append(this_ua)
+
+        self.add_many_to_transient_db(transient_db, captured)
 
     def close(self):
         if self.conn:
@@ -303,6 +266,10 @@ class AnnotationsDB(Logger):
         db_existed = os.path.exists(self.path)
         self.conn = sqlite3.connect(self.path)
         self.conn.row_factory = sqlite3.Row
+
+        # Readers don't block the writer, and commits don't fsync the db
+        self.conn.execute('''PRAGMA journal_mode=WAL''')
+        self.conn.execute('''PRAGMA synchronous=NORMAL''')
         if not db_existed:
             self.set_user_version(self.version)
         self.db_version = self.get_user_version()
@@ -331,7 +298,9 @@ class AnnotationsDB(Logger):
                 location_sort TEXT,
                 last_modification TEXT,
                 highlight_color TEXT
-                );'''.format(cached_db))
+                );
+            CREATE INDEX "{0}_book_id" ON "{0}" (book_id, location_sort);
+            '''.format(cached_db))
 
     def create_annotations_transient_table(self, transient_table):
         '''
@@ -351,7 +320,9 @@ class AnnotationsDB(Logger):
                 location TEXT,
                 location_sort TEXT,
                 reader TEXT
-                );'''.format(transient_table))
+                );
+            CREATE INDEX "{0}_book_id" ON "{0}" (book_id, location_sort);
+            '''.format(transient_table))
 
     def create_book_notes_table(self, cached_db):
         """
@@ -362,7 +333,9 @@ class AnnotationsDB(Logger):
                 (
                 book_id TEXT,
                 note_text TEXT
-                );'''.format(cached_db))
+                );
+            CREATE INDEX "{0}_book_id" ON "{0}" (book_id);
+            '''.format(cached_db))
 
     def create_bookmark_notes_table(self, cached_db):
         """
@@ -378,7 +351,9 @@ class AnnotationsDB(Logger):
                 location TEXT,
                 highlight_color TEXT,
                 note_text TEXT
-                );'''.format(cached_db))
+                );
+            CREATE INDEX "{0}_book_id" ON "{0}" (book_id);
+            '''.format(cached_db))
 
     def create_books_table(self, cached_db):
         """
@@ -547,6 +522,20 @@ class AnnotationsDB(Logger):
         user_version = cur.fetchone()[0]
         return user_version
 
+    def maintenance(self, preview=False):
+        '''
+        Fold the WAL back into the db, reclaim free pages and refresh index
+        statistics. Books tables are rebuilt with every book active, so there
+        are no orphaned annotations or widowed books to purge here.
+        '''
+        self._log_location()
+
+        if not preview:
+            self.commit()
+            self.conn.execute('''PRAGMA wal_checkpoint(TRUNCATE)''')
+            self.conn.execute('''VACUUM''')
+            self.conn.execute('''ANALYZE''')
+
     def now(self):
         c = self.conn.cursor()
         c.execute("SELECT datetime('now', 'localtime')")
@@ -657,11 +646,28 @@ class AnnotationsDB(Logger):
     def set_user_version(self, db_version):
         self.conn.execute('''PRAGMA user_version={0}'''.format(db_version))
 
+    @contextmanager
+    def transaction(self):
+        '''
+        Commit on success, roll back on exception
+        '''
+        with self.conn:
+            yield self.conn
+
     def update_book_last_annotation(self, books_db, timestamp, book_id):
         self.conn.execute('''UPDATE {0}
                              SET last_annotation=?
                              WHERE book_id=?'''.format(books_db), (timestamp, book_id))
 
+    def update_books_last_annotation(self, books_db, last_annotations):
+        '''
+        last_annotations: {book_id: timestamp}
+        '''
+        self.conn.executemany('''UPDATE {0}
+                                 SET last_annotation=?
+                                 WHERE book_id=?'''.format(books_db),
+                              [(timestamp, book_id) for book_id, timestamp in last_annotations.items()])
+
     def update_timestamp(self, cached_db):
         self.conn.execute(
             '''INSERT OR REPLACE INTO timestamps
@@ -669,6 +675,18 @@ class AnnotationsDB(Logger):
                (cached_db, self.now()))
 
     # Helpers
+    def _insert(self, table, columns, records):
+        '''
+        INSERT OR REPLACE records, each a dict supplying columns
+        Return the number of rows written
+        '''
+        cur = self.conn.executemany('''INSERT OR REPLACE INTO {0}
+                                        ({1})
+                                       VALUES({2})'''.format(
+                                        table, ', '.join(columns), ', '.join(['?'] * len(columns))),
+                                    ([record[column] for column in columns] for record in records))
+        return cur.rowcount
+
     def _timestamp_to_datestr(self, timestamp):
         '''
         Convert timestamp to
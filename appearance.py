@@ -361,15 +361,23 @@ class AnnotationElementsTable(QTableWidget):
         Modeled after book_status:_get_formatted_annotations()
         '''
         from calibre_plugins.marvin_manager.annotations import (
-            ANNOTATIONS_HTML_TEMPLATE, Annotation, Annotations, BookNotes, BookmarkNotes)
-
-        # Assemble the preview soup
-        soup = BeautifulSoup(ANNOTATIONS_HTML_TEMPLATE)
+            ANNOTATIONS_HTML_TEMPLATE, Annotation, Annotations, BookNotes, BookmarkNotes,
+            annotations_css_signature, render_cache)
 
         # Load the CSS from MXD resources
         path = os.path.join(self.parent.opts.resources_path, 'css', 'annotations.css')
         with open(path, 'rb') as f:
             css = f.read().decode('utf-8')
+
+        # Reuse the preview if this appearance has already been shown
+        key = ('preview', annotations_css_signature(), repr(self.get_data()), css)
+        preview = render_cache.get(key)
+        if preview is not None:
+            self.parent.wv.setHtml(preview)
+            return
+
+        # Assemble the preview soup
+        soup = BeautifulSoup(ANNOTATIONS_HTML_TEMPLATE)
         style_tag = Tag(soup, 'style')
         style_tag.insert(0, css)
         soup.head.style.replaceWith(style_tag)
@@ -394,7 +402,9 @@ class AnnotationElementsTable(QTableWidget):
         annotations_soup = pas.to_HTML(pas.create_soup())
         soup.body.append(annotations_soup)
 
-        self.parent.wv.setHtml(unicode(soup.renderContents()))
+        preview = unicode(soup.renderContents())
+        render_cache.put(key, preview)
+        self.parent.wv.setHtml(preview)
 
     def resize_row_height(self, lines, row):
         point_size = self.FONT.pointSize()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2013, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Developer benchmarks.
+
+Benchmark times each phase listed by a subclass's _phases() and formats the
+results. DataStructureBenchmark times the plugin's data structures against
+synthetic data: highlight location sorting, AnnotationsDB writes, the library
+table model and the installed_books footprint. The simulated Marvin harness
+lives in marvin_simulator.
+'''
+
+import hashlib, os, random, shutil, sqlite3, sys, tempfile, time
+
+try:
+    from PyQt5.Qt import QObject, Qt
+except ImportError:
+    from PyQt4.Qt import QObject, Qt
+
+from calibre.ebooks.metadata.book.base import Metadata
+
+from calibre_plugins.marvin_manager.annotations import LocationSort
+from calibre_plugins.marvin_manager.annotations_db import AnnotationsDB
+from calibre_plugins.marvin_manager.book_status import (BookStatusDialog,
+    MarkupTableModel, SortableImageWidgetItem, SortableTableWidgetItem)
+from calibre_plugins.marvin_manager.common_utils import (AnnotationStruct,
+    Book, Logger)
+
+
+class Benchmark(Logger):
+    '''
+    Time each phase listed by _phases() after _setup(), then _teardown().
+    Results are returned by run() as formatted text. Methods returning a row
+    count also report rows/sec.
+    '''
+    CHAPTER_WORDS = ['calibre', 'Marvin', 'reader', 'annotation', 'highlight',
+                     'collection', 'chapter', 'library', 'the', 'a', 'of', 'and']
+
+    TEMP_PREFIX = 'marvin_benchmark_'
+    XPATH_TEMPLATE = '/x:html[1]/x:body[1]/x:div[1]/x:div[1]/x:{0}/text()[1]'
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.prefs = parent.prefs
+        self.rates = []
+        self.results = []
+        self.root = None
+        self.verbose = parent.verbose
+
+    def run(self):
+        '''
+        Return formatted timings for each phase
+        '''
+        self._log_location()
+        self.root = tempfile.mkdtemp(prefix=self.TEMP_PREFIX)
+        try:
+            self._setup()
+            try:
+                for phase, method in self._phases():
+                    self._timed(phase, method)
+            finally:
+                self._teardown()
+        finally:
+            shutil.rmtree(self.root, ignore_errors=True)
+        return '\n'.join(self._format_results())
+
+    def _format_results(self):
+        '''
+        Return the report as a list of lines
+        '''
+        lines = [" {0:32} {1:>10}".format('phase', 'seconds')]
+        for phase, elapsed in self.results:
+            lines.append(" {0:32} {1:>10.3f}".format(phase, elapsed))
+        if self.rates:
+            lines.append('')
+            lines.append(" {0:32} {1:>10}".format('phase', 'rows/sec'))
+            for phase, rate in self.rates:
+                lines.append(" {0:32} {1:>10,.0f}".format(phase, rate))
+        return lines
+
+    def _phases(self):
+        '''
+        Return (phase, method) in run order
+        '''
+        raise NotImplementedError
+
+    def _setup(self):
+        pass
+
+    def _teardown(self):
+        pass
+
+    def _timed(self, phase, method):
+        start = time.time()
+        rows = method()
+        elapsed = time.time() - start
+        self._log("{0}: {1:.3f}s".format(phase, elapsed))
+        self.results.append((phase, elapsed))
+        if rows is not None:
+            self.rates.append((phase, rows / elapsed if elapsed else 0))
+        return elapsed
+
+
+class SimulatedLibraryView(QObject):
+    '''
+    Stand-in for the BookStatusDialog attributes used by MarkupTableModel
+    '''
+    def __init__(self, prefs, tabledata, show_match_colors=True):
+        QObject.__init__(self)
+        for name in dir(BookStatusDialog):
+            if name.endswith('_COL') or name.endswith('_COLUMNS'):
+                setattr(self, name, getattr(BookStatusDialog, name))
+        self.LIBRARY_HEADER = BookStatusDialog.LIBRARY_HEADER
+        self.busy = False
+        self.prefs = prefs
+        self.show_match_colors = show_match_colors
+        self.tabledata = tabledata
+
+    def repaint(self):
+        pass
+
+
+class DataStructureBenchmark(Benchmark):
+    '''
+    Time the plugin's data structures against synthetic data, without a
+    connected iDevice
+    '''
+    MAX_ELEMENT_DEPTH = 6
+
+    def __init__(self, parent, highlight_count=20000, repaint_rows=10000,
+                 record_count=10000):
+        Benchmark.__init__(self, parent)
+        self.annotations = None
+        self.footprints = []
+        self.highlight_count = highlight_count
+        self.highlights = None
+        self.record_count = record_count
+        self.repaint_rows = repaint_rows
+
+    def _format_results(self):
+        lines = Benchmark._format_results(self)
+        if self.footprints:
+            lines.append('')
+            lines.append(" {0:32} {1:>10}".format('records', 'KB/10k'))
+            for phase, size in self.footprints:
+                lines.append(" {0:32} {1:>10,.0f}".format(phase, size / 1024))
+        return lines
+
+    def _phases(self):
+        return [
+            ("location sort, {0:,} highlights".format(self.highlight_count),
+                self._location_sort),
+            ("annotations db, per-row", self._annotations_db_per_row),
+            ("annotations db, bulk", self._annotations_db_bulk),
+            ("open library model, {0:,} rows".format(self.repaint_rows),
+                self._build_library_model),
+            ("repaint, {0:,} rows".format(self.repaint_rows), self._repaint),
+            ("installed_books footprint", self._record_footprints),
+            ]
+
+    def _setup(self):
+        self.annotations = self._build_annotations()
+        self.highlights = self._build_highlight_table()
+
+    # Synthetic data
+    def _build_annotations(self):
+        '''
+        Return AnnotationStructs as BookStatusDialog stores them, ten per book
+        '''
+        annotations = []
+        for i in range(self.highlight_count):
+            a_mi = AnnotationStruct()
+            a_mi.annotation_id = 'annotation-{0}'.format(i)
+            a_mi.book_id = str(i // 10 + 1)
+            a_mi.highlight_color = 'Yellow'
+            a_mi.highlight_text = 'highlight {0}'.format(i)
+            a_mi.last_modification = time.time()
+            a_mi.location = 'Section 1'
+            a_mi.location_sort = '0001.{0:04d}.0000'.format(i % 10)
+            annotations.append(a_mi)
+        return annotations
+
+    def _build_highlight_table(self):
+        '''
+        Return StartXPath values for a synthetic Highlights table. Several
+        highlights fall in each paragraph, as in real reading.
+        '''
+        rnd = random.Random(self.highlight_count)
+        xpaths = []
+        for i in range(self.highlight_count):
+            steps = ['p[{0}]'.format(i // 5 + 1)]
+            for depth in range(rnd.randint(0, 3)):
+                steps.append('{0}[{1}]'.format(rnd.choice(['span', 'a', 'em']), rnd.randint(1, 4)))
+            xpaths.append(self.XPATH_TEMPLATE.format('/x:'.join(steps)))
+        con = sqlite3.connect(':memory:')
+        con.execute('''CREATE TABLE Highlights (StartXPath TEXT)''')
+        con.executemany('''INSERT INTO Highlights (StartXPath) VALUES (?)''',
+                        [(xpath,) for xpath in xpaths])
+        return con
+
+    def _build_library_model(self):
+        '''
+        Return a MarkupTableModel of repaint_rows books. Display cells are
+        built on demand, as BookStatusDialog does.
+        '''
+        bsd = BookStatusDialog
+
+        def cell_factory(book_id, col):
+            i = book_id - 1
+            if col == bsd.TITLE_COL:
+                return SortableTableWidgetItem('Book {0}'.format(i), 'book {0:06d}'.format(i))
+            elif col == bsd.AUTHOR_COL:
+                return SortableTableWidgetItem('Author {0}'.format(i % 50), i % 50)
+            elif col == bsd.WORD_COUNT_COL:
+                return SortableTableWidgetItem('{0:,}'.format(i * 10), i * 10)
+            elif col in [bsd.ANNOTATIONS_COL, bsd.VOCABULARY_COL, bsd.ARTICLES_COL]:
+                return SortableTableWidgetItem(str(i % 4) if i % 4 else '', i % 4)
+            elif col == bsd.PROGRESS_COL:
+                return SortableImageWidgetItem('progress{0:03d}.png'.format(i % 10 * 10), i % 10)
+            elif col == bsd.COLLECTIONS_COL:
+                return SortableImageWidgetItem('collections.png', i % 3 == 0)
+            elif col == bsd.LOCKED_COL:
+                return SortableImageWidgetItem('lock_enabled.png', i % 2 == 0)
+            elif col == bsd.FLAGS_COL:
+                return SortableImageWidgetItem('flags{0}.png'.format(i % 8), i % 8)
+            return SortableTableWidgetItem('', '')
+
+        tabledata = []
+        for i in range(self.repaint_rows):
+            row = [None] * len(bsd.LIBRARY_HEADER)
+            row[bsd.DEEP_VIEW_COL] = ''
+            row[bsd.MATCHED_COL] = i % len(bsd.MATCH_COLORS)
+            row[bsd.UUID_COL] = 'uuid-{0}'.format(i)
+            row[bsd.CALIBRE_ID_COL] = i + 1 if i % 3 else None
+            row[bsd.BOOK_ID_COL] = i + 1
+            row[bsd.PATH_COL] = 'book_{0:05d}.epub'.format(i)
+            tabledata.append(row)
+
+        self.library_view = SimulatedLibraryView(self.prefs, tabledata)
+        self.library_model = MarkupTableModel(self.library_view,
+                                              centered_columns=bsd.CENTERED_COLUMNS,
+                                              right_aligned_columns=bsd.RIGHT_ALIGNED_COLUMNS,
+                                              cell_factory=cell_factory)
+
+    def _deep_sizeof(self, obj, seen):
+        '''
+        Bytes held by obj and everything it references, counting shared objects once
+        '''
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            size += sum(self._deep_sizeof(k, seen) + self._deep_sizeof(v, seen)
+                        for k, v in obj.items())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sum(self._deep_sizeof(item, seen) for item in obj)
+        elif isinstance(obj, (Book, Metadata)):
+            if hasattr(obj, '__dict__'):
+                size += self._deep_sizeof(object.__getattribute__(obj, '__dict__'), seen)
+            for slot in getattr(type(obj), '__slots__', []):
+                size += self._deep_sizeof(getattr(obj, slot, None), seen)
+        return size
+
+    def _installed_book_records(self, lazy):
+        '''
+        Return {mid: record} for record_count books as _get_installed_books()
+        builds them: Metadata records holding every field, or Book records
+        whose lazy fields have not been viewed
+        '''
+        records = {}
+        for i in range(self.record_count):
+            title = 'Book {0}'.format(i)
+            author = 'Author {0}'.format(i % 50)
+            uuid = 'uuid-{0}'.format(i)
+            fields = dict(author_sort=author, calibre_collections=None,
+                          cid=i + 1 if i % 3 else None, cover_file='cover_{0}.jpg'.format(i),
+                          date_added=time.time(), date_opened=time.time(),
+                          deep_view_prepared=i % 2, device_collections=['Simulated'],
+                          flags=['NEW'], hash=hashlib.md5(title).hexdigest(),
+                          highlights=i % 4, last_updated=time.time(), match_quality=None,
+                          matches=[uuid], metadata_mismatches={}, mid=i + 1,
+                          on_device=None, path='book_{0:05d}.epub'.format(i), pin=0,
+                          progress=0.5, pubdate=None, publisher=None, rating=0,
+                          series=None, series_index=None, tags=['Fiction'],
+                          title_sort=title, uuid=uuid,
+                          word_count='{0:,}'.format(i * 10))
+            if lazy:
+                record = Book(title, [author])
+                fields.update(article_count=5, vocabulary_count=len(self.CHAPTER_WORDS) * 2)
+            else:
+                record = Metadata(title, authors=[author])
+                fields.update(
+                    articles={'Pinned': {'Article {0}'.format(a): 'http://example.com/{0}/{1}'.format(i, a)
+                                         for a in range(2)},
+                              'Wiki': {'Snippet {0}'.format(w): ' '.join(self.CHAPTER_WORDS) * 3
+                                       for w in range(3)}},
+                    comments='<div><p>{0}</p></div>'.format(' '.join(self.CHAPTER_WORDS) * 20),
+                    vocabulary=['{0}{1}'.format(word, i) for word in self.CHAPTER_WORDS * 2])
+            for key, value in fields.items():
+                setattr(record, key, value)
+            records[i + 1] = record
+        return records
+
+    # Benchmarked phases
+    def _annotations_db(self, name):
+        db = AnnotationsDB(None, path=os.path.join(self.root, name))
+        db.connect()
+        db.create_annotations_table('simulated_annotations')
+        return db
+
+    def _annotations_db_bulk(self):
+        '''
+        One executemany in one transaction
+        '''
+        db = self._annotations_db('bulk.db')
+        db.add_many_to_annotations_db('simulated_annotations', self.annotations)
+        db.close()
+        return len(self.annotations)
+
+    def _annotations_db_per_row(self):
+        '''
+        Single-row inserts, committed per book
+        '''
+        db = self._annotations_db('per_row.db')
+        book_id = None
+        for annotation in self.annotations:
+            if annotation.book_id != book_id:
+                db.commit()
+                book_id = annotation.book_id
+            db.add_to_annotations_db('simulated_annotations', annotation)
+        db.commit()
+        db.close()
+        return len(self.annotations)
+
+    def _location_sort(self):
+        '''
+        Generate location_sort keys as BookStatusDialog does for each highlight
+        '''
+        location_sort = LocationSort(self.MAX_ELEMENT_DEPTH)
+        for row in self.highlights.execute('''SELECT StartXPath FROM Highlights'''):
+            location_sort.interior(row[0])
+        self.highlights.close()
+
+    def _record_footprints(self):
+        '''
+        Size installed_books per 10k books, as Metadata records holding every
+        field and as Book records whose lazy fields have not been viewed
+        '''
+        for phase, lazy in [("installed_books, Metadata", False),
+                            ("installed_books, Book", True)]:
+            records = self._installed_book_records(lazy)
+            self.footprints.append((phase, self._deep_sizeof(records, set()) *
+                                           10000 / len(records)))
+
+    def _repaint(self):
+        '''
+        Request every role a QTableView paints, for every visible cell of
+        the library model
+        '''
+        model = self.library_model
+        roles = [Qt.DisplayRole, Qt.DecorationRole, Qt.BackgroundRole,
+                 Qt.ForegroundRole, Qt.TextAlignmentRole]
+        columns = [col for col in range(model.columnCount(None))
+                   if col not in BookStatusDialog.HIDDEN_COLUMNS]
+        for row in range(model.rowCount(None)):
+            for col in columns:
+                index = model.index(row, col)
+                for role in roles:
+                    model.data(index, role)
+        return model.rowCount(None)
@@ -8,15 +8,14 @@ __copyright__ = '2013, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
 import base64, cStringIO, hashlib, importlib, inspect, json
-import locale, operator, os, cPickle as pickle, re, sqlite3, sys, time
+import locale, os, cPickle as pickle, re, sqlite3, sys, time
 
-from collections import OrderedDict
+from collections import Mapping, OrderedDict
 from datetime import datetime, timedelta
 from dateutil import tz
 from functools import partial
 from lxml import etree
 from threading import Timer
-from xml.sax.saxutils import escape
 
 try:
     from PyQt5 import QtCore
@@ -27,7 +26,7 @@ try:
                           QHeaderView, QHBoxLayout, QIcon,
                           QItemSelectionModel, QLabel, QLineEdit, QMenu, QModelIndex,
                           QPainter, QPixmap, QProgressDialog, QPushButton,
-                          QSize, QSizePolicy, QSpacerItem,
+                          QSize, QSizePolicy, QSortFilterProxyModel, QSpacerItem,
                           QTableView, QTableWidget, QTableWidgetItem, QTimer, QToolButton,
                           QVBoxLayout, QWidget,
                           pyqtSignal)
@@ -40,7 +39,7 @@ except ImportError:
                           QHeaderView, QHBoxLayout, QIcon,
                           QItemSelectionModel, QLabel, QLineEdit, QMenu, QModelIndex,
                           QPainter, QPixmap, QProgressDialog, QPushButton,
-                          QSize, QSizePolicy, QSpacerItem,
+                          QSize, QSizePolicy, QSortFilterProxyModel, QSpacerItem,
                           QTableView, QTableWidget, QTableWidgetItem, QTimer, QToolButton,
                           QVBoxLayout, QWidget,
                           pyqtSignal)
@@ -49,8 +48,7 @@ from calibre import strftime
 from calibre.constants import islinux, isosx, iswindows
 from calibre.devices.errors import UserFeedback
 from calibre.devices.usbms.driver import debug_print
-from calibre.ebooks.BeautifulSoup import BeautifulSoup, BeautifulStoneSoup, Tag, UnicodeDammit
-from calibre.ebooks.oeb.iterator import EbookIterator
+from calibre.ebooks.BeautifulSoup import BeautifulSoup, Tag, UnicodeDammit
 from calibre.gui2 import Application, Dispatcher, error_dialog, warning_dialog
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.gui2.dialogs.progress import ProgressDialog
@@ -59,17 +57,17 @@ from calibre.utils.config import config_dir, JSONConfig
 from calibre.utils.date import strptime
 from calibre.utils.icu import sort_key
 from calibre.utils.magick.draw import thumbnail
-from calibre.utils.wordcount import get_wordcount_obj
 from calibre.utils.zipfile import ZipFile
 
 from calibre_plugins.marvin_manager.annotations import (
-    ANNOTATIONS_HTML_TEMPLATE, BookNotes, BookmarkNotes,
-    merge_annotations)
+    ANNOTATIONS_HTML_TEMPLATE, BookNotes, BookmarkNotes, LocationSort,
+    annotations_css_signature, merge_annotation_html, render_cache)
 
 from calibre_plugins.marvin_manager.common_utils import (
     AbortRequestException, AnnotationStruct, Book, BookStruct, CommandHandler, InventoryCollections,
     Logger, MyBlockingBusy, ProgressBar, RowFlasher, SizePersistedDialog,
-    get_cc_mapping, get_icon, updateCalibreGUIView, is_qt4,
+    WordCountCache, WordCountPool,
+    get_cc_mapping, get_icon, set_json_config_items, updateCalibreGUIView,
     FULL_STAR)
 
 dialog_resources_path = os.path.join(config_dir, 'plugins', 'Marvin_XD_resources', 'dialogs')
@@ -86,7 +84,7 @@ class MyTableView(QTableView):
 
     def contextMenuEvent(self, event):
 
-        index = self.indexAt(event.pos())
+        index = self.parent.proxy.mapToSource(self.indexAt(event.pos()))
         col = index.column()
         row = index.row()
         selected_books = self.parent._selected_books()
@@ -536,27 +534,45 @@ class MyTableView(QTableView):
         self.parent._update_refresh_button()
 
 
-class SortableImageWidgetItem(QWidget):
+class SortableImageWidgetItem(object):
+    """
+    Image cell sortable by sort_key
+    Pixmaps are loaded on first paint and shared by all cells with the same path
+    """
+    __slots__ = ('path', 'sort_key')
+    pixmaps = {}
+
     def __init__(self, path, sort_key):
-        super(SortableImageWidgetItem, self).__init__()
-        self.picture = QPixmap(path)
+        self.path = path
         self.sort_key = sort_key
 
     def __lt__(self, other):
         return self.sort_key < other.sort_key
 
+    @property
+    def picture(self):
+        pixmap = self.pixmaps.get(self.path)
+        if pixmap is None:
+            pixmap = self.pixmaps[self.path] = QPixmap(self.path)
+        return pixmap
 
-class SortableTableWidgetItem(QTableWidgetItem):
+
+class SortableTableWidgetItem(object):
     """
-    Subclass widget sortable by sort_key
+    Text cell sortable by sort_key
     """
+    __slots__ = ('_text', 'sort_key')
+
     def __init__(self, text, sort_key):
-        super(SortableTableWidgetItem, self).__init__(text)
+        self._text = text
         self.sort_key = sort_key
 
     def __lt__(self, other):
         return self.sort_key < other.sort_key
 
+    def text(self):
+        return self._text
+
 
 class MarkupTableModel(QAbstractTableModel):
     #http://www.saltycrane.com/blog/2007/12/pyqt-43-qtableview-qabstracttablemodel/
@@ -571,183 +587,97 @@ class MarkupTableModel(QAbstractTableModel):
     MAGENTA_HUE = 0.875        # 315/360
     WHITE_HUE = 1.0
 
+    ROW_CACHE_LIMIT = 2000
+
     dataChanged = pyqtSignal(object, object)
     layoutChanged = pyqtSignal(object)
 
-    def __init__(self, parent=None, centered_columns=[], right_aligned_columns=[], *args):
+    def __init__(self, parent=None, centered_columns=[], right_aligned_columns=[],
+                 cell_factory=None, *args):
         """
-        datain: a list of lists
+        parent.tabledata: a list of rows, each a list of cells in LIBRARY_HEADER order
         headerdata: a list of strings
+        Storage is by column: columns[col][row] holds the cell, text[col][row]
+        its display text. Sort keys are extracted per column on first sort.
+        book_id and cid indexes are maintained across sorts and edits.
+
+        With cell_factory(book_id, col), cells in parent.LAZY_COLUMNS may be None
+        in tabledata. A row's cells are then built when the view first asks for
+        them, and dropped again once more than ROW_CACHE_LIMIT rows are built.
+        Rows with edited cells are kept.
         """
         QAbstractTableModel.__init__(self, parent, *args)
         self.parent = parent
-        self.arraydata = parent.tabledata
         self.centered_columns = centered_columns
         self.right_aligned_columns = right_aligned_columns
         self.headerdata = parent.LIBRARY_HEADER
         self.show_match_colors = parent.show_match_colors
 
+        self.cell_factory = cell_factory
+        self.edited_rows = set()
+        self.lazy_columns = frozenset(parent.LAZY_COLUMNS if cell_factory else [])
+        self.row_cache = OrderedDict()
+
+        ncols = len(self.headerdata)
+        self.columns = [list(column) for column in zip(*parent.tabledata)] or [[] for col in range(ncols)]
+        self.text = [[self._cell_text(cell) for cell in column] for column in self.columns]
+        self.sort_keys = [None] * ncols
+        self._build_indexes()
+        self._build_render_state()
+
     def all_rows(self):
-        return self.arraydata
+        """
+        Return the rows as lists of cells
+        """
+        return [[self._cell(col, row) for col in range(len(self.columns))]
+                for row in range(self.rowCount(None))]
 
     def columnCount(self, parent):
         return len(self.headerdata)
 
+    def column_text(self, col):
+        """
+        Return display text for every row in col. Rows not yet built are
+        rendered through cell_factory without being cached.
+        """
+        if col not in self.lazy_columns:
+            return self.text[col]
+        book_ids = self.columns[self.parent.BOOK_ID_COL]
+        return [text if cell is not None else self._cell_text(self.cell_factory(book_ids[row], col))
+                for row, (cell, text) in enumerate(zip(self.columns[col], self.text[col]))]
+
     def data(self, index, role):
-        row, col = index.row(), index.column()
+        """
+        Role values come from the render state built by _build_render_state()
+        """
         if not index.isValid():
             return None
+        row, col = index.row(), index.column()
 
-        elif role == Qt.ForegroundRole and self.show_match_colors:
-            match_quality = self.get_match_quality(row)
-            if match_quality == BookStatusDialog.MATCH_COLORS.index('DARK_GRAY'):
-                return QBrush(Qt.white)
-
-        elif role == Qt.BackgroundRole and self.show_match_colors:
-            match_quality = self.get_match_quality(row)
-            if match_quality == BookStatusDialog.MATCH_COLORS.index('LIGHT_GRAY'):
-                return QBrush(QColor(0xD8, 0xD8,0xD8))
-            elif match_quality == BookStatusDialog.MATCH_COLORS.index('DARK_GRAY'):
-                return QBrush(QColor(0x98, 0x98,0x98))
-            elif match_quality == BookStatusDialog.MATCH_COLORS.index('GREEN'):
-                return QBrush(QColor.fromHsvF(self.GREEN_HUE, self.SATURATION, self.HSVALUE))
-            elif match_quality == BookStatusDialog.MATCH_COLORS.index('MAGENTA'):
-                return QBrush(QColor.fromHsvF(self.MAGENTA_HUE, self.SATURATION, self.HSVALUE))
-            elif match_quality == BookStatusDialog.MATCH_COLORS.index('ORANGE'):
-                return QBrush(QColor.fromHsvF(self.ORANGE_HUE, self.SATURATION, self.HSVALUE))
-            elif match_quality == BookStatusDialog.MATCH_COLORS.index('RED'):
-                return QBrush(QColor.fromHsvF(self.RED_HUE, self.SATURATION, self.HSVALUE))
-            elif match_quality == BookStatusDialog.MATCH_COLORS.index('YELLOW'):
-                return QBrush(QColor.fromHsvF(self.YELLOW_HUE, self.SATURATION, self.HSVALUE))
-            else:
-                return QBrush(QColor.fromHsvF(self.WHITE_HUE, 0.0, self.HSVALUE))
-
-        elif role == Qt.DecorationRole and col == self.parent.LOCKED_COL:
-            return self.arraydata[row][self.parent.LOCKED_COL].picture
-
-        elif role == Qt.DecorationRole and col == self.parent.FLAGS_COL:
-            return self.arraydata[row][self.parent.FLAGS_COL].picture
-
-        elif role == Qt.DecorationRole and col == self.parent.COLLECTIONS_COL:
-            return self.arraydata[row][self.parent.COLLECTIONS_COL].picture
-
-        elif (role == Qt.DisplayRole and
-              col == self.parent.PROGRESS_COL
-              and self.parent.prefs.get('show_progress_as_percentage', False)):
-            return self.arraydata[row][self.parent.PROGRESS_COL].text()
-        elif (role == Qt.DecorationRole and
-              col == self.parent.PROGRESS_COL
-              and not self.parent.prefs.get('show_progress_as_percentage', False)):
-            return self.arraydata[row][self.parent.PROGRESS_COL].picture
-
-        elif role == Qt.DisplayRole and col == self.parent.SERIES_COL:
-            return self.arraydata[row][self.parent.SERIES_COL].text()
-
-        elif role == Qt.DisplayRole and col == self.parent.RATING_COL:
-            return self.arraydata[row][self.parent.RATING_COL].text()
-
-        elif role == Qt.DisplayRole and col == self.parent.WORD_COUNT_COL:
-            return self.arraydata[row][self.parent.WORD_COUNT_COL].text()
-
-        elif role == Qt.DisplayRole and col == self.parent.TITLE_COL:
-            return self.arraydata[row][self.parent.TITLE_COL].text()
-        elif role == Qt.DisplayRole and col == self.parent.AUTHOR_COL:
-            return self.arraydata[row][self.parent.AUTHOR_COL].text()
-        elif role == Qt.DisplayRole and col == self.parent.DATE_ADDED_COL:
-            return self.arraydata[row][self.parent.DATE_ADDED_COL].text()
-        elif role == Qt.DisplayRole and col == self.parent.LAST_OPENED_COL:
-            return self.arraydata[row][self.parent.LAST_OPENED_COL].text()
-        elif role == Qt.DisplayRole and col == self.parent.SUBJECTS_COL:
-            return self.arraydata[row][self.parent.SUBJECTS_COL].text()
-        elif role == Qt.DisplayRole and col == self.parent.ANNOTATIONS_COL:
-            return self.arraydata[row][self.parent.ANNOTATIONS_COL].text()
-        elif role == Qt.DisplayRole and col == self.parent.VOCABULARY_COL:
-            return self.arraydata[row][self.parent.VOCABULARY_COL].text()
-        elif role == Qt.DisplayRole and col == self.parent.ARTICLES_COL:
-            return self.arraydata[row][self.parent.ARTICLES_COL].text()
-
-        elif role == Qt.TextAlignmentRole and (col in self.centered_columns):
-            return Qt.AlignHCenter
-        elif role == Qt.TextAlignmentRole and (col in self.right_aligned_columns):
-            return Qt.AlignRight
-
-        elif role == Qt.ToolTipRole:
-            if self.parent.busy:
-                return "<p>Please wait until current operation completes</p>"
-            else:
-                match_quality = self.get_match_quality(row)
-                tip = '<p>'
-                if match_quality == BookStatusDialog.MATCH_COLORS.index('GREEN'):
-                    tip += 'Matched in calibre library'
-                elif match_quality == BookStatusDialog.MATCH_COLORS.index('YELLOW'):
-                    tip += 'Matched in calibre library with differing metadata'
-                elif match_quality == BookStatusDialog.MATCH_COLORS.index('ORANGE'):
-                    tip += 'Duplicate of matched book in calibre library'
-                elif match_quality == BookStatusDialog.MATCH_COLORS.index('LIGHT_GRAY'):
-                    tip += 'Book updated in calibre library'
-                elif match_quality == BookStatusDialog.MATCH_COLORS.index('DARK_GRAY'):
-                    tip += 'Book updated in Marvin library'
-                elif match_quality == BookStatusDialog.MATCH_COLORS.index('MAGENTA'):
-                    tip += 'Multiple copies in calibre library'
-                elif match_quality == BookStatusDialog.MATCH_COLORS.index('RED'):
-                    tip += 'Duplicated in Marvin library'
-                else:
-                    tip += 'Book in Marvin library only'
-
-                # Add the suffix based upon column
-                if col in [self.parent.TITLE_COL, self.parent.AUTHOR_COL]:
-                    return tip + "<br/>Double-click to view metadata<br/>Right-click for more options</p>"
-
-                elif col in [self.parent.ANNOTATIONS_COL,
-                             self.parent.ARTICLES_COL]:
-                    has_content = bool(self.arraydata[row][col])
-                    if has_content:
-                        return tip + "<br/>Double-click to view details<br/>Right-click for more options</p>"
-                    else:
-                        return tip + '</p>'
-
-                elif col == self.parent.COLLECTIONS_COL:
-                    has_content = bool(self.arraydata[row][col].sort_key)
-                    if has_content:
-                        return tip + "<br/>Double-click to view details<br/>Right-click for more options</p>"
-                    else:
-                        return tip + '<br/>Right-click for more options</p>'
-
-                elif col in [self.parent.DEEP_VIEW_COL]:
-                    has_content = bool(self.arraydata[row][col])
-                    if has_content:
-                        return tip + "<br/>Double-click to view Deep View content<br/>Right-click for more options</p>"
-                    else:
-                        return tip + '<br/>Double-click to generate Deep View content<br/>Right-click for more options</p>'
-
-                elif col in [self.parent.FLAGS_COL]:
-                    return tip + "<br/>Right-click for options</p>"
-
-                elif col == self.parent.LOCKED_COL:
-                    return ("<p>Double-click to toggle locked status" +
-                            "<br/>Right-click for more options</p>")
+        if role == Qt.DisplayRole:
+            if col in self.display_text_columns:
+                return self._text(col, row)
+            return self._cell(col, row)
 
-                elif col in [self.parent.RATING_COL]:
-                    return tip + "<br/>Right-click to set rating</p>"
+        elif role == Qt.DecorationRole:
+            if col in self.decoration_columns:
+                return self._cell(col, row).picture
 
-                elif col in [self.parent.VOCABULARY_COL]:
-                    has_content = bool(self.arraydata[row][col])
-                    if has_content:
-                        return tip + "<br/>Double-click to view Vocabulary words<br/>Right-click for more options</p>"
-                    else:
-                        return tip + '<br/>Right-click for options</p>'
+        elif role == Qt.BackgroundRole:
+            if self.show_match_colors:
+                return self.background_brushes.get(self.get_match_quality(row), self.default_background)
 
-                elif col in [self.parent.WORD_COUNT_COL]:
-                    return (tip + "<br/>Double-click to generate word count" +
-                                  "<br/>Right-click to generate word count for multiple books</p>")
+        elif role == Qt.ForegroundRole:
+            if self.show_match_colors:
+                return self.foreground_brushes.get(self.get_match_quality(row))
 
-                else:
-                    return tip + '</p>'
+        elif role == Qt.TextAlignmentRole:
+            return self.alignments.get(col)
 
-        elif role != Qt.DisplayRole:
-            return None
+        elif role == Qt.ToolTipRole:
+            return self._tooltip(row, col)
 
-        return self.arraydata[index.row()][index.column()]
+        return None
 
     def headerData(self, col, orientation, role):
         if role == Qt.DisplayRole:
@@ -797,11 +727,42 @@ class MarkupTableModel(QAbstractTableModel):
 
     def refresh(self, show_match_colors):
         self.show_match_colors = show_match_colors
+        self._build_render_state()
         self.dataChanged.emit(self.createIndex(0, 0),
                               self.createIndex(self.rowCount(0), self.columnCount(0)))
 
+    def remove_rows(self, rows):
+        """
+        Remove rows from the model
+        """
+        for row in sorted(rows, reverse=True):
+            book_id = self.columns[self.parent.BOOK_ID_COL][row]
+            self.edited_rows.discard(book_id)
+            self.row_cache.pop(book_id, None)
+            self.beginRemoveRows(QModelIndex(), row, row)
+            for col, column in enumerate(self.columns):
+                del column[row]
+                del self.text[col][row]
+                if self.sort_keys[col] is not None:
+                    del self.sort_keys[col][row]
+            self.endRemoveRows()
+        self._build_indexes()
+
+    def row_for_book_id(self, book_id):
+        """
+        Return the row displaying book_id, or None
+        """
+        return self.book_id_index.get(book_id)
+
+    def row_for_cid(self, cid):
+        """
+        Return the first row matched to calibre id cid, or None
+        """
+        rows = self.cid_index.get(cid)
+        return min(rows) if rows else None
+
     def rowCount(self, parent):
-        return len(self.arraydata)
+        return len(self.columns[0])
 
     def setData(self, index, value, role):
         row, col = index.row(), index.column()
@@ -812,127 +773,496 @@ class MarkupTableModel(QAbstractTableModel):
     def sort(self, Ncol, order):
         """
         Sort table by given column number.
+        Rows are ordered by the column's sort keys, then every column is
+        permuted, so cells are never compared directly.
         """
         self.layoutChanged.emit("layoutAboutToBeChanged")
-        self.arraydata = sorted(self.arraydata, key=operator.itemgetter(Ncol))
+        if self.sort_keys[Ncol] is None:
+            self.sort_keys[Ncol] = self._column_sort_keys(Ncol)
+        keys = self.sort_keys[Ncol]
+        permutation = sorted(range(len(keys)), key=keys.__getitem__)
         if order == Qt.DescendingOrder:
-            self.arraydata.reverse()
+            permutation.reverse()
+        self.columns = [[column[i] for i in permutation] for column in self.columns]
+        self.text = [[text[i] for i in permutation] for text in self.text]
+        self.sort_keys = [None if sort_keys is None else [sort_keys[i] for i in permutation]
+                          for sort_keys in self.sort_keys]
+        self._build_indexes()
         self.layoutChanged.emit("layoutChanged")
 
     # ~~~~~~~~~~~ Getters and Setters ~~~~~~~~~~~
     def get_annotations(self, row):
-        return self.arraydata[row][self.parent.ANNOTATIONS_COL]
+        return self._cell(self.parent.ANNOTATIONS_COL, row)
 
 
     def get_articles(self, row):
-        return self.arraydata[row][self.parent.ARTICLES_COL]
+        return self._cell(self.parent.ARTICLES_COL, row)
 
 
     def get_author(self, row):
-        return self.arraydata[row][self.parent.AUTHOR_COL]
+        return self._cell(self.parent.AUTHOR_COL, row)
 
 
     def get_book_id(self, row):
-        return self.arraydata[row][self.parent.BOOK_ID_COL]
+        return self._cell(self.parent.BOOK_ID_COL, row)
 
 
     def get_calibre_id(self, row):
-        return self.arraydata[row][self.parent.CALIBRE_ID_COL]
+        return self._cell(self.parent.CALIBRE_ID_COL, row)
 
     def set_calibre_id(self, row, value):
-        self.arraydata[row][self.parent.CALIBRE_ID_COL] = value
+        self._set_cell(self.parent.CALIBRE_ID_COL, row, value)
 
 
     def get_collections(self, row):
-        return self.arraydata[row][self.parent.COLLECTIONS_COL]
+        return self._cell(self.parent.COLLECTIONS_COL, row)
 
     def set_collections(self, row, value):
-        self.arraydata[row][self.parent.COLLECTIONS_COL] = value
+        self._set_cell(self.parent.COLLECTIONS_COL, row, value)
         self.parent.repaint()
 
 
     def get_deep_view(self, row):
-        return self.arraydata[row][self.parent.DEEP_VIEW_COL]
+        return self._cell(self.parent.DEEP_VIEW_COL, row)
 
     def set_deep_view(self, row, value):
-        self.arraydata[row][self.parent.DEEP_VIEW_COL] = value
+        self._set_cell(self.parent.DEEP_VIEW_COL, row, value)
         self.parent.repaint()
 
 
     def get_flags(self, row):
-        return self.arraydata[row][self.parent.FLAGS_COL]
+        return self._cell(self.parent.FLAGS_COL, row)
 
     def set_flags(self, row, value):
-        self.arraydata[row][self.parent.FLAGS_COL] = value
+        self._set_cell(self.parent.FLAGS_COL, row, value)
         #self.parent.repaint()
 
 
     def get_last_opened(self, row):
-        return self.arraydata[row][self.parent.LAST_OPENED_COL]
+        return self._cell(self.parent.LAST_OPENED_COL, row)
 
 
     def get_locked(self, row):
-        return self.arraydata[row][self.parent.LOCKED_COL]
+        return self._cell(self.parent.LOCKED_COL, row)
 
     def set_locked(self, row, value):
-        self.arraydata[row][self.parent.LOCKED_COL] = value
+        self._set_cell(self.parent.LOCKED_COL, row, value)
         #self.parent.repaint()
 
 
     def get_match_quality(self, row):
-        return self.arraydata[row][self.parent.MATCHED_COL]
+        return self._cell(self.parent.MATCHED_COL, row)
 
     def set_match_quality(self, row, value):
-        self.arraydata[row][self.parent.MATCHED_COL] = value
+        self._set_cell(self.parent.MATCHED_COL, row, value)
         self.parent.repaint()
 
+    def set_match_qualities(self, values):
+        """
+        Set {row: match_quality} without repainting
+        """
+        for row, value in values.iteritems():
+            self._set_cell(self.parent.MATCHED_COL, row, value)
+
 
     def get_path(self, row):
-        return self.arraydata[row][self.parent.PATH_COL]
+        return self._cell(self.parent.PATH_COL, row)
 
 
     def get_progress(self, row):
-        return self.arraydata[row][self.parent.PROGRESS_COL]
+        return self._cell(self.parent.PROGRESS_COL, row)
 
     def set_progress(self, row, value):
-        self.arraydata[row][self.parent.PROGRESS_COL] = value
+        self._set_cell(self.parent.PROGRESS_COL, row, value)
         #self.parent.repaint()
 
 
     def get_rating(self, row):
-        return self.arraydata[row][self.parent.RATING_COL]
+        return self._cell(self.parent.RATING_COL, row)
 
     def set_rating(self, row, value):
-        self.arraydata[row][self.parent.RATING_COL] = value
+        self._set_cell(self.parent.RATING_COL, row, value)
 
 
     def get_series(self, row):
-        return self.arraydata[row][self.parent.SERIES_COL]
+        return self._cell(self.parent.SERIES_COL, row)
 
 
     def get_subjects(self, row):
-        return self.arraydata[row][self.parent.SUBJECTS_COL]
+        return self._cell(self.parent.SUBJECTS_COL, row)
 
 
     def get_title(self, row):
-        return self.arraydata[row][self.parent.TITLE_COL]
+        return self._cell(self.parent.TITLE_COL, row)
 
 
     def get_uuid(self, row):
-        return self.arraydata[row][self.parent.UUID_COL]
+        return self._cell(self.parent.UUID_COL, row)
 
 
     def get_vocabulary(self, row):
-        return self.arraydata[row][self.parent.VOCABULARY_COL]
+        return self._cell(self.parent.VOCABULARY_COL, row)
 
 
     def get_word_count(self, row):
-        return self.arraydata[row][self.parent.WORD_COUNT_COL]
+        return self._cell(self.parent.WORD_COUNT_COL, row)
 
     def set_word_count(self, row, value):
-        self.arraydata[row][self.parent.WORD_COUNT_COL] = value
+        self._set_cell(self.parent.WORD_COUNT_COL, row, value)
         self.parent.repaint()
 
+    # ~~~~~~~~~~~ Helpers ~~~~~~~~~~~
+    def _build_indexes(self):
+        self.book_id_index = dict((book_id, row) for row, book_id in
+                                  enumerate(self.columns[self.parent.BOOK_ID_COL]))
+        self.cid_index = {}
+        for row, cid in enumerate(self.columns[self.parent.CALIBRE_ID_COL]):
+            self.cid_index.setdefault(cid, []).append(row)
+
+    def _build_render_state(self):
+        """
+        Precompute brushes, tooltips and per-column role lookups.
+        Rebuilt by refresh() when prefs change.
+        """
+        mc = BookStatusDialog.MATCH_COLORS
+
+        def hsv_brush(hue):
+            return QBrush(QColor.fromHsvF(hue, self.SATURATION, self.HSVALUE))
+
+        self.background_brushes = {
+            mc.index('DARK_GRAY'): QBrush(QColor(0x98, 0x98, 0x98)),
+            mc.index('GREEN'): hsv_brush(self.GREEN_HUE),
+            mc.index('LIGHT_GRAY'): QBrush(QColor(0xD8, 0xD8, 0xD8)),
+            mc.index('MAGENTA'): hsv_brush(self.MAGENTA_HUE),
+            mc.index('ORANGE'): hsv_brush(self.ORANGE_HUE),
+            mc.index('RED'): hsv_brush(self.RED_HUE),
+            mc.index('YELLOW'): hsv_brush(self.YELLOW_HUE),
+            }
+        self.default_background = QBrush(QColor.fromHsvF(self.WHITE_HUE, 0.0, self.HSVALUE))
+        self.foreground_brushes = {mc.index('DARK_GRAY'): QBrush(Qt.white)}
+        self.match_tips = {
+            mc.index('DARK_GRAY'): 'Book updated in Marvin library',
+            mc.index('GREEN'): 'Matched in calibre library',
+            mc.index('LIGHT_GRAY'): 'Book updated in calibre library',
+            mc.index('MAGENTA'): 'Multiple copies in calibre library',
+            mc.index('ORANGE'): 'Duplicate of matched book in calibre library',
+            mc.index('RED'): 'Duplicated in Marvin library',
+            mc.index('YELLOW'): 'Matched in calibre library with differing metadata',
+            }
+
+        p = self.parent
+        display_text_columns = [p.ANNOTATIONS_COL, p.ARTICLES_COL, p.AUTHOR_COL,
+                                p.DATE_ADDED_COL, p.LAST_OPENED_COL, p.RATING_COL,
+                                p.SERIES_COL, p.SUBJECTS_COL, p.TITLE_COL,
+                                p.VOCABULARY_COL, p.WORD_COUNT_COL]
+        decoration_columns = [p.COLLECTIONS_COL, p.FLAGS_COL, p.LOCKED_COL]
+        if p.prefs.get('show_progress_as_percentage', False):
+            display_text_columns.append(p.PROGRESS_COL)
+        else:
+            decoration_columns.append(p.PROGRESS_COL)
+        self.display_text_columns = frozenset(display_text_columns)
+        self.decoration_columns = frozenset(decoration_columns)
+
+        self.alignments = dict((col, Qt.AlignRight) for col in self.right_aligned_columns)
+        self.alignments.update((col, Qt.AlignHCenter) for col in self.centered_columns)
+
+    def _cell(self, col, row):
+        """
+        Return the cell at row, col, building the row if needed
+        """
+        if col in self.lazy_columns:
+            book_id = self.columns[self.parent.BOOK_ID_COL][row]
+            if book_id in self.row_cache:
+                self.row_cache[book_id] = self.row_cache.pop(book_id)
+            elif self.columns[col][row] is None:
+                self._materialize_row(row)
+        return self.columns[col][row]
+
+    def _cell_text(self, cell):
+        text = getattr(cell, 'text', None)
+        return text() if callable(text) else cell
+
+    def _column_sort_keys(self, col):
+        if col not in self.lazy_columns:
+            return [getattr(cell, 'sort_key', cell) for cell in self.columns[col]]
+        book_ids = self.columns[self.parent.BOOK_ID_COL]
+        return [(cell if cell is not None else self.cell_factory(book_ids[row], col)).sort_key
+                for row, cell in enumerate(self.columns[col])]
+
+    def _materialize_row(self, row):
+        """
+        Build the lazy cells for row, evicting the least recently used rows
+        """
+        book_id = self.columns[self.parent.BOOK_ID_COL][row]
+        for col in self.lazy_columns:
+            if self.columns[col][row] is None:
+                cell = self.cell_factory(book_id, col)
+                self.columns[col][row] = cell
+                self.text[col][row] = self._cell_text(cell)
+        self.row_cache[book_id] = True
+
+        while len(self.row_cache) > self.ROW_CACHE_LIMIT:
+            evicted, _ = self.row_cache.popitem(last=False)
+            if evicted in self.edited_rows:
+                continue
+            evicted_row = self.book_id_index[evicted]
+            for col in self.lazy_columns:
+                self.columns[col][evicted_row] = None
+                self.text[col][evicted_row] = None
+
+    def _set_cell(self, col, row, value):
+        """
+        Store value at row, col, keeping text, sort keys and indexes current
+        """
+        if col == self.parent.CALIBRE_ID_COL:
+            old_cid = self.columns[col][row]
+            if old_cid in self.cid_index:
+                self.cid_index[old_cid].remove(row)
+                if not self.cid_index[old_cid]:
+                    del self.cid_index[old_cid]
+            self.cid_index.setdefault(value, []).append(row)
+        if col in self.lazy_columns:
+            if self.columns[col][row] is None:
+                self._materialize_row(row)
+            self.edited_rows.add(self.columns[self.parent.BOOK_ID_COL][row])
+        self.columns[col][row] = value
+        self.text[col][row] = self._cell_text(value)
+        if self.sort_keys[col] is not None:
+            self.sort_keys[col][row] = getattr(value, 'sort_key', value)
+
+    def _text(self, col, row):
+        if col in self.lazy_columns:
+            self._cell(col, row)
+        return self.text[col][row]
+
+    def _tooltip(self, row, col):
+        if self.parent.busy:
+            return "<p>Please wait until current operation completes</p>"
+        else:
+            tip = '<p>' + self.match_tips.get(self.get_match_quality(row), 'Book in Marvin library only')
+
+            # Add the suffix based upon column
+            if col in [self.parent.TITLE_COL, self.parent.AUTHOR_COL]:
+                return tip + "<br/>Double-click to view metadata<br/>Right-click for more options</p>"
+
+            elif col in [self.parent.ANNOTATIONS_COL,
+                         self.parent.ARTICLES_COL]:
+                has_content = bool(self._cell(col, row))
+                if has_content:
+                    return tip + "<br/>Double-click to view details<br/>Right-click for more options</p>"
+                else:
+                    return tip + '</p>'
+
+            elif col == self.parent.COLLECTIONS_COL:
+                has_content = bool(self._cell(col, row).sort_key)
+                if has_content:
+                    return tip + "<br/>Double-click to view details<br/>Right-click for more options</p>"
+                else:
+                    return tip + '<br/>Right-click for more options</p>'
+
+            elif col in [self.parent.DEEP_VIEW_COL]:
+                has_content = bool(self._cell(col, row))
+                if has_content:
+                    return tip + "<br/>Double-click to view Deep View content<br/>Right-click for more options</p>"
+                else:
+                    return tip + '<br/>Double-click to generate Deep View content<br/>Right-click for more options</p>'
+
+            elif col in [self.parent.FLAGS_COL]:
+                return tip + "<br/>Right-click for options</p>"
+
+            elif col == self.parent.LOCKED_COL:
+                return ("<p>Double-click to toggle locked status" +
+                        "<br/>Right-click for more options</p>")
+
+            elif col in [self.parent.RATING_COL]:
+                return tip + "<br/>Right-click to set rating</p>"
+
+            elif col in [self.parent.VOCABULARY_COL]:
+                has_content = bool(self._cell(col, row))
+                if has_content:
+                    return tip + "<br/>Double-click to view Vocabulary words<br/>Right-click for more options</p>"
+                else:
+                    return tip + '<br/>Right-click for options</p>'
+
+            elif col in [self.parent.WORD_COUNT_COL]:
+                return (tip + "<br/>Double-click to generate word count" +
+                              "<br/>Right-click to generate word count for multiple books</p>")
+
+            else:
+                return tip + '</p>'
+
+
+class MarkupFilterProxyModel(QSortFilterProxyModel):
+    """
+    Filters MarkupTableModel rows by Title, Author, Series or Subjects.
+    Matching runs against a case-folded search index built once per source model.
+    Sorting is delegated to the source model, so filtered rows keep source order.
+    """
+    REGEX_CHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    def __init__(self, parent=None):
+        QSortFilterProxyModel.__init__(self, parent)
+        self.matched = None
+        self.query = None
+        self.search_index = None
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self.matched is None:
+            return True
+        return self.sourceModel().get_book_id(source_row) in self.matched
+
+    def proxy_row(self, source_row):
+        """
+        Return the view row for source_row, -1 if filtered out
+        """
+        return self.mapFromSource(self.sourceModel().index(source_row, 0)).row()
+
+    def set_filter(self, pattern):
+        """
+        Show only rows matching pattern, all rows if pattern is empty.
+        A plain query extending the previous one only searches the previous matches.
+        """
+        pattern = pattern.strip() if pattern else ''
+        query = pattern.lower()
+        if not query:
+            self.matched = None
+            self.query = None
+            self.invalidateFilter()
+            return
+
+        if self.search_index is None:
+            self._build_search_index()
+
+        if self.REGEX_CHARS.search(query):
+            try:
+                # Fields are joined by newlines, MULTILINE anchors ^ and $ to each field
+                match = re.compile(pattern, re.IGNORECASE | re.MULTILINE).search
+            except re.error:
+                # Incomplete pattern while typing, keep the current filter
+                return
+            candidates = self.search_index.iterkeys()
+        else:
+            match = lambda text: query in text
+            if (self.matched is not None and self.query and
+                    not self.REGEX_CHARS.search(self.query) and self.query in query):
+                candidates = self.matched
+            else:
+                candidates = self.search_index.iterkeys()
+
+        self.matched = set(book_id for book_id in candidates if match(self.search_index[book_id]))
+        self.query = query
+        self.invalidateFilter()
+
+    def setSourceModel(self, model):
+        self.matched = None
+        self.query = None
+        self.search_index = None
+        QSortFilterProxyModel.setSourceModel(self, model)
+
+    def sort(self, column, order):
+        self.sourceModel().sort(column, order)
+        self.invalidate()
+
+    # ~~~~~~~~~~~ Helpers ~~~~~~~~~~~
+    def _build_search_index(self):
+        """
+        {book_id: title, author, series and subjects, lowercased, one per line}
+        """
+        model = self.sourceModel()
+        dialog = model.parent
+        book_ids = model.columns[dialog.BOOK_ID_COL]
+        fields = [model.column_text(col) for col in [dialog.TITLE_COL, dialog.AUTHOR_COL,
+                                                     dialog.SERIES_COL, dialog.SUBJECTS_COL]]
+        self.search_index = {}
+        for row, book_id in enumerate(book_ids):
+            self.search_index[book_id] = '\n'.join(unicode(field[row]) for field in fields).lower()
+
+
+class SelectionSnapshot(Mapping):
+    """
+    Immutable {row: book} view of selected rows, captured once from the model.
+    Values are stored as column vectors; snapshot[row][field] and
+    snapshot.column(field) read from them without touching the model again.
+    """
+    FIELDS = ['author', 'book_id', 'cid', 'has_annotations', 'has_articles',
+              'has_dv_content', 'has_vocabulary', 'last_opened', 'locked',
+              'path', 'progress', 'title', 'uuid', 'word_count']
+
+    def __init__(self, rows, columns):
+        self.rows = tuple(rows)
+        self.positions = dict((row, i) for i, row in enumerate(self.rows))
+        self.columns = columns
+
+    @classmethod
+    def capture(cls, model, rows):
+        """
+        Read FIELDS for rows from model
+        """
+        rows = tuple(rows)
+        columns = {
+            'author': tuple(str(model.get_author(row).text()) for row in rows),
+            'book_id': tuple(model.get_book_id(row) for row in rows),
+            'cid': tuple(model.get_calibre_id(row) for row in rows),
+            'has_annotations': tuple(model.get_annotations(row).sort_key for row in rows),
+            'has_articles': tuple(model.get_articles(row).sort_key for row in rows),
+            'has_dv_content': tuple(bool(model.get_deep_view(row)) for row in rows),
+            'has_vocabulary': tuple(model.get_vocabulary(row).sort_key for row in rows),
+            'last_opened': tuple(str(model.get_last_opened(row).text()) for row in rows),
+            'locked': tuple(model.get_locked(row).sort_key for row in rows),
+            'path': tuple(model.get_path(row) for row in rows),
+            'progress': tuple(model.get_progress(row).sort_key for row in rows),
+            'title': tuple(str(model.get_title(row).text()) for row in rows),
+            'uuid': tuple(model.get_uuid(row) for row in rows),
+            'word_count': tuple(model.get_word_count(row).sort_key for row in rows),
+            }
+        return cls(rows, columns)
+
+    def __contains__(self, row):
+        return row in self.positions
+
+    def __getitem__(self, row):
+        return SelectedBook(self, self.positions[row])
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, field):
+        """
+        Return field for every selected row, in selection order
+        """
+        return self.columns[field]
+
+    def subset(self, rows):
+        """
+        Return a snapshot of rows, taken from this one
+        """
+        indexes = [self.positions[row] for row in rows]
+        return SelectionSnapshot(rows, dict((field, tuple(values[i] for i in indexes))
+                                            for field, values in self.columns.items()))
+
+
+class SelectedBook(Mapping):
+    """
+    One row of a SelectionSnapshot
+    """
+    __slots__ = ('index', 'snapshot')
+
+    def __init__(self, snapshot, index):
+        self.index = index
+        self.snapshot = snapshot
+
+    def __getitem__(self, field):
+        return self.snapshot.columns[field][self.index]
+
+    def __iter__(self):
+        return iter(SelectionSnapshot.FIELDS)
+
+    def __len__(self):
+        return len(SelectionSnapshot.FIELDS)
+
 
 class BookStatusDialog(SizePersistedDialog, Logger):
     '''
@@ -1018,6 +1348,24 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             PROGRESS_COL,
             WORD_COUNT_COL
         ]
+        # Built on demand by _generate_table_cell()
+        LAZY_COLUMNS = [
+            ANNOTATIONS_COL,
+            ARTICLES_COL,
+            AUTHOR_COL,
+            COLLECTIONS_COL,
+            DATE_ADDED_COL,
+            FLAGS_COL,
+            LAST_OPENED_COL,
+            LOCKED_COL,
+            PROGRESS_COL,
+            RATING_COL,
+            SERIES_COL,
+            SUBJECTS_COL,
+            TITLE_COL,
+            VOCABULARY_COL,
+            WORD_COUNT_COL,
+        ]
 
     # User-controlled columns. Text is displayed in header context menu
     if True:
@@ -1121,33 +1469,36 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         self._log_location("%s arg2: %s" % (repr(action), arg2))
 
+        # Capture the selection once for the whole action
+        selected_books = self._selected_books()
+
         if action == 'apply_date_read':
-            self._apply_date_read()
+            self._apply_date_read(selected_books=selected_books)
         elif action == 'apply_progress':
-            self._apply_progress()
+            self._apply_progress(selected_books=selected_books)
         elif action == 'apply_word_count':
-            self._apply_word_count()
+            self._apply_word_count(selected_books=selected_books)
         elif action == 'calculate_word_count':
-            self._calculate_word_count()
+            self._calculate_word_count(selected_books=selected_books)
         elif action in ['clear_all_collections', 'export_collections',
                         'import_collections', 'synchronize_collections']:
-            self._update_collections(action)
+            self._update_collections(action, selected_books=selected_books)
         elif action in ['clear_new_flag', 'clear_reading_list_flag',
                         'clear_read_flag', 'clear_all_flags',
                         'set_new_flag', 'set_reading_list_flag', 'set_read_flag']:
-            self._update_flags(action)
+            self._update_flags(action, selected_books=selected_books)
         elif action in ['export_metadata', 'import_metadata']:
-            self._update_metadata(action)
+            self._update_metadata(action, selected_books=selected_books)
         elif action == 'fetch_annotations':
-            self._fetch_annotations(report_results=True)
+            self._fetch_annotations(report_results=True, selected_books=selected_books)
         elif action == 'generate_deep_view':
-            self._generate_deep_view()
+            self._generate_deep_view(selected_books=selected_books)
         elif action == 'manage_collections':
             self.show_manage_collections_dialog()
         elif action in ['set_locked', 'set_unlocked']:
-            self._update_locked_status(action)
+            self._update_locked_status(action, selected_books=selected_books)
         elif action == 'set_rating':
-            self._set_rating(arg2)
+            self._set_rating(arg2, selected_books=selected_books)
 
         elif action in ['show_deep_view_articles',
                         'show_deep_view_alphabetically', 'show_deep_view_by_importance',
@@ -1163,9 +1514,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         elif action == 'show_metadata':
             self.show_view_metadata_dialog(arg2)
         elif action == 'synchronize_flags':
-            self._synchronize_flags()
+            self._synchronize_flags(selected_books=selected_books)
         else:
-            selected_books = self._selected_books()
             det_msg = ''
             for row in selected_books:
                 det_msg += selected_books[row]['title'] + '\n'
@@ -1189,6 +1539,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             self.VOCABULARY_COL: 'show_vocabulary'
             }
 
+        index = self.proxy.mapToSource(index)
         column = index.column()
         row = index.row()
 
@@ -1203,11 +1554,13 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         elif column == self.DEEP_VIEW_COL:
             # If no DV content, generate DV content, else show it
-            has_dv_content = self._selected_books()[row]['has_dv_content']
-            if has_dv_content:
+            selected_books = self._selected_books()
+            if row not in selected_books:
+                selected_books = self._selected_books(rows=[row])
+            if selected_books[row]['has_dv_content']:
                 self.show_html_dialog(asset_actions[column], row)
             else:
-                self._generate_deep_view()
+                self._generate_deep_view(selected_books=selected_books)
 
         elif column == self.COLLECTIONS_COL:
             self.show_view_collections_dialog(row)
@@ -1219,10 +1572,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                        parent=self.opts.gui, show_copy_button=False).exec_()
 
         elif column == self.LOCKED_COL:
-            self._toggle_locked_status(row)
+            self._toggle_locked_status(row, selected_books=self._selected_books())
 
         elif column == self.WORD_COUNT_COL:
-            self._calculate_word_count()
+            self._calculate_word_count(selected_books=self._selected_books())
 
         else:
             self._log("no double-click handler for %s" % self.LIBRARY_HEADER[column])
@@ -1230,7 +1583,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
     def dispatch_single_click(self, index):
         '''
         '''
-        row = index.row()
+        row = self.proxy.mapToSource(index).row()
         self._log_location(row)
         self._update_refresh_button()
 
@@ -1254,54 +1607,26 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             return QLineEdit.eventFilter(self, source, event)
 
 
-    def setHeaderClickable(self, clickable):
-        if is_qt4:
-            self.tv.horizontalHeader().setClickable(clickable)
-        else:
-            self.tv.horizontalHeader().setSectionsClickable(clickable)
-
     def filter_clear(self):
         '''
         Clear the filter, show all rows
         '''
         self._log_location()
+        self.filter_timer.stop()
         self.filter_le.clear()
-        total_books = len(self.tm.all_rows())
-        for i in range(total_books):
-            self.tv.showRow(i)
-
-        # Restore clickability
-        self.setHeaderClickable(True)
+        self.proxy.set_filter(None)
 
     def filter_table_rows(self, qstr):
         '''
         Hide rows not matching filter
         '''
-        pattern = str(qstr).strip()
+        pattern = unicode(qstr).strip()
         if pattern == '':
             self.filter_clear()
             return
 
         self._log_location(pattern)
-        total_books = len(self.tm.all_rows())
-        for i in range(total_books):
-            matched = False
-            if re.search(pattern, self.tm.get_title(i).text(), re.IGNORECASE):
-                matched = True
-            elif re.search(pattern, self.tm.get_author(i).text(), re.IGNORECASE):
-                matched = True
-            elif re.search(pattern, self.tm.get_series(i).text(), re.IGNORECASE):
-                matched = True
-            elif re.search(pattern, self.tm.get_subjects(i).text(), re.IGNORECASE):
-                matched = True
-
-            if matched:
-                self.tv.showRow(i)
-            else:
-                self.tv.hideRow(i)
-
-        # Prevent sorting on cols, because we'll lose reference to the matched rows
-        self.setHeaderClickable(False)
+        self.proxy.set_filter(pattern)
 
     def initialize(self, parent):
         self.busy = False
@@ -1309,6 +1634,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self.busy_panel = None
         self.ch = None
         self.connected_device = parent.connected_device
+        self.device_rates = parent.device_rates
         self.Dispatcher = partial(Dispatcher, parent=self)
         self.hash_cache = None
         self.icon = get_icon(parent.icon)
@@ -1329,11 +1655,24 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self.updated_match_quality = None
         self.verbose = parent.verbose
 
+        # Local copy of mainDb, shared with the plugin, refreshed on demand
+        self.mainDb = parent.mainDb
+        self.mainDb.refresh_method = self._refresh_marvin_database
+
         # Device-specific cover_hash cache
         device_cached_hashes = "plugins/Marvin_XD_resources/{0}_cover_hashes".format(
             re.sub('\W', '_', self.ios.device_name))
         self.archived_cover_hashes = JSONConfig(device_cached_hashes)
 
+        # Memoized StartXPath parser for annotations
+        self.location_sort = LocationSort(self.MAX_ELEMENT_DEPTH)
+
+        # epub TOCs by content hash, shared across devices
+        self.toc_cache = JSONConfig("plugins/Marvin_XD_resources/epub_tocs")
+
+        # Word counts by content hash, shared across devices
+        self.word_count_cache = WordCountCache(verbose=self.verbose)
+
         # Subscribe to Marvin driver change events
         self.connected_device.marvin_device_signals.reader_app_status_changed.connect(
             self.marvin_status_changed)
@@ -1358,7 +1697,12 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self.filter_le = QLineEdit()
         #self.filter_le.setFrame(False)
         self.filter_le.installEventFilter(self)
-        self.filter_le.textEdited.connect(self.filter_table_rows)
+        # Filter once typing pauses
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(self.prefs.get('filter_delay', 250))
+        self.filter_timer.timeout.connect(lambda: self.filter_table_rows(self.filter_le.text()))
+        self.filter_le.textEdited.connect(lambda qstr: self.filter_timer.start())
         self.filter_le.setPlaceholderText("Filter by Title, Author, Series or Subject")
         self.filter_le.setToolTip("Filter books by Title, Author, Series or Subject")
         self.filter_hb.addWidget(self.filter_le)
@@ -1395,6 +1739,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         # ~~~~~~~~ Create the Table ~~~~~~~~
         self.tv = MyTableView(self)
+        self.proxy = MarkupFilterProxyModel(self)
         self.l.addWidget(self.tv)
 
         self.tabledata = self._construct_table_data()
@@ -1535,10 +1880,12 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
 
         if all_books:
-            rows_to_refresh = list(reversed([i for i in range(len(self.tm.all_rows()))]))
+            selected_books = self._selected_books(
+                rows=list(reversed([i for i in range(self.tm.rowCount(None))])))
         else:
             # Process selected books
-            rows_to_refresh = sorted(self._selected_books())
+            selected_books = self._selected_books()
+        rows_to_refresh = sorted(selected_books)
 
         if rows_to_refresh:
             msg = "Refreshing %s for %s" % (cols_to_refresh,
@@ -1546,20 +1893,14 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 "%d books…" % len(rows_to_refresh))
             self._busy_status_setup(msg=msg, show_cancel=len(rows_to_refresh) > 1)
 
-            for row in rows_to_refresh:
-                if self.busy_cancel_requested:
-                    break
-
-                self.tv.selectRow(row)
-                self._fetch_annotations(update_gui=False)
-                self._apply_date_read(update_gui=False)
-                self._apply_flags(update_gui=False)
-                self._apply_locked(update_gui=False)
-                self._apply_progress(update_gui=False)
-                self._apply_word_count(update_gui=False)
+            # Coalesce mainDb refreshes requested by the individual updates
+            with self.mainDb.batch():
+                # Annotations are fetched for all rows in a single pass
+                self._fetch_annotations(update_gui=False, selected_books=selected_books)
 
-            # _apply_flags, apply_locked may have updated Marvin mainDb
-            self._localize_marvin_database()
+                # Remaining columns are computed and written for all rows together
+                if not self.busy_cancel_requested:
+                    self._refresh_custom_columns_for_rows(selected_books)
 
             updateCalibreGUIView()
             self._busy_status_teardown()
@@ -1618,7 +1959,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
                 selected_books = self._selected_books()
                 for row in sorted(selected_books):
-                    self.tv.selectRow(row)
+                    self._select_row(row)
                     book_id = selected_books[row]['book_id']
                     original_collections = self._get_marvin_collections(book_id)
                     updated_collections = sorted(original_collections + added_collections, key=sort_key)
@@ -1684,7 +2025,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                            content_dict,
                            book_id,
                            self.installed_books[book_id],
-                           self.connected_device.local_db_path)
+                           self.mainDb.path())
             dlg.exec_()
 
         else:
@@ -1713,14 +2054,13 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         refresh = None
 
         if action == 'show_deep_view_articles':
-            if not self.installed_books[book_id].articles:
+            if not self.installed_books[book_id].article_count:
                 return
 
             command_type = "GetDeepViewArticlesHTML"
             self.ch = CommandHandler(self)
             self.ch.construct_general_command(command_type)
-            parameters_tag = self._build_parameters(self.installed_books[book_id], self.ch.command_soup)
-            self.ch.command_soup.command.insert(0, parameters_tag)
+            self._build_parameters(self.installed_books[book_id])
 
             header = None
             group_box_title = 'Deep View articles'
@@ -1737,14 +2077,9 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             command_type = "GetFirstOccurrenceHTML"
             self.ch = CommandHandler(self)
             self.ch.construct_general_command(command_type)
-            parameters_tag = Tag(self.ch.command_soup, 'parameters')
-            self.ch.command_soup.command.insert(0, parameters_tag)
 
             # The bookID we know - entityID and hits we get from the user
-            parameter_tag = Tag(self.ch.command_soup, 'parameter')
-            parameter_tag['name'] = "bookID"
-            parameter_tag.insert(0, str(book_id))
-            parameters_tag.insert(0, parameter_tag)
+            self.ch.add_parameters([('bookID', book_id)])
 
             header = None
             if action == 'show_deep_view_alphabetically':
@@ -1769,7 +2104,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             # Get a list of DV items by querying mainDb
             entities = "Entities_%d" % book_id
             entity_locations = "EntityLocations_%d" % book_id
-            con = sqlite3.connect(self.connected_device.local_db_path)
+            con = self.mainDb.connect()
             with con:
                 con.row_factory = sqlite3.Row
                 dv_names_cur = con.cursor()
@@ -1812,17 +2147,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 dlg.exec_()
 
                 if dlg.result:
-                    # entityID
-                    parameter_tag = Tag(self.ch.command_soup, 'parameter')
-                    parameter_tag['name'] = "entityID"
-                    parameter_tag.insert(0, dlg.result['ID'])
-                    parameters_tag.insert(0, parameter_tag)
-
-                    # hits
-                    parameter_tag = Tag(self.ch.command_soup, 'parameter')
-                    parameter_tag['name'] = "hits"
-                    parameter_tag.insert(0, dlg.result['hits'])
-                    parameters_tag.insert(0, parameter_tag)
+                    self.ch.add_parameters([('entityID', dlg.result['ID']),
+                                            ('hits', dlg.result['hits'])])
 
                     group_box_title = "Deep View hits for %s" % dlg.result['item']
                 else:
@@ -1840,14 +2166,13 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             footer = None
 
         elif action == 'show_vocabulary':
-            if not self.installed_books[book_id].vocabulary:
+            if not self.installed_books[book_id].vocabulary_count:
                 return
 
             command_type = "GetLocalVocabularyHTML"
             self.ch = CommandHandler(self)
             self.ch.construct_general_command(command_type)
-            parameters_tag = self._build_parameters(self.installed_books[book_id], self.ch.command_soup)
-            self.ch.command_soup.command.insert(0, parameters_tag)
+            self._build_parameters(self.installed_books[book_id])
 
             header = None
             group_box_title = 'Vocabulary words'
@@ -1904,7 +2229,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                            content_dict,
                            book_id,
                            self.installed_books[book_id],
-                           self.connected_device.local_db_path
+                           self.mainDb.path()
                            )
             dlg.exec_()
 
@@ -1926,7 +2251,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         current_collections = {}
 
         # Get all Marvin collection names
-        con = sqlite3.connect(self.connected_device.local_db_path)
+        con = self.mainDb.connect()
         with con:
             con.row_factory = sqlite3.Row
 
@@ -2085,7 +2410,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                            cid,
                            self.installed_books[book_id],
                            enable_metadata_updates,
-                           self.connected_device.local_db_path)
+                           self.mainDb.path())
             dlg.exec_()
             if dlg.result() == dlg.Accepted and mismatches:
                 action = dlg.stored_command
@@ -2261,14 +2586,28 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             # Reset connected status in Library window
             self.parent.gui.book_on_device(None, reset=True)
 
-    def _apply_date_read(self, update_gui=True):
+    def _add_manifest_book(self, book_id, **attrs):
+        '''
+        Add a <book> identifying book_id to the manifest of the current command
+        attrs supplements or overrides the identifying attributes
+        '''
+        book = self.installed_books[book_id]
+        book_attrs = {'author': ', '.join(book.authors),
+                      'filename': book.path,
+                      'title': book.title,
+                      'uuid': book.uuid}
+        book_attrs.update(attrs)
+        return self.ch.add_element(self.ch.get_manifest(), 'book', **book_attrs)
+
+    def _apply_date_read(self, update_gui=True, selected_books=None):
         '''
         Fetch the LAST_OPENED date, convert to datetime, apply to custom field
         '''
         lookup = get_cc_mapping('date_read', 'field', None)
         if lookup:
             self._log_location()
-            selected_books = self._selected_books()
+            if selected_books is None:
+                selected_books = self._selected_books()
             updated = False
             for row in selected_books:
                 cid = selected_books[row]['cid']
@@ -2298,7 +2637,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             if updated and update_gui:
                 updateCalibreGUIView()
 
-    def _apply_flags(self, update_gui=True):
+    def _apply_flags(self, update_gui=True, selected_books=None):
         '''
         Synchronize Read and Reading list flags between calibre and connected iDevice
         Compare metadata timestamps to determine master
@@ -2311,7 +2650,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             UPDATE_FIELD = b'MetadataUpdated'
             arg2 = ''
 
-            con = sqlite3.connect(self.connected_device.local_db_path)
+            con = self.mainDb.connect()
             with con:
                 con.row_factory = sqlite3.Row
 
@@ -2344,10 +2683,11 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         read_lookup = get_cc_mapping('read', 'field', None)
         reading_list_lookup = get_cc_mapping('reading_list', 'field', None)
         if read_lookup or reading_list_lookup:
-            selected_books = self._selected_books()
+            if selected_books is None:
+                selected_books = self._selected_books()
             self._log_location(selected_books[selected_books.keys()[0]]['title'])
             for row in selected_books:
-                cid = self._selected_books()[row]['cid']
+                cid = selected_books[row]['cid']
                 if cid is not None and (read_lookup or reading_list_lookup):
                     # Get the metadata object
                     db = self.opts.gui.current_db
@@ -2357,7 +2697,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                     flagbits = self.tm.get_flags(row).sort_key
 
                     # Get the Marvin MetadataUpdated date for this book
-                    book_id = self._selected_books()[row]['book_id']
+                    book_id = selected_books[row]['book_id']
                     c_last_modified = mi.last_modified.astimezone(tz.tzlocal())
                     m_last_modified = _get_marvin_last_modified(book_id)
 
@@ -2376,15 +2716,19 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         if c_last_modified > m_last_modified:
                             self._log("Using calibre as sync master. Read flag: %s" % c_read)
                             if c_read:
-                                self._set_flags('set_read_flag', update_local_db=False)
+                                self._set_flags('set_read_flag', update_local_db=False,
+                                                selected_books=selected_books.subset([row]))
                             else:
-                                self._clear_flags('clear_read_flag', update_local_db=False)
+                                self._clear_flags('clear_read_flag', update_local_db=False,
+                                                  selected_books=selected_books.subset([row]))
                         else:
                             self._log("Using Marvin as sync master. Read flag: %s" % m_read)
                             if m_read:
-                                self._set_flags('set_read_flag', update_local_db=False)
+                                self._set_flags('set_read_flag', update_local_db=False,
+                                                selected_books=selected_books.subset([row]))
                             else:
-                                self._clear_flags('clear_read_flag', update_local_db=False)
+                                self._clear_flags('clear_read_flag', update_local_db=False,
+                                                  selected_books=selected_books.subset([row]))
                     else:
                         if not read_lookup:
                             self._log("Read flag: No custom column mapped for Read flag")
@@ -2408,15 +2752,19 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         if c_last_modified > m_last_modified:
                             self._log("Using calibre as sync master. Reading list flag: %s" % c_reading_list)
                             if c_reading_list:
-                                self._set_flags('set_reading_list_flag', update_local_db=False)
+                                self._set_flags('set_reading_list_flag', update_local_db=False,
+                                                selected_books=selected_books.subset([row]))
                             else:
-                                self._clear_flags('clear_reading_list_flag', update_local_db=False)
+                                self._clear_flags('clear_reading_list_flag', update_local_db=False,
+                                                  selected_books=selected_books.subset([row]))
                         else:
                             self._log("Using Marvin as sync master. Reading list flag: %s" % m_reading_list)
                             if m_reading_list:
-                                self._set_flags('set_reading_list_flag', update_local_db=False)
+                                self._set_flags('set_reading_list_flag', update_local_db=False,
+                                                selected_books=selected_books.subset([row]))
                             else:
-                                self._clear_flags('clear_reading_list_flag', update_local_db=False)
+                                self._clear_flags('clear_reading_list_flag', update_local_db=False,
+                                                  selected_books=selected_books.subset([row]))
                     else:
                         if not reading_list_lookup:
                             self._log("Reading list flag: No custom column mapped for Reading list flag")
@@ -2428,7 +2776,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             if update_gui:
                 updateCalibreGUIView()
 
-    def _apply_locked(self, update_gui=True, update_local_db=True):
+    def _apply_locked(self, update_gui=True, update_local_db=True, selected_books=None):
         '''
         If cc exists for Locked, examine both calibre and Marvin.
         If locked in either location, set both to locked
@@ -2442,10 +2790,9 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             command_type = "LockBooks"
             self.ch = CommandHandler(self)
             self.ch.construct_general_command(command_type)
-            manifest_tag = Tag(self.ch.command_soup, 'manifest')
-            self.ch.command_soup.command.insert(0, manifest_tag)
 
-            selected_books = self._selected_books()
+            if selected_books is None:
+                selected_books = self._selected_books()
             c_updated = False
             m_updated = False
             for row in selected_books:
@@ -2480,12 +2827,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                             self.installed_books[book_id].pin = new_pin_value
 
                             # Add the book to the manifest
-                            book_tag = Tag(self.ch.command_soup, 'book')
-                            book_tag['author'] = escape(', '.join(self.installed_books[book_id].authors))
-                            book_tag['filename'] = self.installed_books[book_id].path
-                            book_tag['title'] = self.installed_books[book_id].title
-                            book_tag['uuid'] = self.installed_books[book_id].uuid
-                            manifest_tag.insert(0, book_tag)
+                            self._add_manifest_book(book_id)
                             m_updated = True
 
                         elif m_locked:
@@ -2514,7 +2856,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 if update_local_db:
                     self._localize_marvin_database()
 
-    def _apply_progress(self, update_gui=True):
+    def _apply_progress(self, update_gui=True, selected_books=None):
         '''
         Fetch Progress, apply to custom field
         Need to assert force_changes for db to allow custom field to be set to None.
@@ -2522,7 +2864,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         lookup = get_cc_mapping('progress', 'field', None)
         if lookup:
             self._log_location()
-            selected_books = self._selected_books()
+            if selected_books is None:
+                selected_books = self._selected_books()
             for row in selected_books:
                 cid = selected_books[row]['cid']
                 if cid is not None:
@@ -2542,14 +2885,15 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             if update_gui:
                 updateCalibreGUIView()
 
-    def _apply_word_count(self, update_gui=True):
+    def _apply_word_count(self, update_gui=True, selected_books=None):
         '''
         Fetch Progress, apply to custom field
         '''
         lookup = get_cc_mapping('word_count', 'field', None)
         if lookup:
             self._log_location()
-            selected_books = self._selected_books()
+            if selected_books is None:
+                selected_books = self._selected_books()
             updated = False
             for row in selected_books:
                 cid = selected_books[row]['cid']
@@ -2570,7 +2914,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             if updated and update_gui:
                 updateCalibreGUIView()
 
-    def _build_metadata_update(self, book_id, cid, book, mismatches, update_soup):
+    def _build_metadata_update(self, book_id, cid, book, mismatches):
         '''
         Build a metadata update command file for Marvin
         '''
@@ -2595,32 +2939,44 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         target_epub = self.installed_books[book_id].path
 
         # Populate the update_metadata command file
-        command_element = "updatemetadata"
-        root = update_soup.find(command_element)
-        root['cleanupcollections'] = 'yes'
-
-        book_tag = Tag(update_soup, 'book')
-        book_tag['author'] = escape(', '.join(book.authors))
-        book_tag['authorsort'] = escape(book.author_sort)
-        book_tag['filename'] = target_epub
+        self.ch.command_root.set('cleanupcollections', 'yes')
 
         naive = book.pubdate.replace(hour=0, minute=0, second=0, tzinfo=None)
-        book_tag['pubdate'] = _strftime('%Y-%m-%d', naive)
-        book_tag['publisher'] = ''
-        if book.publisher is not None:
-            book_tag['publisher'] = escape(book.publisher)
-        book_tag['rating'] = 0
-        if book.rating is not None:
-            book_tag['rating'] = book.rating/2
-        book_tag['series'] = ''
-        if book.series:
-            book_tag['series'] = escape(book.series)
-        book_tag['seriesindex'] = ''
-        if book.series_index:
-            book_tag['seriesindex'] = book.series_index
-        book_tag['title'] = escape(book.title)
-        book_tag['titlesort'] = escape(book.title_sort)
-        book_tag['uuid'] = book.uuid
+        book_el = self._add_manifest_book(book_id,
+            author=', '.join(book.authors),
+            authorsort=book.author_sort,
+            filename=target_epub,
+            pubdate=_strftime('%Y-%m-%d', naive),
+            publisher=book.publisher or '',
+            rating=book.rating/2 if book.rating is not None else 0,
+            series=book.series or '',
+            seriesindex=book.series_index or '',
+            title=book.title,
+            titlesort=book.title_sort,
+            uuid=book.uuid)
+
+        # Add the description
+        if book.comments:
+            self.ch.add_element(book_el, 'description', text=book.comments)
+
+        # ~~~~~~ Collections + Flags ~~~~~~
+        ccas = self._get_calibre_collections(cid)
+        if ccas is None:
+            ccas = []
+        flags = self.installed_books[book_id].flags
+        collection_assignments = sorted(flags + ccas, key=sort_key)
+
+        # Update the driver cache
+        cached_books[target_epub]['device_collections'] = collection_assignments
+
+        collections_el = self.ch.add_element(book_el, 'collections')
+        for tag in collection_assignments:
+            self.ch.add_element(collections_el, 'collection', text=tag)
+
+        # ~~~~~~ Subjects ~~~~~~
+        subjects_el = self.ch.add_element(book_el, 'subjects')
+        for tag in sorted(book.tags):
+            self.ch.add_element(subjects_el, 'subject', text=tag)
 
         # Cover
         if 'cover_hash' in mismatches:
@@ -2630,12 +2986,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                                   desired_thumbnail_height,
                                   desired_thumbnail_height)
                 cover_hash = hashlib.md5(cover[2]).hexdigest()
-
-                cover_tag = Tag(update_soup, 'cover')
-                cover_tag['hash'] = cover_hash
-                cover_tag['encoding'] = 'base64'
-                cover_tag.insert(0, base64.b64encode(cover[2]))
-                book_tag.insert(0, cover_tag)
+                self.ch.add_element(book_el, 'cover', text=base64.b64encode(cover[2]),
+                                    encoding='base64', hash=cover_hash)
             except:
                 self._log("error calculating cover_hash for %s (cid %d)" % (book.title, cid))
                 import traceback
@@ -2643,68 +2995,16 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         else:
             self._log(" '%s': cover is up to date" % book.title)
 
-        # ~~~~~~ Subjects ~~~~~~
-        subjects_tag = Tag(update_soup, 'subjects')
-        for tag in sorted(book.tags, reverse=True):
-            subject_tag = Tag(update_soup, 'subject')
-            subject_tag.insert(0, escape(tag))
-            subjects_tag.insert(0, subject_tag)
-        book_tag.insert(0, subjects_tag)
+        return book_el
 
-        # ~~~~~~ Collections + Flags ~~~~~~
-        ccas = self._get_calibre_collections(cid)
-        if ccas is None:
-            ccas = []
-        flags = self.installed_books[book_id].flags
-        collection_assignments = sorted(flags + ccas, key=sort_key)
-
-        # Update the driver cache
-        cached_books[target_epub]['device_collections'] = collection_assignments
-
-        collections_tag = Tag(update_soup, 'collections')
-        if collection_assignments:
-            for tag in collection_assignments:
-                c_tag = Tag(update_soup, 'collection')
-                c_tag.insert(0, escape(tag))
-                collections_tag.insert(0, c_tag)
-        book_tag.insert(0, collections_tag)
-
-        # Add the description
-        try:
-            description_tag = Tag(update_soup, 'description')
-            description_tag.insert(0, escape(book.comments))
-            book_tag.insert(0, description_tag)
-        except:
-            pass
-
-        update_soup.manifest.insert(0, book_tag)
-
-        return update_soup
-
-    def _build_parameters(self, book, update_soup):
-        parameters_tag = Tag(update_soup, 'parameters')
-
-        parameter_tag = Tag(update_soup, 'parameter')
-        parameter_tag['name'] = "filename"
-        parameter_tag.insert(0, book.path)
-        parameters_tag.insert(0, parameter_tag)
-
-        parameter_tag = Tag(update_soup, 'parameter')
-        parameter_tag['name'] = "uuid"
-        parameter_tag.insert(0, book.uuid)
-        parameters_tag.insert(0, parameter_tag)
-
-        parameter_tag = Tag(update_soup, 'parameter')
-        parameter_tag['name'] = "author"
-        parameter_tag.insert(0, escape(', '.join(book.authors)))
-        parameters_tag.insert(0, parameter_tag)
-
-        parameter_tag = Tag(update_soup, 'parameter')
-        parameter_tag['name'] = "title"
-        parameter_tag.insert(0, book.title)
-        parameters_tag.insert(0, parameter_tag)
-
-        return parameters_tag
+    def _build_parameters(self, book):
+        '''
+        Add the parameters identifying book to a general command
+        '''
+        return self.ch.add_parameters([('title', book.title),
+                                       ('author', ', '.join(book.authors)),
+                                       ('uuid', book.uuid),
+                                       ('filename', book.path)])
 
     def _busy_panel_setup(self, title, on_top=False, show_cancel=False):
         '''
@@ -2775,32 +3075,25 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self.tv.setEnabled(True)
         self.busy = False
 
-    def _calculate_word_count(self, silent=False):
+    def _calculate_word_count(self, silent=False, selected_books=None):
         '''
         Calculate word count for each selected book
         selected_books: {row: {'book_id':, 'cid':, 'path':, 'title':}...}
         return stats {book_id: word_count}
         silent switch used when another method needs word count (Generate DV)
-        Wait until completion to update local_db
+        Counts are looked up by content hash in WordCountCache first. Books
+        also in the library are counted from the library copy, others are
+        fetched into memory, all counted by WordCountPool while the next book
+        transfers. Marvin is informed with a single command.
         '''
-        def _extract_body_text(data):
-            '''
-            Get the body text of this html content with any html tags stripped
-            '''
-            RE_HTML_BODY = re.compile(u'<body[^>]*>(.*)</body>', re.UNICODE | re.DOTALL | re.IGNORECASE)
-            RE_STRIP_MARKUP = re.compile(u'<[^>]+>', re.UNICODE)
-
-            body = RE_HTML_BODY.findall(data)
-            if body:
-                return RE_STRIP_MARKUP.sub('', body[0]).replace('.', '. ')
-            return ''
-
         self._log_location()
 
+        command_name = 'update_metadata_items'
         stats = {}
-        db_update = False
+        word_counts = []
 
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
         if selected_books:
             if not silent:
                 msg = "Calculating word count"
@@ -2810,99 +3103,98 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             # Save the selection region for restoration
             self.saved_selection_region = self.tv.visualRegionForSelection(self.tv.selectionModel().selection())
 
-            for i, row in enumerate(sorted(selected_books.keys())):
-                if self.busy_cancel_requested:
-                    break
-
-                # Do we already know the word count?
-                cwc = self.tm.get_word_count(row).sort_key
-                if cwc:
-                    stats[selected_books[row]['book_id']] = cwc
-                    continue
-
-                db_update = True
-
-                # Highlight book we're working on
-                self.tv.selectRow(row)
+            cached = []
+            counted_hashes = {}
+            new_word_counts = {}
+            pool = WordCountPool(len(selected_books), verbose=self.verbose)
+            try:
+                for i, row in enumerate(sorted(selected_books.keys())):
+                    if self.busy_cancel_requested:
+                        break
 
-                if not silent:
-                    if total_books > 1:
-                        msg = "Calculating word count: {0} of {1}".format(i+1, total_books)
-                    else:
-                        msg = "Calculating word count"
-                    self._busy_status_msg(msg=msg)
+                    # Do we already know the word count?
+                    cwc = self.tm.get_word_count(row).sort_key
+                    if cwc:
+                        stats[selected_books[row]['book_id']] = cwc
+                        continue
 
-                # Copy the remote epub to local storage
-                path = selected_books[row]['path']
-                rbp = '/'.join(['/Documents', path])
-                lbp = os.path.join(self.local_cache_folder, path)
-
-                with open(lbp, 'wb') as out:
-                    self.ios.copy_from_idevice(str(rbp), out)
-
-                # Open the file
-                iterator = EbookIterator(lbp)
-                iterator.__enter__(only_input_plugin=True, run_char_count=True,
-                                   read_anchor_map=False)
-                book_files = []
-                strip_html = True
-                for path in iterator.spine:
-                    with open(path, 'rb') as f:
-                        html = f.read().decode('utf-8', 'replace')
-                        if strip_html:
-                            html = unicode(_extract_body_text(html)).strip()
-                            #print('FOUND HTML:', html)
-                    book_files.append(html)
-                book_text = ''.join(book_files)
-
-                wordcount = get_wordcount_obj(book_text)
-
-                self._log("{0}: {1:,} words".format(
-                    selected_books[row]['title'], wordcount.words))
-                stats[selected_books[row]['book_id']] = wordcount.words
-
-                # Delete the local copy
-                os.remove(lbp)
+                    # Have we counted this content before?
+                    book_hash = self.installed_books[selected_books[row]['book_id']].hash
+                    words = self.word_count_cache.get(book_hash)
+                    if words is not None:
+                        cached.append((row, words))
+                        continue
 
-                # Update the model
-                wc = locale.format("%d", wordcount.words, grouping=True)
-                if wc > "0":
-                    word_count_item = SortableTableWidgetItem(
-                        "{0} ".format(wc),
-                        wordcount.words)
-                else:
-                    word_count_item = SortableTableWidgetItem('', 0)
-                self.tm.set_word_count(row, word_count_item)
+                    # Highlight book we're working on
+                    self._select_row(row)
 
-                # Update self.installed_books
-                book_id = selected_books[row]['book_id']
-                self.installed_books[book_id].word_count = wc
+                    if not silent:
+                        if total_books > 1:
+                            msg = "Calculating word count: {0} of {1}".format(i+1, total_books)
+                        else:
+                            msg = "Calculating word count"
+                        self._busy_status_msg(msg=msg)
+
+                    # Count the library copy if we have one, else fetch the remote epub
+                    data = self._get_library_epub(book_hash)
+                    if data is None:
+                        rbp = '/'.join(['/Documents', selected_books[row]['path']])
+                        out = cStringIO.StringIO()
+                        self.ios.copy_from_idevice(str(rbp), out)
+                        data = out.getvalue()
+                        out.close()
+                    pool.submit(row, data)
+                    counted_hashes[row] = book_hash
+
+                for row, words in cached + list(pool.results()):
+                    if words is None:
+                        continue
 
-                # Tell Marvin about the updated word_count
+                    self._log("{0}: {1:,} words".format(
+                        selected_books[row]['title'], words))
+                    book_id = selected_books[row]['book_id']
+                    stats[book_id] = words
+
+                    # Update the model
+                    wc = locale.format("%d", words, grouping=True)
+                    if wc > "0":
+                        word_count_item = SortableTableWidgetItem(
+                            "{0} ".format(wc),
+                            words)
+                    else:
+                        word_count_item = SortableTableWidgetItem('', 0)
+                    self.tm.set_word_count(row, word_count_item)
+
+                    # Update self.installed_books
+                    self.installed_books[book_id].word_count = wc
+                    word_counts.append((words, book_id))
+
+                    if row in counted_hashes:
+                        new_word_counts[counted_hashes[row]] = words
+            finally:
+                pool.close()
+                if new_word_counts:
+                    self.word_count_cache.update(new_word_counts)
+
+            if word_counts:
+                # Tell Marvin about the updated word counts
                 self.ch = CommandHandler(self)
                 self.ch.construct_metadata_command(
                     cmd_name='update_metadata_items', cmd_element='updatemetadataitems')
-
-                book_tag = Tag(self.ch.command_soup, 'book')
-                book_tag['author'] = escape(', '.join(self.installed_books[book_id].authors))
-                book_tag['filename'] = self.installed_books[book_id].path
-                book_tag['title'] = self.installed_books[book_id].title
-                book_tag['uuid'] = self.installed_books[book_id].uuid
-
-                book_tag['wordcount'] = wordcount.words
-                self.ch.command_soup.manifest.insert(0, book_tag)
+                for words, book_id in word_counts:
+                    self._add_manifest_book(book_id, wordcount=words)
 
                 self.ch.issue_command()
                 if self.ch.results['code']:
                     if not silent:
-                        #pb.hide()
                         self._busy_status_teardown()
                     self._show_command_error(command_name, self.ch.results)
                     return stats
 
-            # Update local_db for all changes
-            if db_update:
-                self._localize_marvin_database()
+                # Mirror the word counts in the local copy of mainDb
+                self.mainDb.apply_local_update(
+                    '''UPDATE Books SET WordCount = ? WHERE ID = ?''',
+                    word_counts, many=True)
 
             if not silent:
                 self._busy_status_teardown()
@@ -2924,7 +3216,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         #self._log(stats)
         return stats
 
-    def _clear_flags(self, action, update_local_db=True):
+    def _clear_flags(self, action, update_local_db=True, selected_books=None):
         '''
         Clear specified flags for selected books
         sort_key is the bitfield representing current flag settings
@@ -2970,9 +3262,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         # Save the currently selected rows
         self.saved_selection_region = self.tv.visualRegionForSelection(self.tv.selectionModel().selection())
 
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
         for row in selected_books:
-            self.tv.selectRow(row)
+            self._select_row(row)
             book_id = selected_books[row]['book_id']
             flagbits = self.tm.get_flags(row).sort_key
 
@@ -3111,16 +3404,13 @@ class BookStatusDialog(SizePersistedDialog, Logger):
     def _construct_table_data(self):
         '''
         Populate the table data from self.installed_books
+        Cells in LAZY_COLUMNS are left empty, the model builds them for the rows
+        the view displays through _generate_table_cell()
         '''
         def _generate_articles(book_data):
             '''
             '''
-            article_count = 0
-            if 'Wiki' in book_data.articles:
-                article_count += len(book_data.articles['Wiki'])
-            if 'Pinned' in book_data.articles:
-                article_count += len(book_data.articles['Pinned'])
-
+            article_count = book_data.article_count
             if article_count:
                 articles = SortableTableWidgetItem(
                     "{0}".format(article_count),
@@ -3347,10 +3637,11 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             return title
 
         def _generate_vocabulary(book_data):
-            if len(book_data.vocabulary):
+            vocabulary_count = book_data.vocabulary_count
+            if vocabulary_count:
                 vocabulary = SortableTableWidgetItem(
-                    "{0}".format(len(book_data.vocabulary)),
-                    len(book_data.vocabulary))
+                    "{0}".format(vocabulary_count),
+                    vocabulary_count)
             else:
                 vocabulary = SortableTableWidgetItem('', 0)
             return vocabulary
@@ -3368,53 +3659,39 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         self._log_location()
 
+        self.cell_generators = {
+            self.ANNOTATIONS_COL: _generate_highlights,
+            self.ARTICLES_COL: _generate_articles,
+            self.AUTHOR_COL: _generate_author,
+            self.COLLECTIONS_COL: self._generate_collection_match,
+            self.DATE_ADDED_COL: _generate_date_added,
+            self.FLAGS_COL: _generate_flags_profile,
+            self.LAST_OPENED_COL: _generate_last_opened,
+            self.LOCKED_COL: _generate_locked_status,
+            self.PROGRESS_COL: self._generate_reading_progress,
+            self.RATING_COL: _generate_rating,
+            self.SERIES_COL: _generate_series,
+            self.SUBJECTS_COL: _generate_subjects,
+            self.TITLE_COL: _generate_title,
+            self.VOCABULARY_COL: _generate_vocabulary,
+            self.WORD_COUNT_COL: _generate_word_count,
+            }
+
         tabledata = []
 
         for book in self.installed_books:
             book_data = self.installed_books[book]
-            articles = _generate_articles(book_data)
-            author = _generate_author(book_data)
-            collection_match = self._generate_collection_match(book_data)
-            date_added = _generate_date_added(book_data)
-            flags = _generate_flags_profile(book_data)
-            highlights = _generate_highlights(book_data)
-            last_opened = _generate_last_opened(book_data)
-            locked = _generate_locked_status(book_data)
             book_data.match_quality = _generate_match_quality(book_data)
-            progress = self._generate_reading_progress(book_data)
-            rating = _generate_rating(book_data)
-            title = _generate_title(book_data)
-            series = _generate_series(book_data)
-            subjects = _generate_subjects(book_data)
-            vocabulary = _generate_vocabulary(book_data)
-            word_count = _generate_word_count(book_data)
 
             # List order matches self.LIBRARY_HEADER
-            this_book = [
-                title,
-                author,
-                series,
-                rating,
-                word_count,
-                date_added,
-                progress,
-                last_opened,
-                subjects,
-                collection_match,
-                locked,
-                flags,
-                highlights,
-                vocabulary,
-                self.CHECKMARK if book_data.deep_view_prepared else '',
-                articles,
-                book_data.match_quality,
-                book_data.uuid,
-                book_data.cid,
-                book_data.mid,
-                book_data.path
-                ]
+            this_book = [None] * len(self.LIBRARY_HEADER)
+            this_book[self.DEEP_VIEW_COL] = self.CHECKMARK if book_data.deep_view_prepared else ''
+            this_book[self.MATCHED_COL] = book_data.match_quality
+            this_book[self.UUID_COL] = book_data.uuid
+            this_book[self.CALIBRE_ID_COL] = book_data.cid
+            this_book[self.BOOK_ID_COL] = book_data.mid
+            this_book[self.PATH_COL] = book_data.path
             tabledata.append(this_book)
-            Application.processEvents()
 
         return tabledata
 
@@ -3423,8 +3700,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         self._log_location()
         self.tm = MarkupTableModel(self, centered_columns=self.CENTERED_COLUMNS,
-                                   right_aligned_columns=self.RIGHT_ALIGNED_COLUMNS)
-        self.tv.setModel(self.tm)
+                                   right_aligned_columns=self.RIGHT_ALIGNED_COLUMNS,
+                                   cell_factory=self._generate_table_cell)
+        self.proxy.setSourceModel(self.tm)
+        self.tv.setModel(self.proxy)
         self.tv.setShowGrid(False)
         if self.parent.prefs.get('use_monospace_font', False):
             if isosx:
@@ -3440,9 +3719,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         # Set row height
         fm = QFontMetrics(FONT)
-        nrows = len(self.tabledata)
-        for row in xrange(nrows):
-            self.tv.setRowHeight(row, fm.height() + 4)
+        self.tv.verticalHeader().setDefaultSectionSize(fm.height() + 4)
 
         self.tvSelectionModel = self.tv.selectionModel()
         self.tv.setAlternatingRowColors(not self.show_match_colors)
@@ -3537,7 +3814,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self._log_location()
 
         btd = self._selected_books()
-        books_to_delete = sorted([btd[b]['title'] for b in btd], key=sort_key)
+        books_to_delete = sorted(btd.column('title'), key=sort_key)
 
         self.saved_selection_region = None
         self.updated_match_quality = {}
@@ -3554,7 +3831,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                            parent=self.opts.gui, show_copy_button=False)
             if d.exec_():
                 model = self.parent.gui.memory_view.model()
-                paths_to_delete = [btd[b]['path'] for b in btd]
+                paths_to_delete = list(btd.column('path'))
                 self._log("paths_to_delete: %s" % paths_to_delete)
                 sorted_map = model.sorted_map
                 delete_map = {}
@@ -3565,11 +3842,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         continue
 
                 # Delete the rows in MM spreadsheet
-                rows_to_delete = self._selected_rows()
-                for row in sorted(rows_to_delete, reverse=True):
-                    self.tm.beginRemoveRows(QModelIndex(), row, row)
-                    del self.tm.arraydata[row]
-                    self.tm.endRemoveRows()
+                self.tm.remove_rows(self._selected_rows())
 
                 # Delete the books on Device
                 if self.prefs.get('execute_marvin_commands', True):
@@ -3607,7 +3880,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                     self._log("~~~ execute_marvin_commands disabled in JSON ~~~")
 
                 # Remove from self.installed_books
-                book_ids_to_delete = [btd[b]['book_id'] for b in btd]
+                book_ids_to_delete = list(btd.column('book_id'))
                 for book_id in book_ids_to_delete:
                     deleted = self.installed_books.pop(book_id)
                     if False:
@@ -3660,47 +3933,52 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 title = title[0:30] + '…'
             self._log("{0:<32} {1:<32} {2}".format(hash, title[0:31], library_hash_map[hash]))
 
-    def _fetch_annotations(self, update_gui=True, report_results=False):
+    def _fetch_annotations(self, update_gui=True, report_results=False, selected_books=None):
         '''
-        Retrieve formatted annotations
+        Retrieve formatted annotations for selected books
+        Annotations for all books are formatted together, then written to
+        the custom column with a single library update
         '''
         lookup = get_cc_mapping('annotations', 'field', None)
         if lookup:
             self._log_location()
-            updated = 0
-            for row, book in self._selected_books().items():
+            to_fetch = {}
+            if selected_books is None:
+                selected_books = self._selected_books()
+            for row, book in selected_books.items():
                 cid = book['cid']
                 if cid is not None:
                     if book['has_annotations']:
                         self._log("%s (row %d): %d annotations" %
                                   (repr(book['title']), row, self.tm.get_annotations(row).sort_key))
-                        book_id = book['book_id']
-                        new_annotations = self._get_formatted_annotations(book_id)
-
-                        # Apply to custom column
-                        # Get the current value from the lookup field
-                        db = self.opts.gui.current_db
-                        mi = db.get_metadata(cid, index_is_id=True)
-                        um = mi.metadata_for_field(lookup)
-                        old_annotations = mi.get_user_metadata(lookup, False)['#value#']
-                        if old_annotations is None:
-                            self._log("adding new_annotations")
-                            um['#value#'] = new_annotations
-                        else:
-                            self._log("merging old_annotations and new_annotations")
-                            old_soup = BeautifulSoup(old_annotations)
-                            new_soup = BeautifulSoup(new_annotations)
-                            merged_soup = merge_annotations(self, cid, old_soup, new_soup)
-                            um['#value#'] = unicode(merged_soup)
-                        mi.set_user_metadata(lookup, um)
-                        db.set_metadata(cid, mi, set_title=False, set_authors=False,
-                                        commit=True)
-                        updated += 1
+                        to_fetch[book['book_id']] = cid
                     else:
                         self._log("%s has no annotations" % repr(book['title']))
                 else:
                     self._log("%s does not exist in calibre library" % repr(book['title']))
 
+            updated = 0
+            if to_fetch:
+                formatted = self._get_formatted_annotations_for_books(sorted(to_fetch))
+
+                # Merge with the current values of the lookup field
+                old_values = self._get_calibre_field(lookup, to_fetch.values())
+                new_values = {}
+                for book_id, cid in to_fetch.items():
+                    new_annotations = formatted[book_id]
+                    old_annotations = old_values.get(cid)
+                    if old_annotations is None:
+                        self._log("adding new_annotations")
+                        new_values[cid] = new_annotations
+                    else:
+                        self._log("merging old_annotations and new_annotations")
+                        new_values[cid] = merge_annotation_html(
+                            self, cid, old_annotations, new_annotations)
+
+                # Apply to custom column
+                self._set_calibre_field(lookup, new_values)
+                updated = len(new_values)
+
             if update_gui and updated:
                 updateCalibreGUIView()
 
@@ -3711,6 +3989,68 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 MessageBox(MessageBox.INFO, title, msg, det_msg='',
                            parent=self.opts.gui, show_copy_button=False).exec_()
 
+    def _fetch_book_detail(self, book_id, key):
+        '''
+        Book loader: fetch a lazy field of installed_books[book_id] from mainDb
+        '''
+        ans = {'articles': {}, 'comments': None, 'vocabulary': []}[key]
+        try:
+            con = self.mainDb.connect()
+            with con:
+                con.row_factory = sqlite3.Row
+                cur = con.cursor()
+
+                if key == 'articles':
+                    # Get PinnedArticles
+                    cur.execute('''SELECT
+                                    BookID,
+                                    Title,
+                                    URL
+                                   FROM PinnedArticles
+                                   WHERE BookID = '{0}'
+                                '''.format(book_id))
+                    pinned_article_rows = cur.fetchall()
+                    if len(pinned_article_rows):
+                        ans['Pinned'] = dict((row[b'Title'], row[b'URL'])
+                                             for row in pinned_article_rows)
+
+                    # Get Wiki snippets
+                    cur.execute('''SELECT
+                                    BookID,
+                                    Title,
+                                    Snippet
+                                   FROM Wiki
+                                   WHERE BookID = '{0}'
+                                '''.format(book_id))
+                    wiki_rows = cur.fetchall()
+                    if len(wiki_rows):
+                        ans['Wiki'] = dict((row[b'Title'], row[b'Snippet'])
+                                           for row in wiki_rows)
+
+                elif key == 'comments':
+                    cur.execute('''SELECT
+                                    Description
+                                   FROM Books
+                                   WHERE ID = '{0}'
+                                '''.format(book_id))
+                    row = cur.fetchone()
+                    if row is not None:
+                        ans = row[b'Description']
+
+                elif key == 'vocabulary':
+                    cur.execute('''SELECT
+                                    BookID,
+                                    Word
+                                   FROM Vocabulary
+                                   WHERE BookID = '{0}'
+                                '''.format(book_id))
+                    ans = sorted([row[b'Word'] for row in cur.fetchall()], key=sort_key)
+        except:
+            import traceback
+            self._log_location("{0} {1}".format(book_id, key))
+            self._log(traceback.format_exc())
+        return ans
+
     def _fetch_deep_view_status(self, book_ids):
         '''
         Get current status for book_ids
@@ -3718,7 +4058,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self._log_location(book_ids)
 
         dvp_status = {}
-        con = sqlite3.connect(self.connected_device.local_db_path)
+        con = self.mainDb.connect()
         with con:
             con.row_factory = sqlite3.Row
             # Get all the books
@@ -3781,7 +4121,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         cover_bytes = None
         self._log_location("fetching large cover from cache")
-        con = sqlite3.connect(self.connected_device.local_db_path)
+        con = self.mainDb.connect()
         with con:
             con.row_factory = sqlite3.Row
 
@@ -3807,25 +4147,19 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         Given a book_id, find its row in the displayed model
         '''
-        for row, item in enumerate(self.tm.arraydata):
-            #if self.tm.get_book_id(row) == book_id:
-            if item[self.BOOK_ID_COL] == book_id:
-                self._log("found %s at row %d" % (book_id, row))
-                break
-        else:
-            row = None
+        row = self.tm.row_for_book_id(book_id)
+        if row is not None:
+            self._log("found %s at row %d" % (book_id, row))
         return row
 
     def _find_cid_in_model(self, cid):
         '''
         Given a cid, return its book_id
         '''
-        book_id = None
-        for book in self.tm.arraydata:
-            if book[self.CALIBRE_ID_COL] == cid:
-                book_id = book[self.BOOK_ID_COL]
-                break
-        return book_id
+        row = self.tm.row_for_cid(cid)
+        if row is None:
+            return None
+        return self.tm.get_book_id(row)
 
     def _find_fuzzy_matches(self, library_scanner, installed_books):
         '''
@@ -3870,6 +4204,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         if self.updated_match_quality:
             self._log_location(sorted(self.updated_match_quality.keys()))
+            if getattr(self, 'flasher', None) is not None:
+                self.flasher.stop()
             self.flasher = RowFlasher(self, self.tm, self.updated_match_quality)
 #            self.connect(self.flasher, self.flasher.signal, self._flasher_complete)
             self.flasher.signal.connect(self._flasher_complete)
@@ -3879,6 +4215,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         '''
         self._log_location()
+        self.flasher = None
         if self.saved_selection_region:
             for rect in self.saved_selection_region.rects():
                 self.tv.setSelection(rect, QItemSelectionModel.Select)
@@ -3948,21 +4285,21 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                                                    sort_value)
         return collection_match
 
-    def _generate_deep_view(self, update_local_db=True):
+    def _generate_deep_view(self, update_local_db=True, selected_books=None):
         '''
         '''
-        #WORST_CASE_CONVERSION_RATE = 2800   # WPM iPad1
-        WORST_CASE_CONVERSION_RATE = 2350   # GwR empirical including updates
-        #BEST_CASE_CONVERSION_RATE = 6500    # WPM iPad4, iPhone5
+        # Empirical default 2350 WPM, measured per device after each run
+        WORST_CASE_CONVERSION_RATE = self.device_rates.get('conversion_rate')
         TIMEOUT_PADDING_FACTOR = 0.50
 
         self._log_location()
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
         if selected_books:
 
             # Estimate worst-case time required to generate DV, covering word count calculations
             self._busy_status_setup(msg="Estimating time…")
-            word_counts = self._calculate_word_count(silent=True)
+            word_counts = self._calculate_word_count(silent=True, selected_books=selected_books)
             self._busy_status_teardown()
 
             twc = sum(word_counts.itervalues())
@@ -4011,16 +4348,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             self.ch.construct_general_command(command_type)
 
             # Build a manifest of selected books
-            manifest_tag = Tag(self.ch.command_soup, 'manifest')
-            for row in sorted(selected_books.keys(), reverse=True):
-                book_id = selected_books[row]['book_id']
-                book_tag = Tag(self.ch.command_soup, 'book')
-                book_tag['author'] = escape(', '.join(self.installed_books[book_id].authors))
-                book_tag['filename'] = self.installed_books[book_id].path
-                book_tag['title'] = self.installed_books[book_id].title
-                book_tag['uuid'] = self.installed_books[book_id].uuid
-                manifest_tag.insert(0, book_tag)
-            self.ch.command_soup.command.insert(0, manifest_tag)
+            for row in sorted(selected_books.keys()):
+                self._add_manifest_book(selected_books[row]['book_id'])
 
             busy_msg = ("Generating Deep View for %s" %
                 ("1 book…" if len(selected_books) == 1 else
@@ -4029,6 +4358,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             self._busy_status_setup(msg=busy_msg, show_cancel=len(selected_books) > 1,
                 marvin_cancellation_required=True)
             self.marvin_cancellation_required = True
+            start_time = time.time()
             self.ch.issue_command(timeout_override=timeout)
 
             self._busy_status_teardown()
@@ -4036,12 +4366,14 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             if self.ch.results['code']:
                 return self._show_command_error(command_type, self.ch.results)
 
+            self.device_rates.record('conversion_rate', twc / (time.time() - start_time))
+
             # Update the local db
             if update_local_db:
                 self._localize_marvin_database()
 
             # Get the latest DeepViewPrepared status for selected books
-            book_ids = [selected_books[row]['book_id'] for row in selected_books.keys()]
+            book_ids = list(selected_books.column('book_id'))
             dpv_status = self._fetch_deep_view_status(book_ids)
 
             # Update visible model, self.installed_books
@@ -4052,21 +4384,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 self.tm.set_deep_view(row, updated)
 
     def _generate_interior_location_sort(self, xpath):
-        try:
-            match = re.match(r'\/x:html\[1\]\/x:body\[1\]\/x:div\[1\]\/x:div\[1\]\/x:(.*)\/text.*$', xpath)
-            steps = len(match.group(1).split('/x:'))
-            full_ladder = []
-            for item in match.group(1).split('/x:'):
-                full_ladder.append(int(re.match(r'.*\[(\d+)\]', item).group(1)))
-            if len(full_ladder) < self.MAX_ELEMENT_DEPTH:
-                for x in range(steps, self.MAX_ELEMENT_DEPTH):
-                    full_ladder.append(0)
-            else:
-                full_ladder = full_ladder[:self.MAX_ELEMENT_DEPTH]
-            fmt_str = '.'.join(["%04d"] * self.MAX_ELEMENT_DEPTH)
-            return fmt_str % tuple(full_ladder)
-        except:
-            return False
+        return self.location_sort.interior(xpath)
 
     def _generate_marvin_hash_map(self, installed_books):
         '''
@@ -4141,6 +4459,12 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                                                pct_progress)
         return progress
 
+    def _generate_table_cell(self, book_id, col):
+        '''
+        Build the model cell for book_id in one of LAZY_COLUMNS
+        '''
+        return self.cell_generators[col](self.installed_books[book_id])
+
     def _get_calibre_collections(self, cid):
         '''
         Return a sorted list of current calibre collection assignments or
@@ -4159,96 +4483,136 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                     lib_collections = [lib_collections]
             return sorted(lib_collections, key=sort_key)
 
-    def _get_epub_toc(self, path, prepend_title=None):
+    def _get_calibre_field(self, lookup, cids):
+        '''
+        Return {cid: value} of lookup for cids with a single library read
+        '''
+        db = self.opts.gui.current_db
+        api = getattr(db, 'new_api', None)
+        if api is not None:
+            return api.all_field_for(lookup, cids)
+
+        values = {}
+        for cid in cids:
+            mi = db.get_metadata(cid, index_is_id=True)
+            if lookup == 'last_modified':
+                values[cid] = mi.last_modified
+            else:
+                values[cid] = mi.get_user_metadata(lookup, False)['#value#']
+        return values
+
+    def _get_epub_toc(self, path, prepend_title=None, book_hash=None, commit=True):
         '''
         Given a Marvin path, return the epub TOC indexed by section
+        TOCs are cached by content hash. On a cache miss, the library copy is
+        preferred, as ZipFile then reads only the members needed from disk.
         '''
         toc = None
         fpath = path
 
-        # Find the OPF file in the zipped ePub
-        zfo = cStringIO.StringIO(self.ios.read(fpath, mode='rb'))
-        try:
-            zf = ZipFile(zfo, 'r')
-            container = etree.fromstring(zf.read('META-INF/container.xml'))
-            opf_tree = etree.fromstring(zf.read(container.xpath('.//*[local-name()="rootfile"]')[0].get('full-path')))
+        section_titles = self.toc_cache.get(book_hash) if book_hash else None
+        if section_titles is None:
+            try:
+                library_path = self._get_library_epub_path(book_hash) if book_hash else None
+                if library_path is not None:
+                    zf = ZipFile(library_path, 'r')
+                else:
+                    zf = ZipFile(cStringIO.StringIO(self.ios.read(fpath, mode='rb')), 'r')
+                with zf:
+                    section_titles = self._parse_epub_toc(zf)
+            except:
+                import traceback
+                self._log_location()
+                self._log("{:~^80}".format(" error parsing '%s' " % fpath))
+                self._log(traceback.format_exc())
+                self._log("{:~^80}".format(" end traceback "))
+                return toc
 
-            spine = opf_tree.xpath('.//*[local-name()="spine"]')[0]
-            ncx_fs = spine.get('toc')
-            manifest = opf_tree.xpath('.//*[local-name()="manifest"]')[0]
-            ncx = manifest.find('.//*[@id="%s"]' % ncx_fs).get('href')
+            if book_hash:
+                set_json_config_items(self.toc_cache, [(book_hash, section_titles)], commit=commit)
 
-            # Find the ncx file
-            fnames = zf.namelist()
-            _ncx = [x for x in fnames if ncx in x][0]
-            ncx_tree = etree.fromstring(zf.read(_ncx))
-        except:
-            import traceback
-            self._log_location()
-            self._log(" unable to unzip '%s'" % fpath)
-            self._log(traceback.format_exc())
-            return toc
+        toc = OrderedDict()
+        for i, title in enumerate(section_titles):
+            if prepend_title and title is not None:
+                title = "%s &middot; %s" % (prepend_title, title)
+            toc[str(i)] = title
+        return toc
 
-        # fpath points to epub (zipped or unzipped dir)
-        # spine, ncx_tree populated
-        try:
-            toc = OrderedDict()
-            # 1. capture idrefs from spine
-            for i, el in enumerate(spine):
-                toc[str(i)] = el.get('idref')
-
-            # 2. Resolve <spine> idrefs to <manifest> hrefs
-            for el in toc:
-                toc[el] = manifest.find('.//*[@id="%s"]' % toc[el]).get('href')
-
-            # 3. Build a dict of src:toc_entry
-            src_map = OrderedDict()
-            navMap = ncx_tree.xpath('.//*[local-name()="navMap"]')[0]
-            for navPoint in navMap:
-                # Get the first-level entry
-                src = re.sub(r'#.*$', '', navPoint.xpath('.//*[local-name()="content"]')[0].get('src'))
-                toc_entry = navPoint.xpath('.//*[local-name()="text"]')[0].text
-                src_map[src] = toc_entry
-
-                # Get any nested navPoints
-                nested_navPts = navPoint.xpath('.//*[local-name()="navPoint"]')
-                for nnp in nested_navPts:
-                    src = re.sub(r'#.*$', '', nnp.xpath('.//*[local-name()="content"]')[0].get('src'))
-                    toc_entry = nnp.xpath('.//*[local-name()="text"]')[0].text
-                    src_map[src] = toc_entry
-
-            # Resolve src paths to toc_entry
-            for section in toc:
-                if toc[section] in src_map:
-                    if prepend_title:
-                        toc[section] = "%s &middot; %s" % (prepend_title,  src_map[toc[section]])
-                    else:
-                        toc[section] = src_map[toc[section]]
-                else:
-                    toc[section] = None
+    def _get_epub_tocs(self, book_ids):
+        '''
+        Return {book_id: toc} for book_ids. Cached TOCs are used as is, library
+        copies are parsed concurrently, the rest are fetched from the iDevice
+        one at a time. New TOCs are stored with a single write.
+        '''
+        from multiprocessing.pool import ThreadPool
+
+        def _parse_library_copy(args):
+            book_id, book_hash, library_path = args
+            try:
+                with ZipFile(library_path, 'r') as zf:
+                    return book_id, book_hash, self._parse_epub_toc(zf)
+            except:
+                import traceback
+                self._log_location(library_path)
+                self._log(traceback.format_exc())
+                return book_id, book_hash, None
+
+        tocs = {}
+        library_copies = []
+        serial_copies = []
+        for book_id in book_ids:
+            book = self.installed_books[book_id]
+            if self.toc_cache.get(book.hash) is not None:
+                serial_copies.append(book_id)
+                continue
+            library_path = self._get_library_epub_path(book.hash)
+            if library_path is not None:
+                library_copies.append((book_id, book.hash, library_path))
+            else:
+                serial_copies.append(book_id)
 
-            # 5. Fill in the gaps
-            current_toc_entry = None
-            for section in toc:
-                if toc[section] is None:
-                    toc[section] = current_toc_entry
+        if library_copies:
+            pool = ThreadPool(min(len(library_copies), 4))
+            try:
+                parsed = pool.map(_parse_library_copy, library_copies)
+            finally:
+                pool.close()
+                pool.join()
+            for book_id, book_hash, section_titles in parsed:
+                if section_titles is not None:
+                    set_json_config_items(self.toc_cache, [(book_hash, section_titles)], commit=False)
+                    tocs[book_id] = OrderedDict(
+                        (str(i), title) for i, title in enumerate(section_titles))
                 else:
-                    current_toc_entry = toc[section]
-        except:
-            import traceback
-            self._log_location()
-            self._log("{:~^80}".format(" error parsing '%s' " % fpath))
-            self._log(traceback.format_exc())
-            self._log("{:~^80}".format(" end traceback "))
+                    serial_copies.append(book_id)
 
-        return toc
+        # Cache hits, and books only on the iDevice
+        for book_id in serial_copies:
+            book = self.installed_books[book_id]
+            path = '/'.join(['/Documents', book.path])
+            tocs[book_id] = self._get_epub_toc(path, book_hash=book.hash, commit=False)
+
+        self.toc_cache.commit()
+        return tocs
 
     def _get_formatted_annotations(self, book_id):
         '''
         Fetch and format Book notes, Bookmark notes, Annotations for book_id
         appearance:preview_css() uses code modeled from this method to construct preview
         '''
+        return self._get_formatted_annotations_for_books([book_id])[book_id]
+
+    def _get_formatted_annotations_for_books(self, book_ids):
+        '''
+        Fetch and format Book notes, Bookmark notes, Annotations for book_ids
+        mainDb is read with one set-based query per table, the scratch tables
+        are populated once and committed once, TOCs are resolved together.
+        Renderings are cached by the mainDb rows they are built from, so only
+        books whose rows or appearance changed go through the pipeline.
+        Return {book_id: html}
+        '''
         DIV_TEMPLATE = '''<div class="{0}"></div>'''
+        SQL_VARIABLE_LIMIT = 500
 
         def _build_book_notes(book_id, book_notes_table):
             '''
@@ -4288,27 +4652,27 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 soup = BookmarkNotes().construct(bookmark_notes)
             return soup
 
-        def _get_active_annotations(book_id, annotations_table):
+        def _get_active_annotations(con, annotations_table):
             '''
+            Populate annotations_table from Highlights for all book_ids
             '''
-            self._log_location(book_id)
+            self._log_location("%d books" % len(book_ids))
             # ~~~~~~~~~~ Emulating get_active_annotations() ~~~~~~~~~~
 
             # Create a blank annotations table (#153)
             self.opts.db.create_annotations_table(annotations_table)
 
             # Fetch the annotations (#158)
-            con = sqlite3.connect(local_db_path)
-            with con:
-                con.row_factory = sqlite3.Row
-                cur = con.cursor()
-                cur.execute('''
-                               SELECT * FROM Highlights
-                               WHERE BookId = '{0}' AND Deleted = "0"
-                               ORDER BY NoteDateTime
-                            '''.format(book_id))
-                rows = cur.fetchall()
+            annotations = []
+            last_annotations = {}
+            for rows in _select_for_books(con, '''
+                                               SELECT * FROM Highlights
+                                               WHERE BookID IN ({0}) AND Deleted = "0"
+                                               ORDER BY NoteDateTime
+                                            '''):
                 for row in rows:
+                    book_id = row[b'BookID']
+
                     # Sanitize text, note to unicode
                     highlight_text = re.sub('\xa0', ' ', row[b'Text'])
                     highlight_text = UnicodeDammit(highlight_text).unicode
@@ -4355,82 +4719,77 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         interior,
                         int(row[b'StartOffset']))
 
-                    # Add annotation
-                    self.opts.db.add_to_annotations_db(annotations_table, a_mi)
+                    annotations.append(a_mi)
 
-                    # Update last_annotation in books_db
-                    self.opts.db.update_book_last_annotation(books_db, row[b'NoteDateTime'], book_id)
+                    # Rows are ordered by NoteDateTime, so the last one seen is latest
+                    last_annotations[book_id] = row[b'NoteDateTime']
 
-                # Update the timestamp
-                self.opts.db.update_timestamp(annotations_table)
-                self.opts.db.commit()
+            # Add the annotations, update last_annotation in books_db
+            self.opts.db.add_many_to_annotations_db(annotations_table, annotations)
+            self.opts.db.update_books_last_annotation(books_db, last_annotations)
 
-        def _get_book_notes(book_id, book_notes_table):
+            # Update the timestamp
+            self.opts.db.update_timestamp(annotations_table)
+
+        def _get_book_notes(con, book_notes_table):
             '''
             Retrieve Book notes
             '''
-            self._log_location(book_id)
+            self._log_location("%d books" % len(book_ids))
 
             # Initialize a blank book notes table (#153)
             self.opts.db.create_book_notes_table(book_notes_table)
 
-            # Fetch the book note from Marvin
-            book_note = None
-            con = sqlite3.connect(local_db_path)
-            with con:
-                con.row_factory = sqlite3.Row
-                cur = con.cursor()
-                cur.execute('''SELECT * FROM BOOKS''')
-                row = cur.fetchone()
-
-                # Books:Note added 2.6.665
-                if 'Note' in row.keys():
-                    cur.execute('''
-                                   SELECT
-                                    Note
-                                   FROM Books
-                                   WHERE ID = '{0}'
-                                '''.format(book_id))
-                    book_note = cur.fetchone()[b'Note']
+            # Books:Note added 2.6.665
+            cur = con.cursor()
+            cur.execute('''SELECT * FROM Books LIMIT 1''')
+            if 'Note' not in [d[0] for d in cur.description]:
+                return
 
-            # Store the book note to our db
-            if book_note:
-                self.opts.db.add_to_book_notes_db(book_notes_table,
-                    {'book_id': book_id, 'note_text': book_note})
+            # Store the book notes to our db
+            book_notes = []
+            for rows in _select_for_books(con, '''
+                                               SELECT
+                                                ID,
+                                                Note
+                                               FROM Books
+                                               WHERE ID IN ({0})
+                                            '''):
+                for row in rows:
+                    if row[b'Note']:
+                        book_notes.append({'book_id': row[b'ID'], 'note_text': row[b'Note']})
+            self.opts.db.add_many_to_book_notes_db(book_notes_table, book_notes)
 
-        def _get_bookmark_notes(book_id, bookmark_notes_table):
+        def _get_bookmark_notes(con, bookmark_notes_table):
             '''
             Retrieve Bookmark notes
             '''
-            self._log_location(book_id)
+            self._log_location("%d books" % len(book_ids))
 
             # Initialize a blank bookmark notes table
             self.opts.db.create_bookmark_notes_table(bookmark_notes_table)
 
             # Fetch the bookmark notes from Marvin
-            con = sqlite3.connect(local_db_path)
-            with con:
-                con.row_factory = sqlite3.Row
-                cur = con.cursor()
-                cur.execute('''
-                               SELECT
-                                Colour,
-                                Location,
-                                SectionNumber,
-                                Text
-                               FROM Bookmarks
-                               WHERE BookID = '{0}'
-                            '''.format(book_id))
-                bmn_rows = cur.fetchall()
-                for row in bmn_rows:
+            bookmark_notes = []
+            for rows in _select_for_books(con, '''
+                                               SELECT
+                                                BookID,
+                                                Colour,
+                                                Location,
+                                                SectionNumber,
+                                                Text
+                                               FROM Bookmarks
+                                               WHERE BookID IN ({0})
+                                            '''):
+                for row in rows:
                     if row[b'Text']:
-                        bookmark_note = {
-                            'book_id': book_id,
+                        bookmark_notes.append({
+                            'book_id': row[b'BookID'],
                             'highlight_color': row[b'Colour'],
                             'location': row[b'Location'],
                             'note_text': row[b'Text'],
-                            'section_number': row[b'SectionNumber']}
-                        self.opts.db.add_to_bookmark_notes_db(bookmark_notes_table, bookmark_note)
+                            'section_number': row[b'SectionNumber']})
+            self.opts.db.add_many_to_bookmark_notes_db(bookmark_notes_table, bookmark_notes)
 
         def _minify_css(css):
             '''
@@ -4455,92 +4814,177 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
             return css.strip()
 
+        def _source_hashes(con):
+            '''
+            Return {book_id: digest} of the mainDb rows rendered for each book,
+            with its title and content hash, which determines its TOC
+            '''
+            digests = {}
+            for book_id in book_ids:
+                digests[book_id] = hashlib.md5(repr((self.installed_books[book_id].title,
+                                                     self.installed_books[book_id].hash)))
+
+            queries = [(b'BookID', '''SELECT * FROM Highlights
+                                     WHERE BookID IN ({0}) AND Deleted = "0"
+                                     ORDER BY NoteDateTime
+                                  '''),
+                       (b'BookID', '''SELECT BookID, Colour, Location, SectionNumber, Text
+                                     FROM Bookmarks
+                                     WHERE BookID IN ({0})
+                                  ''')]
+
+            # Books:Note added 2.6.665
+            cur = con.cursor()
+            cur.execute('''SELECT * FROM Books LIMIT 1''')
+            if 'Note' in [d[0] for d in cur.description]:
+                queries.append((b'ID', '''SELECT ID, Note FROM Books WHERE ID IN ({0})'''))
+            cur.close()
+
+            for id_column, sql in queries:
+                for rows in _select_for_books(con, sql):
+                    for row in rows:
+                        digests[int(row[id_column])].update(repr(tuple(row)))
+            return dict((book_id, m.hexdigest()) for book_id, m in digests.items())
+
+        def _select_for_books(con, sql):
+            '''
+            Yield rows for book_ids in chunks within SQLite's variable limit
+            '''
+            cur = con.cursor()
+            for i in range(0, len(book_ids), SQL_VARIABLE_LIMIT):
+                chunk = book_ids[i:i + SQL_VARIABLE_LIMIT]
+                cur.execute(sql.format(', '.join(['?'] * len(chunk))), chunk)
+                yield cur.fetchall()
+            cur.close()
 
-        # ~~~~~~~~~~ Emulating get_installed_books() ~~~~~~~~~~
-        local_db_path = getattr(self.connected_device, "local_db_path")
 
-        template = "{0}_books"
-        books_db = template.format(re.sub('\W', '_', self.ios.device_name))
+        book_ids = list(book_ids)
+
+        # Load the CSS from MXD resources, minified once per version
+        path = os.path.join(self.parent.opts.resources_path, 'css', 'annotations.css')
+        with open(path, 'rb') as f:
+            raw_css = f.read()
+        css_hash = hashlib.md5(raw_css).hexdigest()
+        css = render_cache.get(('css', css_hash))
+        if css is None:
+            css = _minify_css(raw_css.decode('utf-8'))
+            render_cache.put(('css', css_hash), css)
+        appearance = annotations_css_signature() + css_hash
+
+        # Reuse the renderings of books whose rows and appearance are unchanged
+        con = sqlite3.connect(self.mainDb.path())
+        con.row_factory = sqlite3.Row
+        source_hashes = _source_hashes(con)
+        formatted = {}
+        for book_id in book_ids:
+            formatted[book_id] = render_cache.get((source_hashes[book_id], appearance))
+        book_ids = [book_id for book_id in book_ids if formatted[book_id] is None]
+        if not book_ids:
+            con.close()
+            return formatted
+
+        # ~~~~~~~~~~ Emulating get_installed_books() ~~~~~~~~~~
+        device = re.sub('\W', '_', self.ios.device_name)
+        books_db = "{0}_books".format(device)
+        book_notes_table = "{0}_book_notes".format(device)
+        bookmark_notes_table = "{0}_bookmark_notes".format(device)
+        annotations_table = "{0}_annotations".format(device)
 
         # Create the books table as needed (#272)
         self.opts.db.create_books_table(books_db)
 
-        # Add the book to the books_db
-        b_mi = BookStruct()
-        b_mi.active = True
-        b_mi.author = ', '.join(self.installed_books[book_id].author)
-        b_mi.author_sort = self.installed_books[book_id].author_sort
-        b_mi.book_id = book_id
-        b_mi.title = self.installed_books[book_id].title
-        b_mi.title_sort = self.installed_books[book_id].title_sort
-        b_mi.uuid = self.installed_books[book_id].uuid
-        self.opts.db.add_to_books_db(books_db, b_mi)
+        # Add the books to the books_db
+        books = []
+        for book_id in book_ids:
+            b_mi = BookStruct()
+            b_mi.active = True
+            b_mi.author = ', '.join(self.installed_books[book_id].author)
+            b_mi.author_sort = self.installed_books[book_id].author_sort
+            b_mi.book_id = book_id
+            b_mi.title = self.installed_books[book_id].title
+            b_mi.title_sort = self.installed_books[book_id].title_sort
+            b_mi.uuid = self.installed_books[book_id].uuid
+            books.append(b_mi)
+        self.opts.db.add_many_to_books_db(books_db, books)
 
         # Get the toc_entries (#344)
-        path = '/'.join(['/Documents', self.installed_books[book_id].path])
-        self.tocs = {}
-        self.tocs[book_id] = self._get_epub_toc(path)
+        self.tocs = self._get_epub_tocs(book_ids)
 
         # Update the timestamp (#347)
         self.opts.db.update_timestamp(books_db)
-        self.opts.db.commit()
-
-        # Populate book_notes_table
-        template = "{0}_book_notes"
-        book_notes_table = template.format(re.sub('\W', '_', self.ios.device_name))
-        _get_book_notes(book_id, book_notes_table)
-
-        # Populate bookmark_notes table
-        template = "{0}_bookmark_notes"
-        bookmark_notes_table = template.format(re.sub('\W', '_', self.ios.device_name))
-        _get_bookmark_notes(book_id, bookmark_notes_table)
-
-        # Populate annotations_table
-        template = "{0}_annotations"
-        annotations_table = template.format(re.sub('\W', '_', self.ios.device_name))
-        _get_active_annotations(book_id, annotations_table)
 
-        # Build the formatted user annotations div
-        book_mi = BookStruct()
-        book_mi.book_id = book_id
-        book_mi.reader_app = 'Marvin'
-        book_mi.title = self.installed_books[book_id].title
-        annotations_soup = self.opts.db.annotations_to_html(annotations_table, book_mi)
-
-        # Build Bookmark notes
-        bookmark_notes_soup = _build_bookmark_notes(book_id, bookmark_notes_table)
-
-        # Build Book notes
-        book_notes_soup = _build_book_notes(book_id, book_notes_table)
+        # Populate book_notes_table, bookmark_notes table, annotations_table
+        with con:
+            _get_book_notes(con, book_notes_table)
+            _get_bookmark_notes(con, bookmark_notes_table)
+            _get_active_annotations(con, annotations_table)
+        con.close()
+        self.opts.db.commit()
 
-        # Assemble the soup
-        soup = BeautifulSoup(ANNOTATIONS_HTML_TEMPLATE)
+        for book_id in book_ids:
+            # Build the formatted user annotations div
+            book_mi = BookStruct()
+            book_mi.book_id = book_id
+            book_mi.reader_app = 'Marvin'
+            book_mi.title = self.installed_books[book_id].title
+            annotations_soup = self.opts.db.annotations_to_html(annotations_table, book_mi)
+
+            # Build Bookmark notes
+            bookmark_notes_soup = _build_bookmark_notes(book_id, bookmark_notes_table)
+
+            # Build Book notes
+            book_notes_soup = _build_book_notes(book_id, book_notes_table)
+
+            # Assemble the soup
+            soup = BeautifulSoup(ANNOTATIONS_HTML_TEMPLATE)
+
+            # Populate style tag with minified CSS
+            style_tag = Tag(soup, 'style')
+            style_tag.append(css)
+            soup.head.style.replaceWith(style_tag)
+
+            # Add pieces, with dividers as needed
+            if book_notes_soup is not None:
+                soup.body.append(book_notes_soup)
+                if annotations_soup.div.contents or bookmark_notes_soup:
+                    cd_tag = Tag(soup, 'div', [('class', "divider")])
+                    soup.body.append(cd_tag)
+            if bookmark_notes_soup is not None:
+                soup.body.append(bookmark_notes_soup)
+                if annotations_soup.div.contents:
+                    cd_tag = Tag(soup, 'div', [('class', "divider")])
+                    soup.body.append(cd_tag)
+            if annotations_soup is not None:
+                soup.body.append(annotations_soup)
+
+            formatted[book_id] = unicode(soup.renderContents())
+            render_cache.put((source_hashes[book_id], appearance), formatted[book_id])
+        return formatted
+
+    def _get_library_epub(self, book_hash):
+        '''
+        Return the contents of the library epub with content hash book_hash,
+        or None if the library has no copy
+        '''
+        path = self._get_library_epub_path(book_hash)
+        if path is not None:
+            with open(path, 'rb') as f:
+                return f.read()
+        return None
 
-        # Load the CSS from MXD resources
-        path = os.path.join(self.parent.opts.resources_path, 'css', 'annotations.css')
-        with open(path, 'rb') as f:
-            css = f.read().decode('utf-8')
-
-        # Populate style tag with minified CSS
-        style_tag = Tag(soup, 'style')
-        style_tag.append(_minify_css(css))
-        soup.head.style.replaceWith(style_tag)
-
-        # Add pieces, with dividers as needed
-        if book_notes_soup is not None:
-            soup.body.append(book_notes_soup)
-            if annotations_soup.div.contents or bookmark_notes_soup:
-                cd_tag = Tag(soup, 'div', [('class', "divider")])
-                soup.body.append(cd_tag)
-        if bookmark_notes_soup is not None:
-            soup.body.append(bookmark_notes_soup)
-            if annotations_soup.div.contents:
-                cd_tag = Tag(soup, 'div', [('class', "divider")])
-                soup.body.append(cd_tag)
-        if annotations_soup is not None:
-            soup.body.append(annotations_soup)
-
-        return unicode(soup.renderContents())
+    def _get_library_epub_path(self, book_hash):
+        '''
+        Return the path of the library epub with content hash book_hash,
+        or None if the library has no copy
+        '''
+        hash_map = getattr(self.library_scanner, 'hash_map', None) or {}
+        db = self.opts.gui.current_db
+        for uuid in hash_map.get(book_hash, []):
+            cid = self.library_scanner.uuid_map[uuid]['id']
+            path = db.format_abspath(cid, 'EPUB', index_is_id=True)
+            if path and os.path.exists(path):
+                return path
+        return None
 
     def _get_marvin_collections(self, book_id):
         return sorted(self.installed_books[book_id].device_collections, key=sort_key)
@@ -4571,47 +5015,6 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         Try to use previously generated installed_books if available
         '''
-        def _get_articles(cur, book_id):
-            '''
-            Return True if PinnedArticles or Wiki entries exist for book_id
-            '''
-            articles = {}
-
-            # Get PinnedArticles
-            a_cur = con.cursor()
-            a_cur.execute('''SELECT
-                              BookID,
-                              Title,
-                              URL
-                             FROM PinnedArticles
-                             WHERE BookID = '{0}'
-                          '''.format(book_id))
-            pinned_article_rows = a_cur.fetchall()
-
-            if len(pinned_article_rows):
-                pinned_articles = {}
-                for row in pinned_article_rows:
-                    pinned_articles[row[b'Title']] = row[b'URL']
-                articles['Pinned'] = pinned_articles
-
-            # Get Wiki snippets
-            a_cur.execute('''SELECT
-                              BookID,
-                              Title,
-                              Snippet
-                             FROM Wiki
-                             WHERE BookID = '{0}'
-                          '''.format(book_id))
-            wiki_rows = a_cur.fetchall()
-
-            if len(wiki_rows):
-                wiki_snippets = {}
-                for row in wiki_rows:
-                    wiki_snippets[row[b'Title']] = row[b'Snippet']
-                articles['Wiki'] = wiki_snippets
-
-            return articles
-
         def _get_calibre_id(uuid, title, author):
             '''
             Find book in library, return cid, mi
@@ -4692,6 +5095,25 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             collections_cur.close()
             return collection_map
 
+        def _get_counts(con, tables):
+            '''
+            Return {book_id: rows in tables}, one aggregate query per table
+            '''
+            counts = {}
+            c_cur = con.cursor()
+            for table in tables:
+                c_cur.execute('''SELECT
+                                  BookID,
+                                  count(*) AS count
+                                 FROM {0}
+                                 GROUP BY BookID
+                              '''.format(table))
+                for row in c_cur.fetchall():
+                    book_id = int(row[b'BookID'])
+                    counts[book_id] = counts.get(book_id, 0) + row[b'count']
+            c_cur.close()
+            return counts
+
         def _get_flags(cur, row):
             # Get the flag assignments
             flags = []
@@ -4971,25 +5393,6 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 publisher = None
             return publisher
 
-        def _get_vocabulary_list(cur, book_id):
-            # Get the vocabulary content
-            voc_cur = con.cursor()
-            voc_cur.execute('''SELECT
-                                BookID,
-                                Word
-                              FROM Vocabulary
-                              WHERE BookID = '{0}'
-                           '''.format(book_id))
-
-            vocabulary_rows = voc_cur.fetchall()
-            vocabulary_list = []
-            if len(vocabulary_rows):
-                vocabulary_list = [vocabulary_item[b'Word']
-                                   for vocabulary_item in vocabulary_rows]
-                vocabulary_list = sorted(vocabulary_list, key=sort_key)
-            voc_cur.close()
-            return vocabulary_list
-
         def _populate_installed_book(row):
             '''
             Add row to installed_books
@@ -5002,11 +5405,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
                 # Get the primary metadata from Books
                 this_book = Book(row[b'Title'], row[b'Author'].split(', '))
-                this_book.articles = _get_articles(cur, book_id)
+                this_book.article_count = article_counts.get(book_id, 0)
                 this_book.author_sort = row[b'AuthorSort']
                 this_book.cid = cid
                 this_book.calibre_collections = self._get_calibre_collections(this_book.cid)
-                this_book.comments = row[b'Description']
                 this_book.cover_file = row[b'CoverFile']
                 this_book.date_added = row[b'DateAdded']
                 this_book.date_opened = row[b'DateOpened']
@@ -5032,7 +5434,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 this_book.tags = _get_marvin_genres(book_id)
                 this_book.title_sort = row[b'CalibreTitleSort']
                 this_book.uuid = row[b'UUID']
-                this_book.vocabulary = _get_vocabulary_list(cur, book_id)
+                this_book.vocabulary_count = vocabulary_counts.get(book_id, 0)
                 this_book.word_count = locale.format("%d", row[b'WordCount'], grouping=True)
                 installed_books[book_id] = this_book
             except:
@@ -5111,13 +5513,17 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 hashes = self._scan_marvin_books(cached_books)
 
                 # Get the mainDb data
-                con = sqlite3.connect(self.connected_device.local_db_path)
+                con = self.mainDb.connect()
                 with con:
                     con.row_factory = sqlite3.Row
 
                     # Get the collection map
                     collection_map = _get_collection_map(con)
 
+                    # Get the Deep View article and Vocabulary counts
+                    article_counts = _get_counts(con, ['PinnedArticles', 'Wiki'])
+                    vocabulary_counts = _get_counts(con, ['Vocabulary'])
+
                     # Get the books
                     cur = con.cursor()
                     cur.execute('''SELECT count(*) from Books''')
@@ -5179,13 +5585,17 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 hashes = self._scan_marvin_books(cached_books)
 
                 # Get the mainDb data
-                con = sqlite3.connect(self.connected_device.local_db_path)
+                con = self.mainDb.connect()
                 with con:
                     con.row_factory = sqlite3.Row
 
                     # Get the collection map
                     collection_map = _get_collection_map(con)
 
+                    # Get the Deep View article and Vocabulary counts
+                    article_counts = _get_counts(con, ['PinnedArticles', 'Wiki'])
+                    vocabulary_counts = _get_counts(con, ['Vocabulary'])
+
                     # Get the updated books
                     cur = con.cursor()
                     modified_count = len(installed_books_metadata_changes)
@@ -5221,6 +5631,24 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             load_method = "WARM START"
             self._log("{}: returning existing installed_books".format(load_method))
 
+        # Articles, comments and vocabulary are fetched from this dialog's mainDb when first viewed
+        for book in installed_books.values():
+            book.loader = self._fetch_book_detail
+
+        # Snapshots stored before counts were kept have None
+        uncounted = [book_id for book_id in installed_books
+                     if installed_books[book_id].vocabulary_count is None]
+        if uncounted:
+            self._log("adding article and vocabulary counts to {:,} books".format(len(uncounted)))
+            con = self.mainDb.connect()
+            with con:
+                con.row_factory = sqlite3.Row
+                article_counts = _get_counts(con, ['PinnedArticles', 'Wiki'])
+                vocabulary_counts = _get_counts(con, ['Vocabulary'])
+            for book_id in uncounted:
+                installed_books[book_id].article_count = article_counts.get(book_id, 0)
+                installed_books[book_id].vocabulary_count = vocabulary_counts.get(book_id, 0)
+
         elapsed = _seconds_to_time(time.time() - start_time)
         self._log_location("{0} elapsed time: {1:02d}:{2:02d}".format(
             load_method, int(elapsed['mins']), int(elapsed['secs'])))
@@ -5306,24 +5734,15 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         self.ch = CommandHandler(self)
         self.ch.construct_metadata_command(
             cmd_name='update_metadata_items', cmd_element='updatemetadataitems')
-        book_tag = Tag(self.ch.command_soup, 'book')
-        book_tag['author'] = escape(', '.join(self.installed_books[book_id].authors))
-        book_tag['filename'] = self.installed_books[book_id].path
-        book_tag['title'] = self.installed_books[book_id].title
-        book_tag['uuid'] = self.installed_books[book_id].uuid
+        book_el = self._add_manifest_book(book_id)
 
         flags = self.installed_books[book_id].flags
         collections = self.installed_books[book_id].device_collections
         merged = sorted(flags + collections, key=sort_key)
 
-        collections_tag = Tag(self.ch.command_soup, 'collections')
-        for tag in sorted(merged, key=sort_key):
-            c_tag = Tag(self.ch.command_soup, 'collection')
-            c_tag.insert(0, escape(tag))
-            collections_tag.insert(0, c_tag)
-        book_tag.insert(0, collections_tag)
-
-        self.ch.command_soup.manifest.insert(0, book_tag)
+        collections_el = self.ch.add_element(book_el, 'collections')
+        for tag in merged:
+            self.ch.add_element(collections_el, 'collection', text=tag)
 
         local_busy = False
         if self.busy:
@@ -5346,32 +5765,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
     def _localize_marvin_database(self):
         '''
-        Copy remote_db_path from iOS to local storage using device method
+        Mark the local copy of mainDb stale after a mutating command.
+        MainDbLocalizer refreshes it from the iDevice before the next read.
         '''
-        self._log_location("starting")
-        msg = "Refreshing database"
-        local_busy = False
-        if self.busy:
-            self._busy_status_msg(msg=msg)
-        else:
-            local_busy = True
-            self._busy_status_setup(msg=msg)
-
-        self.connected_device._localize_database_path(self.connected_device.books_subpath)
-
-#         local_db_path = self.connected_device.local_db_path
-#         remote_db_path = self.connected_device.books_subpath
-#
-#         # Report size of remote_db
-#         stats = self.ios.exists(remote_db_path)
-#         self._log("mainDb: {:,} bytes".format(int(stats['st_size'])))
-#
-#         with open(local_db_path, 'wb') as out:
-#             self.ios.copy_from_idevice(remote_db_path, out)
-
-        if local_busy:
-            self._busy_status_teardown()
-        self._log_location("finished")
+        self.mainDb.invalidate()
 
     def _localize_hash_cache(self, cached_books):
         '''
@@ -5432,6 +5829,44 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         return hash_cache
 
+    def _parse_epub_toc(self, zf):
+        '''
+        Return the TOC entries of an open epub as a list indexed by section.
+        Manifest ids are mapped to hrefs once, sections without a TOC entry
+        inherit the preceding entry.
+        '''
+        container = etree.fromstring(zf.read('META-INF/container.xml'))
+        opf_tree = etree.fromstring(zf.read(container.xpath('.//*[local-name()="rootfile"]')[0].get('full-path')))
+
+        manifest = {}
+        for item in opf_tree.xpath('.//*[local-name()="manifest"]/*[local-name()="item"]'):
+            manifest[item.get('id')] = item.get('href')
+
+        # Find the ncx file
+        spine = opf_tree.xpath('.//*[local-name()="spine"]')[0]
+        ncx = manifest[spine.get('toc')]
+        _ncx = [x for x in zf.namelist() if ncx in x][0]
+        ncx_tree = etree.fromstring(zf.read(_ncx))
+
+        # Build a dict of src:toc_entry, nested navPoints following their parent
+        src_map = {}
+        navMap = ncx_tree.xpath('.//*[local-name()="navMap"]')[0]
+        for navPoint in navMap.xpath('.//*[local-name()="navPoint"]'):
+            src = re.sub(r'#.*$', '', navPoint.xpath('.//*[local-name()="content"]')[0].get('src'))
+            src_map[src] = navPoint.xpath('.//*[local-name()="text"]')[0].text
+
+        # Resolve spine idrefs to toc entries, filling in the gaps
+        section_titles = []
+        current_toc_entry = None
+        for itemref in spine.xpath('./*[local-name()="itemref"]'):
+            toc_entry = src_map.get(manifest.get(itemref.get('idref')))
+            if toc_entry is None:
+                toc_entry = current_toc_entry
+            else:
+                current_toc_entry = toc_entry
+            section_titles.append(toc_entry)
+        return section_titles
+
     def _purge_cached_orphans(self, cached_books):
         '''
 
@@ -5457,6 +5892,220 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         return hash_cache
 
+    def _refresh_custom_columns_for_rows(self, selected_books):
+        '''
+        Refresh Date read, Locked, Progress, Read, Reading list and Word count
+        for the rows of selected_books. Values come from the model and a single pass over mainDb, and
+        are written with one library update per column. Marvin is sent at most
+        one LockBooks and one update_metadata_items command.
+        Mirrors _apply_date_read(), _apply_flags(), _apply_locked(),
+        _apply_progress(), _apply_word_count()
+        '''
+        self._log_location("%d rows" % len(selected_books))
+
+        def _build_flag_list(flagbits):
+            flags = []
+            if flagbits & self.NEW_FLAG:
+                flags.append(self.FLAGS['new'])
+            if flagbits & self.READING_FLAG:
+                flags.append(self.FLAGS['reading_list'])
+            if flagbits & self.READ_FLAG:
+                flags.append(self.FLAGS['read'])
+            return flags
+
+        def _get_marvin_last_modified():
+            '''
+            Return {book_id: MetadataUpdated} from one query
+            Books without MetadataUpdated are treated as modified now()
+            '''
+            last_modified = {}
+            con = self.mainDb.connect()
+            with con:
+                con.row_factory = sqlite3.Row
+                cur = con.cursor()
+                try:
+                    cur.execute('''SELECT ID, MetadataUpdated FROM Books''')
+                except sqlite3.OperationalError:
+                    self._log("MetadataUpdated unavailable, using now()")
+                    return last_modified
+                for row in cur:
+                    try:
+                        last_modified[row[b'ID']] = datetime.utcfromtimestamp(
+                            row[b'MetadataUpdated']).replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal())
+                    except:
+                        pass
+                cur.close()
+            return last_modified
+
+        books = dict((row, book) for row, book in selected_books.items()
+                     if book['cid'] is not None)
+        cids = [book['cid'] for book in books.values()]
+        updates = {}
+
+        # ~~~~~~~~~ Date read, Word count from the model ~~~~~~~~~
+        lookup = get_cc_mapping('date_read', 'field', None)
+        if lookup:
+            updates[lookup] = {}
+            for book in books.values():
+                if book['last_opened']:
+                    try:
+                        updates[lookup][book['cid']] = strptime(book['last_opened'], "%Y-%m-%d %H:%M",
+                                                                as_utc=False, assume_utc=True)
+                    except:
+                        self._log("unable to parse Last read date for '%s'" % book['title'])
+
+        lookup = get_cc_mapping('word_count', 'field', None)
+        if lookup:
+            updates[lookup] = dict((book['cid'], book['word_count'])
+                                   for book in books.values() if book['word_count'])
+
+        # ~~~~~~~~~ Locked: locked in either location locks both ~~~~~~~~~
+        lookup = get_cc_mapping('locked', 'field', None)
+        if lookup:
+            c_locked = self._get_calibre_field(lookup, cids)
+            updates[lookup] = {}
+            to_lock = []
+            for row, book in books.items():
+                if bool(c_locked.get(book['cid'])) ^ bool(book['locked']):
+                    if c_locked.get(book['cid']):
+                        to_lock.append(row)
+                    else:
+                        updates[lookup][book['cid']] = True
+
+            if to_lock:
+                self.ch = CommandHandler(self)
+                self.ch.construct_general_command("LockBooks")
+                for row in to_lock:
+                    book_id = books[row]['book_id']
+                    self._log("Setting Marvin Locked status for {0}".format(
+                        self.installed_books[book_id].title))
+                    new_locked_widget = SortableImageWidgetItem(
+                        os.path.join(self.parent.opts.resources_path, 'icons', "lock_enabled.png"), 1)
+                    self.tm.set_locked(row, new_locked_widget)
+                    self.installed_books[book_id].pin = 1
+                    self._add_manifest_book(book_id)
+                self.ch.issue_command()
+                if self.ch.results['code']:
+                    self._show_command_error('apply_locked', self.ch.results)
+
+        # ~~~~~~~~~ Read, Reading list: newer metadata is sync master ~~~~~~~~~
+        read_lookup = get_cc_mapping('read', 'field', None)
+        reading_list_lookup = get_cc_mapping('reading_list', 'field', None)
+        if read_lookup or reading_list_lookup:
+            m_last_modified = _get_marvin_last_modified()
+            c_last_modified = self._get_calibre_field('last_modified', cids)
+            flag_lookups = []
+            if read_lookup:
+                flag_lookups.append((read_lookup, self.READ_FLAG,
+                                     self.READING_FLAG + self.READ_FLAG,
+                                     self._get_calibre_field(read_lookup, cids)))
+                updates[read_lookup] = {}
+            if reading_list_lookup:
+                flag_lookups.append((reading_list_lookup, self.READING_FLAG,
+                                     self.NEW_FLAG + self.READING_FLAG + self.READ_FLAG,
+                                     self._get_calibre_field(reading_list_lookup, cids)))
+                updates[reading_list_lookup] = {}
+
+            marvin_updates = []
+            for row, book in books.items():
+                book_id = book['book_id']
+                cid = book['cid']
+                flagbits = original_flagbits = self.tm.get_flags(row).sort_key
+                calibre_is_master = (c_last_modified[cid].astimezone(tz.tzlocal()) >
+                                     m_last_modified.get(book_id, datetime.now(tz.tzlocal())))
+
+                # Apply calibre values to Marvin flags where calibre is master
+                for lookup, mask, inhibit, c_values in flag_lookups:
+                    c_flag = bool(c_values.get(cid))
+                    if c_flag != bool(flagbits & mask) and calibre_is_master:
+                        if c_flag:
+                            flagbits = (flagbits | mask) & inhibit
+                        else:
+                            flagbits = flagbits ^ mask
+
+                if flagbits != original_flagbits:
+                    self.tm.set_flags(row, SortableImageWidgetItem(
+                        os.path.join(self.parent.opts.resources_path, 'icons',
+                                     "flags%d.png" % flagbits), flagbits))
+                    self.installed_books[book_id].flags = _build_flag_list(flagbits)
+                    self._update_reading_progress(self.installed_books[book_id], row)
+                    self._update_device_flags(book_id, book['path'], self.installed_books[book_id].flags)
+                    marvin_updates.append(book_id)
+
+                # calibre columns follow the resulting Marvin flags
+                for lookup, mask, inhibit, c_values in flag_lookups:
+                    if bool(c_values.get(cid)) != bool(flagbits & mask):
+                        updates[lookup][cid] = 1 if flagbits & mask else None
+
+            if marvin_updates:
+                # Inform Marvin of updated flags + collections in one command
+                self.ch = CommandHandler(self)
+                self.ch.construct_metadata_command(
+                    cmd_name='update_metadata_items', cmd_element='updatemetadataitems')
+                for book_id in marvin_updates:
+                    book_el = self._add_manifest_book(book_id)
+                    merged = sorted(self.installed_books[book_id].flags +
+                                    self.installed_books[book_id].device_collections, key=sort_key)
+                    collections_el = self.ch.add_element(book_el, 'collections')
+                    for tag in merged:
+                        self.ch.add_element(collections_el, 'collection', text=tag)
+                self.ch.issue_command()
+                if self.ch.results['code']:
+                    self._show_command_error('update_metadata_items', self.ch.results)
+
+        # ~~~~~~~~~ Progress from the model, after flag sync may have changed it ~~~~~~~~~
+        lookup = get_cc_mapping('progress', 'field', None)
+        if lookup:
+            updates[lookup] = {}
+            for row, book in books.items():
+                progress = self.tm.get_progress(row).sort_key
+                updates[lookup][book['cid']] = progress * 100 if progress is not None else None
+
+        # ~~~~~~~~~ One library write per column ~~~~~~~~~
+        for lookup, values in updates.items():
+            if values:
+                self._log("%s: %d books" % (lookup, len(values)))
+                self._set_calibre_field(lookup, values)
+
+        # Marvin commands have updated mainDb
+        self._localize_marvin_database()
+
+    def _refresh_marvin_database(self):
+        '''
+        Copy remote_db_path from iOS to local storage using device method
+        '''
+        self._log_location("starting")
+        msg = "Refreshing database"
+        local_busy = False
+        if self.busy:
+            self._busy_status_msg(msg=msg)
+        else:
+            local_busy = True
+            self._busy_status_setup(msg=msg)
+
+        self.connected_device._localize_database_path(self.connected_device.books_subpath)
+
+        if local_busy:
+            self._busy_status_teardown()
+        self._log_location("finished")
+
+    def _repaint_rows(self, rows):
+        '''
+        Repaint those model rows currently visible in the view
+        '''
+        rows = set(rows)
+        viewport = self.tv.viewport()
+        first = self.tv.rowAt(0)
+        if first < 0:
+            return
+        last = self.tv.rowAt(viewport.height() - 1)
+        if last < 0:
+            last = self.proxy.rowCount() - 1
+        for view_row in range(first, last + 1):
+            if self.proxy.mapToSource(self.proxy.index(view_row, 0)).row() in rows:
+                viewport.update(0, self.tv.rowViewportPosition(view_row),
+                                viewport.width(), self.tv.rowHeight(view_row))
+
     def _report_calibre_duplicates(self):
         '''
         Scan for multiple UUIDs matching single hash
@@ -5749,44 +6398,20 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         return self.tm.get_book_id(row)
 
-    def _selected_books(self):
-        '''
-        Generate a dict of books selected in the dialog
-        '''
-        selected_books = {}
-
-        for row in self._selected_rows():
-            author = str(self.tm.get_author(row).text())
-            book_id = self.tm.get_book_id(row)
-            cid = self.tm.get_calibre_id(row)
-            has_annotations = self.tm.get_annotations(row).sort_key
-            has_articles = self.tm.get_articles(row).sort_key
-            has_dv_content = bool(self.tm.get_deep_view(row))
-            has_vocabulary = self.tm.get_vocabulary(row).sort_key
-            last_opened = str(self.tm.get_last_opened(row).text())
-            locked = self.tm.get_locked(row).sort_key
-            path = self.tm.get_path(row)
-            progress = self.tm.get_progress(row).sort_key
-            title = str(self.tm.get_title(row).text())
-            uuid = self.tm.get_uuid(row)
-            word_count = self.tm.get_word_count(row).sort_key
-            selected_books[row] = {
-                'author': author,
-                'book_id': book_id,
-                'cid': cid,
-                'has_annotations': has_annotations,
-                'has_articles': has_articles,
-                'has_dv_content': has_dv_content,
-                'has_vocabulary': has_vocabulary,
-                'last_opened': last_opened,
-                'locked': locked,
-                'path': path,
-                'progress': progress,
-                'title': title,
-                'uuid': uuid,
-                'word_count': word_count}
-
-        return selected_books
+    def _select_row(self, row):
+        '''
+        Select model row in the view
+        '''
+        self.tv.selectRow(self.proxy.proxy_row(row))
+
+    def _selected_books(self, rows=None):
+        '''
+        Return a SelectionSnapshot of books selected in the dialog, or of rows
+        Capture once per action and pass it along, rather than calling again
+        '''
+        if rows is None:
+            rows = self._selected_rows()
+        return SelectionSnapshot.capture(self.tm, rows)
 
     def _selected_cid(self, row):
         '''
@@ -5799,9 +6424,27 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         Return a list of selected rows
         '''
         srs = self.tv.selectionModel().selectedRows()
-        return [sr.row() for sr in srs]
+        return [self.proxy.mapToSource(sr).row() for sr in srs]
+
+    def _set_calibre_field(self, lookup, values):
+        '''
+        Write {cid: value} to lookup with a single library update
+        '''
+        db = self.opts.gui.current_db
+        api = getattr(db, 'new_api', None)
+        if api is not None:
+            api.set_field(lookup, values)
+        else:
+            for cid, value in values.items():
+                mi = db.get_metadata(cid, index_is_id=True)
+                um = mi.metadata_for_field(lookup)
+                um['#value#'] = value
+                mi.set_user_metadata(lookup, um)
+                db.set_metadata(cid, mi, set_title=False, set_authors=False,
+                                commit=False, force_changes=True)
+            db.commit()
 
-    def _set_flags(self, action, update_local_db=True):
+    def _set_flags(self, action, update_local_db=True, selected_books=None):
         '''
         Set specified flags for selected books
         '''
@@ -5847,9 +6490,10 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         # Save the currently selected rows
         self.saved_selection_region = self.tv.visualRegionForSelection(self.tv.selectionModel().selection())
 
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
         for row in selected_books:
-            self.tv.selectRow(row)
+            self._select_row(row)
             book_id = selected_books[row]['book_id']
             flagbits = self.tm.get_flags(row).sort_key
 
@@ -5895,7 +6539,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         Application.processEvents()
 
-    def _set_rating(self, rating, silent=False, update_gui=True, update_local_db=True):
+    def _set_rating(self, rating, silent=False, update_gui=True, update_local_db=True,
+                    selected_books=None):
         '''
         Apply passed rating to selected books.
         '''
@@ -5903,7 +6548,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         # Apply rating to calibre
         db = self.opts.gui.current_db
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
         updated = False
         for row in selected_books:
             cid = selected_books[row]['cid']
@@ -5924,12 +6570,13 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             # Save the selection
             self.saved_selection_region = self.tv.visualRegionForSelection(self.tv.selectionModel().selection())
 
+            sent_book_ids = []
             for i, row in enumerate(sorted(selected_books.keys())):
                 if self.busy_cancel_requested:
                     break
 
                 # Highlight the row we're working on
-                self.tv.selectRow(row)
+                self._select_row(row)
 
                 if not silent:
                     if total_books > 1:
@@ -5959,13 +6606,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         self.tm.set_match_quality(row, self.MATCH_COLORS.index('GREEN'))
 
                 # Add the book to the command file
-                book_tag = Tag(self.ch.command_soup, 'book')
-                book_tag['author'] = escape(', '.join(self.installed_books[book_id].authors))
-                book_tag['filename'] = self.installed_books[book_id].path
-                book_tag['title'] = self.installed_books[book_id].title
-                book_tag['uuid'] = self.installed_books[book_id].uuid
-                book_tag['rating'] = rating
-                self.ch.command_soup.manifest.insert(0, book_tag)
+                self._add_manifest_book(book_id, rating=rating)
+                sent_book_ids.append(book_id)
 
             self.ch.issue_command()
             if self.ch.results['code']:
@@ -5974,9 +6616,12 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 self._show_command_error(command_name, self.ch.results)
                 return
 
-            # Update local_db for all changes
+            # Mirror the ratings in the local copy of mainDb
             if update_local_db:
-                self._localize_marvin_database()
+                self.mainDb.apply_local_update(
+                    '''UPDATE Books SET Rating = ? WHERE ID = ?''',
+                    [(rating, book_id) for book_id in sent_book_ids],
+                    many=True)
 
             if not silent:
                 self._busy_status_teardown()
@@ -6006,7 +6651,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         MessageBox(MessageBox.WARNING, title, msg, det_msg=details,
                    parent=self.opts.gui, show_copy_button=False).exec_()
 
-    def _synchronize_flags(self):
+    def _synchronize_flags(self, selected_books=None):
         '''
         Iteratively synchronize each selected row
         '''
@@ -6015,10 +6660,11 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         # Save the currently selected rows
         self.saved_selection_region = self.tv.visualRegionForSelection(self.tv.selectionModel().selection())
 
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
         for row in selected_books:
-            self.tv.selectRow(row)
-            self._apply_flags()
+            self._select_row(row)
+            self._apply_flags(selected_books=selected_books.subset([row]))
 
         # Restore selection
         if self.saved_selection_region:
@@ -6030,7 +6676,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         Application.processEvents()
 
-    def _toggle_locked_status(self, row):
+    def _toggle_locked_status(self, row, selected_books=None):
         '''
         '''
         current_status = self.tm.get_locked(row).sort_key
@@ -6041,7 +6687,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         else:
             action = "set_locked"
 
-        self._update_locked_status(action)
+        self._update_locked_status(action, selected_books=selected_books)
 
     def _update_calibre_collections(self, book_id, cid, updated_calibre_collections):
         '''
@@ -6074,7 +6720,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
 
         # Highlight the row we're working on
-        self.tv.selectRow(model_row)
+        self._select_row(model_row)
 
         # Get the current metadata
         db = self.opts.gui.current_db
@@ -6136,19 +6782,9 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                     self.ch = CommandHandler(self)
                     self.ch.construct_metadata_command(
                         cmd_name='update_metadata_items', cmd_element='updatemetadataitems')
-                    book_tag = Tag(self.ch.command_soup, 'book')
-                    book_tag['author'] = escape(', '.join(self.installed_books[book_id].authors))
-                    book_tag['filename'] = self.installed_books[book_id].path
-                    book_tag['title'] = self.installed_books[book_id].title
-                    book_tag['uuid'] = mismatches[key]['Marvin']
-
-                    cover_tag = Tag(self.ch.command_soup, 'cover')
-                    cover_tag['hash'] = cover_hash
-                    cover_tag['encoding'] = 'base64'
-                    cover_tag.insert(0, base64.b64encode(marvin_cover))
-                    book_tag.insert(0, cover_tag)
-
-                    self.ch.command_soup.manifest.insert(0, book_tag)
+                    book_el = self._add_manifest_book(book_id, uuid=mismatches[key]['Marvin'])
+                    self.ch.add_element(book_el, 'cover', text=base64.b64encode(marvin_cover),
+                                        encoding='base64', hash=cover_hash)
 
                     self.ch.issue_command()
                     if self.ch.results['code']:
@@ -6213,23 +6849,19 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 self.ch.construct_metadata_command(
                     cmd_name='update_metadata_items', cmd_element='updatemetadataitems')
 
-                book_tag = Tag(self.ch.command_soup, 'book')
-                book_tag['author'] = escape(', '.join(self.installed_books[book_id].authors))
-                book_tag['filename'] = self.installed_books[book_id].path
-                book_tag['title'] = self.installed_books[book_id].title
-                book_tag['uuid'] = mismatches[key]['Marvin']
-
-                book_tag['newuuid'] = mismatches[key]['calibre']
-                self.ch.command_soup.manifest.insert(0, book_tag)
+                self._add_manifest_book(book_id, uuid=mismatches[key]['Marvin'],
+                                        newuuid=mismatches[key]['calibre'])
 
                 self.ch.issue_command()
                 if self.ch.results['code']:
                     #return self._show_command_error(command_name, self.ch.results)
                     return self.ch.results
 
-                # Update the local db
+                # Mirror the uuid in the local copy of mainDb
                 if update_local_db:
-                    self._localize_marvin_database()
+                    self.mainDb.apply_local_update(
+                        '''UPDATE Books SET UUID = ? WHERE ID = ?''',
+                        (mismatches[key]['calibre'], book_id))
 
         updateCalibreGUIView()
 
@@ -6252,7 +6884,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         match_status = self._generate_collection_match(book)
         self.tm.set_collections(row, match_status)
 
-    def _update_collections(self, action):
+    def _update_collections(self, action, selected_books=None):
         '''
         Apply action to selected books.
             export_collections
@@ -6262,7 +6894,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
         self._log_location(action)
 
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
         for row in selected_books:
             book_id = self._selected_book_id(row)
             cid = self._selected_cid(row)
@@ -6329,18 +6962,19 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                 book.device_collections = updated_collections
                 break
 
-    def _update_flags(self, action):
+    def _update_flags(self, action, selected_books=None):
         '''
         Context menu entry point
         '''
-        rows_to_refresh = len(self._selected_books())
+        if selected_books is None:
+            selected_books = self._selected_books()
 
         if action in ['clear_new_flag', 'clear_reading_list_flag',
                       'clear_read_flag', 'clear_all_flags']:
-            self._clear_flags(action)
+            self._clear_flags(action, selected_books=selected_books)
 
         elif action in ['set_new_flag', 'set_reading_list_flag', 'set_read_flag']:
-            self._set_flags(action)
+            self._set_flags(action, selected_books=selected_books)
 
         else:
             self._log("unsupported action: %s" % action)
@@ -6481,9 +7115,6 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                     self.ch = CommandHandler(self)
                     self.ch.construct_general_command(command_type)
 
-                    parameters_tag = Tag(self.ch.command_soup, 'parameters')
-                    self.ch.command_soup.command.insert(0, parameters_tag)
-
                     if ctd in book.device_collections:
                         self._log("%s: delete '%s'" % (book.title, book.device_collections))
                         book.device_collections.remove(ctd)
@@ -6499,15 +7130,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         cached_books[book.path]['device_collections'] = book.device_collections
 
                         # Add a <parameter action="delete"> tag
-                        parameter_tag = Tag(self.ch.command_soup, 'parameter')
-                        parameter_tag['name'] = "action"
-                        parameter_tag.insert(0, "delete")
-                        parameters_tag.insert(0, parameter_tag)
-
-                        parameter_tag = Tag(self.ch.command_soup, 'parameter')
-                        parameter_tag['name'] = "name"
-                        parameter_tag.insert(0, ctd)
-                        parameters_tag.insert(0, parameter_tag)
+                        self.ch.add_parameters([('action', 'delete'), ('name', ctd)])
 
                         self.ch.issue_command()
                         if self.ch.results['code']:
@@ -6526,9 +7149,6 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                     self.ch = CommandHandler(self)
                     self.ch.construct_general_command(command_type)
 
-                    parameters_tag = Tag(self.ch.command_soup, 'parameters')
-                    self.ch.command_soup.command.insert(0, parameters_tag)
-
                     if ctr in book.device_collections:
                         self._log("%s: rename '%s'" % (book.title, book.device_collections))
                         book.device_collections.remove(ctr)
@@ -6547,20 +7167,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         cached_books[book.path]['device_collections'] = book.device_collections
 
                         # Add the parameter tags
-                        parameter_tag = Tag(self.ch.command_soup, 'parameter')
-                        parameter_tag['name'] = "action"
-                        parameter_tag.insert(0, "rename")
-                        parameters_tag.insert(0, parameter_tag)
-
-                        parameter_tag = Tag(self.ch.command_soup, 'parameter')
-                        parameter_tag['name'] = "name"
-                        parameter_tag.insert(0, ctr)
-                        parameters_tag.insert(0, parameter_tag)
-
-                        parameter_tag = Tag(self.ch.command_soup, 'parameter')
-                        parameter_tag['name'] = "newname"
-                        parameter_tag.insert(0, replacement)
-                        parameters_tag.insert(0, parameter_tag)
+                        self.ch.add_parameters([('action', 'rename'), ('name', ctr),
+                                                ('newname', replacement)])
 
                         self.ch.issue_command()
                         if self.ch.results['code']:
@@ -6570,14 +7178,16 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                         if update_local_db:
                             self._localize_marvin_database()
 
-    def _update_locked_status(self, action, update_gui=True, update_local_db=True):
+    def _update_locked_status(self, action, update_gui=True, update_local_db=True,
+                              selected_books=None):
         '''
         Update Marvin locked status
         Update calibre custom column if mapped cc
         '''
         self._log_location(action)
 
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
 
         if action == 'set_locked':
             new_pin_value = 1
@@ -6594,8 +7204,6 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         # Build the command shell
         self.ch = CommandHandler(self)
         self.ch.construct_general_command(command_type)
-        manifest_tag = Tag(self.ch.command_soup, 'manifest')
-        self.ch.command_soup.command.insert(0, manifest_tag)
 
         new_locked_widget = SortableImageWidgetItem(os.path.join(self.parent.opts.resources_path,
                                                                  'icons', new_image_name),
@@ -6611,12 +7219,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
             self.installed_books[book_id].pin = new_pin_value
 
             # Add the book to the manifest
-            book_tag = Tag(self.ch.command_soup, 'book')
-            book_tag['author'] = escape(', '.join(self.installed_books[book_id].authors))
-            book_tag['filename'] = self.installed_books[book_id].path
-            book_tag['title'] = self.installed_books[book_id].title
-            book_tag['uuid'] = self.installed_books[book_id].uuid
-            manifest_tag.insert(0, book_tag)
+            self._add_manifest_book(book_id)
 
             # Update calibre Locked column
             if cid and lookup:
@@ -6643,9 +7246,12 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         if self.ch.results['code']:
             return self._show_command_error('update_locked_status', self.ch.results)
 
-        # Update the local db
+        # Mirror the locked status in the local copy of mainDb
         if update_local_db:
-            self._localize_marvin_database()
+            self.mainDb.apply_local_update(
+                '''UPDATE Books SET Pin = ? WHERE ID = ?''',
+                [(new_pin_value, book_id) for book_id in selected_books.column('book_id')],
+                many=True)
 
     def _update_marvin_collections(self, book_id, updated_marvin_collections):
         '''
@@ -6687,7 +7293,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         '''
 
         # Highlight the row we're working on
-        self.tv.selectRow(model_row)
+        self._select_row(model_row)
 
         # Get the current metadata
         db = self.opts.gui.current_db
@@ -6698,9 +7304,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
 
         self.ch = CommandHandler(self)
         self.ch.construct_metadata_command(cmd_name='update_metadata', cmd_element="updatemetadata")
-        update_soup = self._build_metadata_update(book_id, cid, mi, mismatches, self.ch.command_soup)
-        #command_name = "update_metadata"
-        #update_soup = self._build_metadata_update(book_id, cid, mi, mismatches)
+        self._build_metadata_update(book_id, cid, mi, mismatches)
 
         """
         results = self._issue_command(command_name, update_soup)
@@ -6854,7 +7458,7 @@ class BookStatusDialog(SizePersistedDialog, Logger):
                                                  'new': self.MATCH_COLORS.index('GREEN')}
         return None
 
-    def _update_metadata(self, action):
+    def _update_metadata(self, action, selected_books=None):
         '''
         Dispatched method is responsible for updating progress bar twice per book
         '''
@@ -6863,7 +7467,8 @@ class BookStatusDialog(SizePersistedDialog, Logger):
         # Save the selection region for restoration
         self.saved_selection_region = self.tv.visualRegionForSelection(self.tv.selectionModel().selection())
 
-        selected_books = self._selected_books()
+        if selected_books is None:
+            selected_books = self._selected_books()
 
         for row in selected_books:
             book_id = self._selected_book_id(row)
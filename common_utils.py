@@ -8,13 +8,15 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import base64, cStringIO, json, os, re, sys, time, traceback
+import base64, cStringIO, json, os, posixpath, re, sqlite3, sys, time, traceback
 
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from lxml import etree
-from threading import Thread, Timer
+from threading import Lock, Thread, Timer
 from time import sleep
+from urllib import unquote
 #from zipfile import ZipFile
 
 from calibre import browser, sanitize_file_name
@@ -22,20 +24,20 @@ from calibre.constants import __version__, iswindows, isosx
 from calibre.devices.usbms.driver import debug_print
 from calibre.ebooks.BeautifulSoup import BeautifulSoup, BeautifulStoneSoup, Tag
 from calibre.ebooks.metadata import title_sort
-from calibre.ebooks.metadata.book.base import Metadata
 from calibre.gui2 import Application
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.gui2.progress_indicator import ProgressIndicator
 from calibre.library import current_library_name
-from calibre.utils.config import config_dir
+from calibre.utils.config import config_dir, JSONConfig
 from calibre.utils.ipc import RC
+from calibre.utils.wordcount import get_wordcount_obj
 from calibre.utils.zipfile import ZipFile, ZIP_STORED
 
 try:
     from PyQt5.Qt import (Qt, QAbstractItemModel, QAction, QApplication,
                           QCheckBox, QComboBox, QCursor, QDial, QDialog, QDialogButtonBox,
                           QDoubleSpinBox, QFont, QFrame, QIcon,
-                          QKeySequence, QLabel, QLineEdit,
+                          QKeySequence, QLabel, QLineEdit, QObject,
                           QPixmap, QProgressBar, QPushButton,
                           QRadioButton, QSizePolicy, QSlider, QSpinBox,
                           QThread, QTimer, QUrl,
@@ -49,7 +51,7 @@ except ImportError as e:
     from PyQt4.Qt import (Qt, QAbstractItemModel, QAction, QApplication,
                           QCheckBox, QComboBox, QCursor, QDial, QDialog, QDialogButtonBox,
                           QDoubleSpinBox, QFont, QFrame, QIcon,
-                          QKeySequence, QLabel, QLineEdit,
+                          QKeySequence, QLabel, QLineEdit, QObject,
                           QPixmap, QProgressBar, QPushButton,
                           QRadioButton, QSizePolicy, QSlider, QSpinBox,
                           QThread, QTimer, QUrl,
@@ -102,6 +104,8 @@ plugin_icon_resources = {}
 '''     Constants       '''
 EMPTY_STAR = u'\u2606'
 FULL_STAR = u'\u2605'
+MOVE_ANNOTATIONS_CHECKPOINT = "plugins/Marvin_XD_resources/move_annotations"
+MOVE_ANNOTATIONS_CHUNK = 200
 
 
 '''     Base classes    '''
@@ -189,30 +193,74 @@ class Logger():
         pass
 
 
-class Book(Metadata):
+def _lazy_field(key):
     '''
-    A simple class describing a book
-    See ebooks.metadata.book.base #46
+    Property for a Book field fetched through the record's loader on first access
+    '''
+    slot = '_' + key
+
+    def fget(self):
+        value = getattr(self, slot)
+        if value is Book.NOT_LOADED:
+            value = self.loader(self.mid, key) if self.loader else None
+            setattr(self, slot, value)
+        return value
+
+    def fset(self, value):
+        setattr(self, slot, value)
+
+    return property(fget, fset)
+
+
+class Book(object):
+    '''
+    A compact record describing a book in the Marvin library
+    Field names follow ebooks.metadata.book.base #46
+    Large, rarely viewed fields in mxd_lazy_keys are fetched from mainDb through
+    loader(mid, key) on first access, then kept. The loader is assigned by the
+    dialog using the record, and is neither stored nor compared.
     '''
     # 14 standard field keys from Metadata
     mxd_standard_keys = ['author_sort', 'authors', 'comments', 'device_collections',
                          'last_updated', 'pubdate', 'publisher', 'rating', 'series',
                          'series_index', 'tags', 'title', 'title_sort', 'uuid']
-    # 19 private field keys
-    mxd_custom_keys = ['articles', 'cid', 'calibre_collections', 'cover_file',
-                       'date_added', 'date_opened', 'deep_view_prepared',
+    # 21 private field keys
+    mxd_custom_keys = ['article_count', 'articles', 'cid', 'calibre_collections',
+                       'cover_file', 'date_added', 'date_opened', 'deep_view_prepared',
                        'flags', 'hash', 'highlights', 'match_quality',
                        'metadata_mismatches', 'mid', 'on_device', 'path', 'pin',
-                       'progress', 'vocabulary', 'word_count']
+                       'progress', 'vocabulary', 'vocabulary_count', 'word_count']
+    # Keys fetched on demand, not stored or compared
+    mxd_lazy_keys = ['articles', 'comments', 'vocabulary']
+
+    NOT_LOADED = object()
+
+    __slots__ = ['_articles', '_comments', '_vocabulary', 'article_count',
+                 'author_sort', 'authors', 'calibre_collections', 'cid',
+                 'cover_file', 'date_added', 'date_opened', 'deep_view_prepared',
+                 'device_collections', 'flags', 'hash', 'highlights',
+                 'last_updated', 'loader', 'match_quality', 'matches', 'metadata_mismatches',
+                 'mid', 'on_device', 'path', 'pin', 'progress', 'pubdate',
+                 'publisher', 'rating', 'series', 'series_index', 'tags', 'title',
+                 'title_sort', 'uuid', 'vocabulary_count', 'word_count']
+
+    articles = _lazy_field('articles')
+    comments = _lazy_field('comments')
+    vocabulary = _lazy_field('vocabulary')
 
     def __init__(self, title, author):
-        if type(author) is list:
-            Metadata.__init__(self, title, authors=author)
-        else:
-            Metadata.__init__(self, title, authors=[author])
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        for key in self.mxd_lazy_keys:
+            setattr(self, '_' + key, self.NOT_LOADED)
+        self.authors = author if type(author) is list else [author]
+        self.device_collections = []
+        self.tags = []
+        self.title = title
 
     def __eq__(self, other):
-        all_mxd_keys = self.mxd_standard_keys + self.mxd_custom_keys
+        all_mxd_keys = [key for key in self.mxd_standard_keys + self.mxd_custom_keys
+                        if key not in self.mxd_lazy_keys]
         for attr in all_mxd_keys:
             v1, v2 = [getattr(obj, attr, object()) for obj in [self, other]]
             if v1 is object() or v2 is object():
@@ -222,14 +270,11 @@ class Book(Metadata):
         return True
 
     def __ne__(self, other):
-        all_mxd_keys = self.mxd_standard_keys + self.mxd_custom_keys
-        for attr in all_mxd_keys:
-            v1, v2 = [getattr(obj, attr, object()) for obj in [self, other]]
-            if v1 is object() or v2 is object():
-                return True
-            elif v1 != v2:
-                return True
-        return False
+        return not self.__eq__(other)
+
+    @property
+    def author(self):
+        return self.authors
 
     def title_sorter(self):
         return title_sort(self.title)
@@ -463,6 +508,15 @@ class MyBlockingBusy(QDialog):
 
 
 class ProgressBar(QDialog, Logger):
+    '''
+    Progress is kept in a lock-protected counter, so worker threads may call
+    increment(). The widgets are updated from the GUI thread at most
+    MAX_UPDATES_PER_SECOND times, either by increment() itself or by a timer
+    while the event loop is running. set_label() and set_value() on the GUI
+    thread repaint at once.
+    '''
+    MAX_UPDATES_PER_SECOND = 30
+
     def __init__(self,
                  alignment=Qt.AlignHCenter, frameless=True, label='Label goes here',
                  max_items=100, on_top=False, parent=None, window_title='Progress Bar'
@@ -521,46 +575,110 @@ class ProgressBar(QDialog, Logger):
         self.close_requested = False
         self.resize(self.sizeHint())
 
+        # Shared progress state, guarded by lock
+        self.lock = Lock()
+        self.maximum = 0
+        self.value = 0
+        self.pending_label = None
+
+        # Widget updates are throttled
+        self.interval = 1.0 / self.MAX_UPDATES_PER_SECOND
+        self.last_update = 0
+        self.update_timer = QTimer(self)
+        self.update_timer.setInterval(int(self.interval * 1000))
+        self.update_timer.timeout.connect(self._update_widgets)
+
     def closeEvent(self, event):
         self._log_location()
         self.close_requested = True
 
+    def get_maximum(self):
+        with self.lock:
+            return self.maximum
+
     def get_pct_complete(self):
-        pct_complete = float(self.progressBar.value() / self.progressBar.maximum())
+        with self.lock:
+            value, maximum = self.value, self.maximum
+        pct_complete = float(value / maximum) if maximum else 0.0
         return int(pct_complete * 100)
 
+    def get_value(self):
+        with self.lock:
+            return self.value
+
+    def hideEvent(self, event):
+        self.update_timer.stop()
+        self._update_widgets()
+        super(ProgressBar, self).hideEvent(event)
+
     def increment(self):
         try:
-            if self.progressBar.value() < self.progressBar.maximum():
-                self.progressBar.setValue(self.progressBar.value() + 1)
-                self.refresh()
+            with self.lock:
+                if self.value < self.maximum:
+                    self.value += 1
+            self._throttled_update()
         except:
             self._log_location()
             import traceback
             self._log(traceback.format_exc())
 
     def refresh(self):
+        self._update_widgets()
         self.application.processEvents()
 
     def set_label(self, value):
-        self.label.setText(value)
-        self.resize(self.sizeHint())
-        self.label.repaint()
-        self.refresh()
+        '''
+        Labels change rarely, so they are painted at once rather than throttled
+        '''
+        with self.lock:
+            self.pending_label = value
+        if QThread.currentThread() == self.thread():
+            self.refresh()
 
     def set_maximum(self, value):
-        self.progressBar.setMaximum(value)
+        with self.lock:
+            self.maximum = value
+            self.value = min(self.value, value)
         self.refresh()
 
     def set_range(self, min, max):
+        with self.lock:
+            self.maximum = max
         self.progressBar.setRange(min, max)
         self.refresh()
 
     def set_value(self, value):
-        self.progressBar.setValue(value)
-        self.progressBar.repaint()
+        with self.lock:
+            self.value = value
         self.refresh()
 
+    def showEvent(self, event):
+        super(ProgressBar, self).showEvent(event)
+        self._update_widgets()
+        self.update_timer.start()
+
+    def _throttled_update(self):
+        '''
+        Refresh the widgets if on the GUI thread and the interval has elapsed
+        '''
+        if QThread.currentThread() != self.thread():
+            return
+        if time.time() - self.last_update >= self.interval:
+            self.refresh()
+
+    def _update_widgets(self):
+        with self.lock:
+            maximum, value = self.maximum, self.value
+            label, self.pending_label = self.pending_label, None
+        if label is not None:
+            self.label.setText(label)
+            self.resize(self.sizeHint())
+        if self.progressBar.maximum() != maximum:
+            self.progressBar.setMaximum(maximum)
+        if self.progressBar.value() != value:
+            self.progressBar.setValue(value)
+        self.last_update = time.time()
+
 
 '''     Threads         '''
 
@@ -815,7 +933,7 @@ class MoveBackup(QThread, Logger):
         Don't let it get to 100%
         '''
         try:
-            if self.pb.progressBar.value() < self.pb.progressBar.maximum() - 1:
+            if self.pb.get_value() < self.pb.get_maximum() - 1:
                 self.pb.increment()
             self.timer = Timer(self.TIMER_TICK, self._ticked)
             self.timer.start()
@@ -935,7 +1053,7 @@ class RestoreBackup(QThread, Logger):
         Don't let it get to 100%
         '''
         try:
-            if self.pb.progressBar.value() < self.pb.progressBar.maximum() - 1:
+            if self.pb.get_value() < self.pb.get_maximum() - 1:
                 self.pb.increment()
             self.timer = Timer(self.TIMER_TICK, self._ticked)
             self.timer.start()
@@ -960,15 +1078,18 @@ class RestoreBackup(QThread, Logger):
             self.success = True
 
 
-class RowFlasher(QThread):
+class RowFlasher(QObject):
     '''
     Flash rows_to_flash to show where ops occurred
+    Runs on the GUI thread, driven by a single-shot QTimer. Each tick sets the
+    match quality of all rows at once, then repaints only the visible ones.
+    Rows are looked up by book_id on every tick, as sorting or removing rows
+    renumbers them.
     '''
     signal = pyqtSignal(object)
 
     def __init__(self, parent, model, rows_to_flash):
-        QThread.__init__(self)
-#        self.signal = SIGNAL("flasher_complete")
+        QObject.__init__(self, parent)
         self.model = model
         self.parent = parent
         self.rows_to_flash = rows_to_flash
@@ -978,60 +1099,223 @@ class RowFlasher(QThread):
         self.new_time = self.parent.prefs.get('flasher_new_time', 300)
         self.old_time = self.parent.prefs.get('flasher_old_time', 100)
 
-    def run(self):
-        QTimer.singleShot(self.old_time, self.update)
-        while self.cycles:
-            QApplication.processEvents()
-#        self.emit(self.signal)
-        self.signal.emit("flasher_complete")
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.update)
+
+    def start(self):
+        self.timer.start(self.old_time)
+
+    def stop(self):
+        '''
+        Stop flashing, leaving every row at its new match quality
+        '''
+        if self.timer.isActive():
+            self.timer.stop()
+            self.toggle_values('new')
 
     def toggle_values(self, mode):
-        for row, item in self.rows_to_flash.items():
-            self.model.set_match_quality(row, item[mode])
+        qualities = {}
+        for item in self.rows_to_flash.values():
+            row = self.model.row_for_book_id(item['book_id'])
+            if row is not None:
+                qualities[row] = item[mode]
+        self.model.set_match_qualities(qualities)
+        self.parent._repaint_rows(qualities.keys())
 
     def update(self):
         if self.mode == 'new':
             self.toggle_values('old')
             self.mode = 'old'
-            QTimer.singleShot(self.old_time, self.update)
+            self.timer.start(self.old_time)
         elif self.mode == 'old':
             self.toggle_values('new')
             self.mode = 'new'
             self.cycles -= 1
             if self.cycles:
-                QTimer.singleShot(self.new_time, self.update)
+                self.timer.start(self.new_time)
+            else:
+                self.signal.emit("flasher_complete")
 
 '''     Helper Classes  '''
 
 
+class CachedIDevice(Logger):
+    '''
+    Caching proxy for libiMobileDevice.
+    exists(), stat() and listdir() results are cached per path for ttl seconds.
+    Writes, renames, removes and copies made through the proxy invalidate the
+    affected paths. Paths below volatile_folders, which Marvin changes on its
+    own, are never cached. Call counts and elapsed time are kept per operation.
+    Everything else is passed through to the wrapped instance.
+    '''
+    DEFAULT_TTL = 5.0
+
+    def __init__(self, ios, ttl=None, volatile_folders=None, verbose=False):
+        self._ios = ios
+        self.metrics = {}
+        self.stat_cache = {}
+        self.listdir_cache = {}
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+        self.verbose = verbose
+        self.volatile_folders = volatile_folders or []
+
+    def __getattr__(self, attr):
+        return getattr(self._ios, attr)
+
+    def copy_from_idevice(self, src, dst):
+        return self._timed('copy_from_idevice', self._ios.copy_from_idevice, src, dst)
+
+    def copy_to_idevice(self, src, dst):
+        self.invalidate(dst)
+        return self._timed('copy_to_idevice', self._ios.copy_to_idevice, src, dst)
+
+    def exists(self, path, silent=False):
+        '''
+        Return cached stats for path, or False if path does not exist
+        '''
+        hit = self._cached('exists', self.stat_cache, path)
+        if hit is not None:
+            return hit[1]
+        ans = self._timed('exists', self._ios.exists, path, silent=silent)
+        self._store(self.stat_cache, path, ans)
+        return ans
+
+    def format_metrics(self):
+        '''
+        Return a summary of AFC activity, one line per operation
+        '''
+        lines = [" {0:20} {1:>8} {2:>8} {3:>10}".format('operation', 'calls', 'cached', 'seconds')]
+        for op in sorted(self.metrics):
+            m = self.metrics[op]
+            lines.append(" {0:20} {1:>8,} {2:>8,} {3:>10.3f}".format(
+                op, m['calls'], m['cached'], m['elapsed']))
+        return '\n'.join(lines)
+
+    def invalidate(self, path=None):
+        '''
+        Drop cached results for path and its parent folder, or everything
+        '''
+        if path is None:
+            self.stat_cache.clear()
+            self.listdir_cache.clear()
+        else:
+            parent = path.rpartition('/')[0]
+            for key in [path, ('stat', path)]:
+                self.stat_cache.pop(key, None)
+            for key in [(path, True), (path, False), (parent, True), (parent, False)]:
+                self.listdir_cache.pop(key, None)
+
+    def listdir(self, path, get_stats=True):
+        key = (path, get_stats)
+        hit = self._cached('listdir', self.listdir_cache, key)
+        if hit is not None:
+            return hit[1]
+        ans = self._timed('listdir', self._ios.listdir, path, get_stats=get_stats)
+        self._store(self.listdir_cache, key, ans, path=path)
+        return ans
+
+    def mkdir(self, path):
+        self.invalidate(path)
+        return self._timed('mkdir', self._ios.mkdir, path)
+
+    def read(self, path, **kwargs):
+        return self._timed('read', self._ios.read, path, **kwargs)
+
+    def remove(self, path):
+        self.invalidate(path)
+        return self._timed('remove', self._ios.remove, path)
+
+    def rename(self, from_name, to_name):
+        self.invalidate(from_name)
+        self.invalidate(to_name)
+        return self._timed('rename', self._ios.rename, from_name, to_name)
+
+    def stat(self, path):
+        key = ('stat', path)
+        hit = self._cached('stat', self.stat_cache, key)
+        if hit is not None:
+            return hit[1]
+        ans = self._timed('stat', self._ios.stat, path)
+        self._store(self.stat_cache, key, ans, path=path)
+        return ans
+
+    def write(self, content, destination, **kwargs):
+        self.invalidate(destination)
+        return self._timed('write', self._ios.write, content, destination, **kwargs)
+
+    def _cached(self, op, cache, key):
+        '''
+        Return (timestamp, value) if a current entry exists
+        '''
+        entry = cache.get(key)
+        if entry is not None:
+            if time.time() - entry[0] < self.ttl:
+                self._metric(op)['cached'] += 1
+                return entry
+            del cache[key]
+        return None
+
+    def _is_volatile(self, path):
+        for folder in self.volatile_folders:
+            if path == folder or path.startswith(folder + '/'):
+                return True
+        return False
+
+    def _metric(self, op):
+        if op not in self.metrics:
+            self.metrics[op] = {'calls': 0, 'cached': 0, 'elapsed': 0.0}
+        return self.metrics[op]
+
+    def _store(self, cache, key, value, path=None):
+        if path is None:
+            path = key
+        if self.ttl and not self._is_volatile(path):
+            cache[key] = (time.time(), value)
+
+    def _timed(self, op, method, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            m = self._metric(op)
+            m['calls'] += 1
+            m['elapsed'] += time.time() - start
+
+
 class CommandHandler(Logger):
     '''
     Consolidated class for handling Marvin commands
     Construct two types of commands:
-    METADATA_COMMAND_XML: specific
-    GENERAL_COMMAND_XML: general
+    construct_metadata_command(): specific
+    construct_general_command(): general
+    Commands are assembled as lxml elements, then streamed to the staging
+    folder with etree.xmlfile.
     '''
+    ACK_PADDING_FACTOR = 4.0
     POLLING_DELAY = 0.25        # Spinner frequency
     WATCHDOG_TIMEOUT = 10.0
 
-    GENERAL_COMMAND_XML = b'''\xef\xbb\xbf<?xml version='1.0' encoding='utf-8'?>
-    <command type=\'{0}\' timestamp=\'{1}\'>
-    </command>'''
+    UTF_8_BOM = b'\xef\xbb\xbf'
 
-    METADATA_COMMAND_XML = b'''\xef\xbb\xbf<?xml version='1.0' encoding='utf-8'?>
-    <{0} timestamp=\'{1}\'>
-    <manifest>
-    </manifest>
-    </{0}>'''
+    # Payloads suppressed when show_staged_commands is enabled
+    DEBUG_SUPPRESSED_ELEMENTS = {
+        'cover': "(cover bytes removed for debug stream)",
+        'description': "(description removed for debug stream)"
+        }
 
     def __init__(self, parent, pb=None):
         self._log_location()
+        self.ack_latency = None
         self.busy_cancel_requested = False
         self.command_name = None
-        self.command_soup = None
+        self.command_root = None
+        self.command_staged = None
         self.connected_device = parent.connected_device
+        self.device_rates = getattr(parent, 'device_rates', None)
         self.get_response = None
         self.ios = parent.ios
+        self.manifest = None
         self.marvin_cancellation_required = False
         self.operation_timed_out = False
         self.pb = pb
@@ -1039,23 +1323,57 @@ class CommandHandler(Logger):
         self.results = None
         self.timeout_override = None
 
+    def add_element(self, parent, tag, text=None, **attrs):
+        '''
+        Append a child element to parent. Values are stringified, lxml escapes
+        them when the command is serialized.
+        '''
+        el = etree.SubElement(parent, tag)
+        for attr in sorted(attrs):
+            el.set(attr, self._stringify(attrs[attr]))
+        if text is not None:
+            el.text = self._stringify(text)
+        return el
+
+    def add_parameters(self, parameters):
+        '''
+        Append <parameters> to a general command from a list of (name, value)
+        '''
+        parameters_el = self.command_root.find('parameters')
+        if parameters_el is None:
+            parameters_el = self.add_element(self.command_root, 'parameters')
+        for name, value in parameters:
+            self.add_element(parameters_el, 'parameter', text=value, name=name)
+        return parameters_el
+
     def construct_general_command(self, cmd_type):
         '''
-        Create GENERAL_COMMAND_XML soup
+        Create the root of a general command
         '''
         self._log_location("type={0}".format(cmd_type))
         self.command_name = 'command'
         self.command_type = cmd_type
-        self.command_soup = BeautifulStoneSoup(self.GENERAL_COMMAND_XML.format(
-            cmd_type, time.mktime(time.localtime())))
+        self.command_root = etree.Element('command')
+        self.command_root.set('type', cmd_type)
+        self.command_root.set('timestamp', unicode(time.mktime(time.localtime())))
+        self.manifest = None
 
     def construct_metadata_command(self, cmd_element=None, cmd_name=None):
         '''
-        Create METADATA_COMMAND_XML soup
+        Create the root of a metadata command, with its <manifest>
         '''
         self.command_name = cmd_name
-        self.command_soup = BeautifulStoneSoup(self.METADATA_COMMAND_XML.format(
-            cmd_element, time.mktime(time.localtime())))
+        self.command_root = etree.Element(cmd_element)
+        self.command_root.set('timestamp', unicode(time.mktime(time.localtime())))
+        self.manifest = etree.SubElement(self.command_root, 'manifest')
+
+    def get_manifest(self):
+        '''
+        Return <manifest>, creating it within a general command as needed
+        '''
+        if self.manifest is None:
+            self.manifest = self.add_element(self.command_root, 'manifest')
+        return self.manifest
 
     def init_pb(self, total_seconds):
         self._log_location()
@@ -1097,6 +1415,11 @@ class CommandHandler(Logger):
                        'status': "Error communicating with Marvin",
                        'details': details}
 
+        # Marvin may have changed the file system while executing the command
+        invalidate = getattr(self.ios, 'invalidate', None)
+        if invalidate is not None:
+            invalidate()
+
         # Try to reset the busy flag, although it might fail
         try:
             self.connected_device.set_busy_flag(False)
@@ -1106,30 +1429,29 @@ class CommandHandler(Logger):
         QApplication.restoreOverrideCursor()
         self.results = results
 
+    def _log_staged_command(self):
+        '''
+        Log the command with bulky payloads suppressed. Payload text is swapped
+        out in place and restored, so the command is not copied or re-parsed.
+        '''
+        swapped = []
+        if self.command_name in ['update_metadata', 'update_metadata_items']:
+            for tag, placeholder in self.DEBUG_SUPPRESSED_ELEMENTS.items():
+                for el in self.command_root.iter(tag):
+                    swapped.append((el, el.text))
+                    el.text = placeholder
+        try:
+            self._log(etree.tostring(self.command_root, encoding='unicode', pretty_print=True))
+        finally:
+            for el, text in swapped:
+                el.text = text
+
     def _stage_command_file(self):
 
         self._log_location()
 
         if self.prefs.get('show_staged_commands', False):
-            if self.command_name in ['update_metadata', 'update_metadata_items']:
-                soup = BeautifulStoneSoup(self.command_soup.renderContents())
-                # <descriptions>
-                descriptions = soup.findAll('description')
-                for description in descriptions:
-                    d_tag = Tag(soup, 'description')
-                    d_tag.insert(0, "(description removed for debug stream)")
-                    description.replaceWith(d_tag)
-                # <covers>
-                covers = soup.findAll('cover')
-                for cover in covers:
-                    cover_tag = Tag(soup, 'cover')
-                    cover_tag['hash'] = cover['hash']
-                    cover_tag['encoding'] = cover['encoding']
-                    cover_tag.insert(0, "(cover bytes removed for debug stream)")
-                    cover.replaceWith(cover_tag)
-                self._log(soup.prettify())
-            else:
-                self._log(self.command_soup.prettify())
+            self._log_staged_command()
 
         if self.prefs.get('execute_marvin_commands', True):
             # Make sure there is no orphan status.xml from a previous timeout
@@ -1138,12 +1460,46 @@ class CommandHandler(Logger):
 
             tmp = b'/'.join([self.connected_device.staging_folder, b'%s.tmp' % self.command_name])
             final = b'/'.join([self.connected_device.staging_folder, b'%s.xml' % self.command_name])
-            self.ios.write(self.command_soup.renderContents(), tmp)
+            local = os.path.join(self.connected_device.temp_dir,
+                                 b'%s.xml' % self.command_name)
+            with open(local, 'wb') as f:
+                self._write_command_file(f)
+            self.ios.copy_to_idevice(local, tmp)
+            os.remove(local)
             self.ios.rename(tmp, final)
+            self.command_staged = time.time()
 
         else:
             self._log("~~~ execute_marvin_commands disabled in JSON ~~~")
 
+    def _stringify(self, value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        if not isinstance(value, unicode):
+            return unicode(value)
+        return value
+
+    def _write_command_file(self, f):
+        '''
+        Stream the command to f. Children of <manifest> are serialized one at a
+        time, so bulk manifests are never rendered to a single string.
+        '''
+        f.write(self.UTF_8_BOM)
+        with etree.xmlfile(f, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element(self.command_root.tag, dict(self.command_root.attrib)):
+                xf.write('\n')
+                for child in self.command_root:
+                    if child is self.manifest:
+                        with xf.element('manifest'):
+                            xf.write('\n')
+                            for book in child:
+                                xf.write(book)
+                                xf.write('\n')
+                    else:
+                        xf.write(child)
+                    xf.write('\n')
+
     def _wait_for_command_completion(self):
         '''
         Wait for Marvin to issue progress reports via status.xml
@@ -1168,9 +1524,13 @@ class CommandHandler(Logger):
             else:
                 timeout_value = self.timeout_override
 
-            # Set initial watchdog timer for ACK with default timeout
+            # Set initial watchdog timer for ACK, allowing for a slow device
+            ack_timeout = self.WATCHDOG_TIMEOUT
+            if self.device_rates is not None:
+                ack_timeout = max(ack_timeout,
+                                  self.device_rates.get('command_ack_latency') * self.ACK_PADDING_FACTOR)
             self.operation_timed_out = False
-            self.watchdog = Timer(self.WATCHDOG_TIMEOUT, self._watchdog_timed_out)
+            self.watchdog = Timer(ack_timeout, self._watchdog_timed_out)
             self.watchdog.start()
 
             while True:
@@ -1192,6 +1552,10 @@ class CommandHandler(Logger):
                     time.sleep(self.POLLING_DELAY)
 
                 else:
+                    if self.ack_latency is None and self.command_staged is not None:
+                        self.ack_latency = time.time() - self.command_staged
+                        self._log("ACK latency: {0:.3f}s".format(self.ack_latency))
+
                     # Start a new watchdog timer per iteration
                     self.watchdog.cancel()
                     self.watchdog = Timer(timeout_value, self._watchdog_timed_out)
@@ -1428,6 +1792,235 @@ class CompileUI():
         return compiled_form
 
 
+class DeviceRates(Logger):
+    '''
+    Throughput and latency estimates for a specific iDevice.
+    Observations from the I/O benchmark and from completed operations are
+    persisted per device. Estimators use the worst recent observation,
+    falling back to the historical worst-case constants.
+    '''
+    DEFAULT_RATES = {
+        'afc_read_rate': 7500000,       # bytes/second, 11.8 - 16 MB/sec OS X, Windows 6.6MB
+        'afc_write_rate': 5000000,      # bytes/second
+        'archive_rate': 1800000,        # bytes/second, Marvin preparing a backup
+        'command_ack_latency': 1.0,     # seconds until Marvin creates status.xml
+        'conversion_rate': 2350,        # words/second, Deep View generation
+        'stat_latency': 0.02,           # seconds per AFC stat
+        }
+    LATENCIES = ['command_ack_latency', 'stat_latency']
+    MAX_OBSERVATIONS = 5
+
+    def __init__(self, device_name, verbose=False):
+        self.device_name = device_name
+        self.verbose = verbose
+        self.prefs = JSONConfig("plugins/Marvin_XD_resources/{0}_device_rates".format(
+            re.sub('\W', '_', device_name)))
+
+    def format_rates(self):
+        '''
+        Return a summary of current estimates
+        '''
+        lines = []
+        for key in sorted(self.DEFAULT_RATES):
+            observations = self.prefs.get(key, [])
+            lines.append(" {0:20} {1:>14,.3f} {2}".format(
+                key, self.get(key),
+                "({0} observed)".format(len(observations)) if observations else "(default)"))
+        if self.prefs.get('benchmarked'):
+            lines.append(" benchmarked: {0}".format(self.prefs.get('benchmarked')))
+        return '\n'.join(lines)
+
+    def get(self, key):
+        '''
+        Return the worst-case estimate for key
+        '''
+        observations = self.prefs.get(key, [])
+        if not observations:
+            return self.DEFAULT_RATES[key]
+        if key in self.LATENCIES:
+            return max(observations)
+        return min(observations)
+
+    def record(self, key, value):
+        '''
+        Add an observation for key, retaining the most recent MAX_OBSERVATIONS
+        '''
+        if not value or value < 0:
+            return
+        self._log_location("{0}: {1:,.3f}".format(key, value))
+        observations = self.prefs.get(key, [])
+        observations.append(value)
+        self.prefs.set(key, observations[-self.MAX_OBSERVATIONS:])
+
+
+class MainDbLocalizer(Logger):
+    '''
+    Manage the local copy of Marvin's mainDb.
+    Mutating commands invalidate() the local copy rather than copying mainDb
+    from the iDevice after every command. The copy is refreshed lazily, before
+    the next read via connect() or path(). Within batch(), refreshes are
+    deferred until the outermost batch exits, so a series of commands costs a
+    single transfer. Changes whose effect on mainDb is known exactly may be
+    mirrored with apply_local_update(), avoiding the transfer altogether.
+    '''
+    def __init__(self, parent, refresh_method=None):
+        self.batch_depth = 0
+        self.connected_device = parent.connected_device
+        self.dirty = False
+        self.refresh_method = refresh_method
+        self.refreshes = 0
+        self.refreshes_avoided = 0
+        self.verbose = parent.verbose
+
+    def apply_local_update(self, sql, args=(), many=False):
+        '''
+        Mirror a change already sent to Marvin in the local copy.
+        If the local copy is stale, the change arrives with the next refresh.
+        '''
+        if self.dirty:
+            return
+        try:
+            con = sqlite3.connect(self.connected_device.local_db_path)
+            with con:
+                if many:
+                    con.executemany(sql, args)
+                else:
+                    con.execute(sql, args)
+            self.refreshes_avoided += 1
+        except:
+            import traceback
+            self._log_location()
+            self._log(traceback.format_exc())
+            self.invalidate()
+
+    @contextmanager
+    def batch(self):
+        '''
+        Coalesce refreshes requested by the enclosed operations
+        '''
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.ensure_current()
+
+    def connect(self):
+        '''
+        Return a sqlite3 connection to a current local copy
+        '''
+        return sqlite3.connect(self.path())
+
+    def ensure_current(self):
+        '''
+        Refresh the local copy if stale. Deferred while a batch is open.
+        '''
+        if self.dirty and not self.batch_depth:
+            self.refresh()
+
+    def invalidate(self):
+        '''
+        Mark the local copy stale
+        '''
+        self.dirty = True
+
+    def path(self):
+        '''
+        Return the path of a current local copy
+        '''
+        self.ensure_current()
+        return self.connected_device.local_db_path
+
+    def refresh(self):
+        '''
+        Copy mainDb from the iDevice now
+        '''
+        self._log_location("refreshes: {0} avoided: {1}".format(
+            self.refreshes, self.refreshes_avoided))
+        if self.refresh_method is not None:
+            self.refresh_method()
+        else:
+            self.connected_device._localize_database_path(self.connected_device.books_subpath)
+        self.dirty = False
+        self.refreshes += 1
+
+
+class WordCountCache(Logger):
+    '''
+    Persistent word counts keyed by content hash.
+    Word count depends only on content, so counts are shared across devices
+    and sessions, and books also in calibre are counted from the library.
+    '''
+    def __init__(self, verbose=False):
+        self.prefs = JSONConfig("plugins/Marvin_XD_resources/word_counts")
+        self.verbose = verbose
+
+    def get(self, hash):
+        if hash is None:
+            return None
+        return self.prefs.get(hash, None)
+
+    def update(self, word_counts):
+        '''
+        Store {hash: word_count} with a single write.
+        Books without a content hash are not cached.
+        '''
+        set_json_config_items(self.prefs, [(hash, word_count)
+                                           for hash, word_count in word_counts.items()
+                                           if hash is not None])
+
+
+class WordCountPool(Logger):
+    '''
+    Count words in epubs with count_epub_words() on worker threads,
+    while the caller continues fetching books from the iDevice.
+    Books are counted in the calling thread for a single book.
+    '''
+    MAX_THREADS = 4
+
+    def __init__(self, book_count, verbose=False):
+        self.pending = []
+        self.pool = None
+        self.verbose = verbose
+        if book_count > 1:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(min(book_count, self.MAX_THREADS))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def results(self):
+        '''
+        Yield (key, word_count) in submission order. word_count is None if
+        the book could not be counted.
+        '''
+        for key, pending in self.pending:
+            try:
+                if self.pool is not None:
+                    yield key, pending.get()
+                else:
+                    yield key, count_epub_words(pending)
+            except:
+                import traceback
+                self._log_location(key)
+                self._log(traceback.format_exc())
+                yield key, None
+        self.pending = []
+
+    def submit(self, key, data):
+        '''
+        Queue epub contents for counting
+        '''
+        if self.pool is not None:
+            self.pending.append((key, self.pool.apply_async(count_epub_words, (data,))))
+        else:
+            self.pending.append((key, data))
+
+
 '''     Helper functions   '''
 
 def _log(msg=None):
@@ -1463,6 +2056,125 @@ def _log_location(*args):
                 arg1=arg1, arg2=arg2))
 
 
+def _annotations_timestamp_range(values):
+    '''
+    Return (oldest, newest) annotation timestamp across values, or None
+    '''
+    timestamps = []
+    for value in values:
+        timestamps.extend(annotation_timestamps(value))
+    if timestamps:
+        return min(timestamps), max(timestamps)
+    return None
+
+
+class _TimestampTarget(object):
+    '''
+    lxml parser target collecting <td class="timestamp" uts="..."> values
+    without building a tree
+    '''
+    def __init__(self):
+        self.timestamps = []
+
+    def close(self):
+        return self.timestamps
+
+    def data(self, data):
+        pass
+
+    def end(self, tag):
+        pass
+
+    def start(self, tag, attrib):
+        if tag == 'td' and attrib.get('class') == 'timestamp' and attrib.get('uts'):
+            self.timestamps.append(float(attrib['uts']))
+
+
+def annotated_books(db, field, book_ids=None):
+    '''
+    Return {book_id: field value} for books whose field contains user_annotations.
+    The field is read for all books at once, values without annotations are
+    discarded with a substring test before any parsing.
+    '''
+    if book_ids is None:
+        book_ids = db.all_ids()
+    try:
+        lookup = 'comments' if field == 'Comments' else field
+        values = db.new_api.all_field_for(lookup, book_ids)
+    except AttributeError:
+        # Legacy db
+        values = {}
+        for cid in book_ids:
+            mi = db.get_metadata(cid, index_is_id=True)
+            if field == 'Comments':
+                values[cid] = mi.comments
+            else:
+                values[cid] = mi.get_user_metadata(field, False)['#value#']
+
+    return dict((cid, value) for cid, value in values.iteritems()
+                if value and 'user_annotations' in value)
+
+
+def annotation_timestamps(value):
+    '''
+    Return the timestamps of the annotations in an annotations field value
+    '''
+    return etree.fromstring(value, etree.HTMLParser(target=_TimestampTarget()))
+
+
+def annotations_date_range(values, chunk_size=500):
+    '''
+    Return (oldest, newest) annotation timestamp in values, or None.
+    Values are parsed in chunks with the lxml target parser, no trees are built.
+    '''
+    values = list(values)
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    ranges = [_annotations_timestamp_range(chunk) for chunk in chunks]
+
+    ranges = [r for r in ranges if r is not None]
+    if ranges:
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+    return None
+
+
+def count_epub_words(data):
+    '''
+    Return the word count of an epub, given its contents as a string.
+    Spine documents are read from the archive in memory and counted one at a
+    time with get_wordcount_obj(), so the book text is never concatenated.
+    Runs on a worker thread when called from WordCountPool.
+    '''
+    RE_HTML_BODY = re.compile(u'<body[^>]*>(.*)</body>', re.UNICODE | re.DOTALL | re.IGNORECASE)
+    RE_STRIP_MARKUP = re.compile(u'<[^>]+>', re.UNICODE)
+
+    words = 0
+    with ZipFile(cStringIO.StringIO(data), 'r') as zf:
+        container = etree.fromstring(zf.read('META-INF/container.xml'))
+        opf_path = container.xpath('//*[local-name()="rootfile"]/@full-path')[0]
+        opf = etree.fromstring(zf.read(opf_path))
+        opf_folder = posixpath.dirname(opf_path)
+
+        manifest = {}
+        for item in opf.xpath('//*[local-name()="manifest"]/*[local-name()="item"]'):
+            manifest[item.get('id')] = item.get('href')
+
+        for itemref in opf.xpath('//*[local-name()="spine"]/*[local-name()="itemref"]'):
+            href = manifest.get(itemref.get('idref'))
+            if href is None:
+                continue
+            name = posixpath.normpath(posixpath.join(opf_folder, unquote(href.encode('utf-8'))))
+            try:
+                html = zf.read(name).decode('utf-8', 'replace')
+            except KeyError:
+                continue
+            body = RE_HTML_BODY.findall(html)
+            if body:
+                text = RE_STRIP_MARKUP.sub('', body[0]).replace('.', '. ').strip()
+                if text:
+                    words += get_wordcount_obj(text).words
+    return words
+
+
 def existing_annotations(parent, field, return_all=False):
     '''
     Return count of existing annotations, or existence of any
@@ -1472,21 +2184,10 @@ def existing_annotations(parent, field, return_all=False):
     annotation_map = []
     if field:
         db = parent.opts.gui.current_db
-        id = db.FIELD_MAP['id']
-        for i, record in enumerate(db.data.iterall()):
-            mi = db.get_metadata(record[id], index_is_id=True)
-            if field == 'Comments':
-                if mi.comments:
-                    soup = BeautifulSoup(mi.comments)
-                else:
-                    continue
-            else:
-                soup = BeautifulSoup(mi.get_user_metadata(field, False)['#value#'])
-            if soup.find('div', 'user_annotations') is not None:
-                annotation_map.append(mi.id)
-                if not return_all:
-                    break
-        if return_all:
+        annotation_map = sorted(annotated_books(db, field))
+        if not return_all:
+            annotation_map = annotation_map[:1]
+        else:
             _log("Identified %d annotated books of %d total books" %
                 (len(annotation_map), len(db.data)))
 
@@ -1586,40 +2287,86 @@ def isoformat(date_time, sep='T'):
     return unicode(date_time.isoformat(str(sep)))
 
 
-def move_annotations(parent, annotation_map, old_destination_field, new_destination_field,
-                     window_title="Moving annotations"):
+def _move_book_annotations(parent, cid, mi, old_destination_field, new_destination_field,
+                           comments_divider, transient_db='transient'):
     '''
-    Move annotations from old_destination_field to new_destination_field
-    annotation_map precalculated in thread in config.py
+    Move or rerender the annotations in mi for one book of move_annotations()
+    Return True if mi was changed and needs to be written
     '''
-    import calibre_plugins.marvin_manager.config as cfg
     from calibre_plugins.marvin_manager.annotations import BookNotes, BookmarkNotes
 
-    _log_location(annotation_map)
-    _log(" %s -> %s" % (repr(old_destination_field), repr(new_destination_field)))
+    # Comments -> custom
+    if old_destination_field == 'Comments' and new_destination_field.startswith('#'):
+        if mi.comments:
+            old_soup = BeautifulSoup(mi.comments)
+            uas = old_soup.find('div', 'user_annotations')
+            if uas:
+                # Remove user_annotations from Comments
+                uas.extract()
 
-    db = parent.opts.gui.current_db
-    id = db.FIELD_MAP['id']
+                # Remove comments_divider from Comments
+                cd = old_soup.find('div', 'comments_divider')
+                if cd:
+                    cd.extract()
 
-    # Show progress
-    pb = ProgressBar(parent=parent, window_title=window_title)
-    total_books = len(annotation_map)
-    pb.set_maximum(total_books)
-    pb.set_value(1)
-    pb.set_label('{:^100}'.format('Moving annotations for %d books' % total_books))
-    pb.show()
+                # Save stripped Comments
+                mi.comments = unicode(old_soup)
 
-    transient_db = 'transient'
+                # Capture content
+                parent.opts.db.capture_content(uas, cid, transient_db)
 
-    # Prepare a new COMMENTS_DIVIDER
-    comments_divider = '<div class="comments_divider"><p style="text-align:center;margin:1em 0 1em 0">{0}</p></div>'.format(
-        cfg.plugin_prefs.get('COMMENTS_DIVIDER', '&middot;  &middot;  &bull;  &middot;  &#x2726;  &middot;  &bull;  &middot; &middot;'))
+                # Regurgitate content with current CSS style
+                new_soup = parent.opts.db.rerender_to_html(transient_db, cid)
+
+                # Add user_annotations to destination
+                um = mi.metadata_for_field(new_destination_field)
+                um['#value#'] = unicode(new_soup)
+                mi.set_user_metadata(new_destination_field, um)
+                return True
 
-    for cid in annotation_map:
-        mi = db.get_metadata(cid, index_is_id=True)
+    # custom -> Comments
+    elif old_destination_field.startswith('#') and new_destination_field == 'Comments':
+        if mi.get_user_metadata(old_destination_field, False)['#value#'] is not None:
+            old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
+            uas = old_soup.find('div', 'user_annotations')
+            if uas:
+                # Remove user_annotations from custom field
+                uas.extract()
 
-        # Comments -> custom
-        if old_destination_field == 'Comments' and new_destination_field.startswith('#'):
+                # Capture content
+                parent.opts.db.capture_content(uas, cid, transient_db)
+
+                # Regurgitate content with current CSS style
+                new_soup = parent.opts.db.rerender_to_html(transient_db, cid)
+
+                # Save stripped custom field data
+                um = mi.metadata_for_field(old_destination_field)
+                um['#value#'] = unicode(old_soup)
+                mi.set_user_metadata(old_destination_field, um)
+
+                # Drop user_annotations left in Comments by an interrupted move
+                if mi.comments:
+                    comments_soup = BeautifulSoup(mi.comments)
+                    stale = comments_soup.find('div', 'user_annotations')
+                    if stale:
+                        stale.extract()
+                        cd = comments_soup.find('div', 'comments_divider')
+                        if cd:
+                            cd.extract()
+                        mi.comments = unicode(comments_soup) or None
+
+                # Add user_annotations to Comments
+                if mi.comments is None:
+                    mi.comments = unicode(new_soup)
+                else:
+                    mi.comments = mi.comments + \
+                                  unicode(comments_divider) + \
+                                  unicode(new_soup)
+                return True
+
+    # same field -> same field - called from config:configure_appearance()
+    elif (old_destination_field == new_destination_field):
+        if new_destination_field == 'Comments':
             if mi.comments:
                 old_soup = BeautifulSoup(mi.comments)
                 uas = old_soup.find('div', 'user_annotations')
@@ -1641,36 +2388,6 @@ def move_annotations(parent, annotation_map, old_destination_field, new_destinat
                     # Regurgitate content with current CSS style
                     new_soup = parent.opts.db.rerender_to_html(transient_db, cid)
 
-                    # Add user_annotations to destination
-                    um = mi.metadata_for_field(new_destination_field)
-                    um['#value#'] = unicode(new_soup)
-                    mi.set_user_metadata(new_destination_field, um)
-
-                    # Update the record with stripped Comments, populated custom field
-                    db.set_metadata(cid, mi, set_title=False, set_authors=False,
-                                    commit=True, force_changes=True, notify=True)
-                    pb.increment()
-
-        # custom -> Comments
-        elif old_destination_field.startswith('#') and new_destination_field == 'Comments':
-            if mi.get_user_metadata(old_destination_field, False)['#value#'] is not None:
-                old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
-                uas = old_soup.find('div', 'user_annotations')
-                if uas:
-                    # Remove user_annotations from custom field
-                    uas.extract()
-
-                    # Capture content
-                    parent.opts.db.capture_content(uas, cid, transient_db)
-
-                    # Regurgitate content with current CSS style
-                    new_soup = parent.opts.db.rerender_to_html(transient_db, cid)
-
-                    # Save stripped custom field data
-                    um = mi.metadata_for_field(old_destination_field)
-                    um['#value#'] = unicode(old_soup)
-                    mi.set_user_metadata(old_destination_field, um)
-
                     # Add user_annotations to Comments
                     if mi.comments is None:
                         mi.comments = unicode(new_soup)
@@ -1678,132 +2395,174 @@ def move_annotations(parent, annotation_map, old_destination_field, new_destinat
                         mi.comments = mi.comments + \
                                       unicode(comments_divider) + \
                                       unicode(new_soup)
+                    return True
 
-                    # Update the record with stripped custom field, updated Comments
-                    db.set_metadata(cid, mi, set_title=False, set_authors=False,
-                                    commit=True, force_changes=True, notify=True)
-                    pb.increment()
-
-        # same field -> same field - called from config:configure_appearance()
-        elif (old_destination_field == new_destination_field):
-            pb.set_label('{:^100}'.format('Updating annotations for %d books' % total_books))
-
-            if new_destination_field == 'Comments':
-                if mi.comments:
-                    old_soup = BeautifulSoup(mi.comments)
-                    uas = old_soup.find('div', 'user_annotations')
-                    if uas:
-                        # Remove user_annotations from Comments
-                        uas.extract()
-
-                        # Remove comments_divider from Comments
-                        cd = old_soup.find('div', 'comments_divider')
-                        if cd:
-                            cd.extract()
-
-                        # Save stripped Comments
-                        mi.comments = unicode(old_soup)
+        else:
+            # Update custom field
+            old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
+
+            # Rerender book notes div
+            bnd = old_soup.find('div', 'book_note')
+            if bnd:
+                bnd.replaceWith(BookNotes().reconstruct(bnd))
+
+            # Rerender bookmark notes div
+            bmnd = old_soup.find('div', 'bookmark_notes')
+            if bmnd:
+                bmnd.replaceWith(BookmarkNotes().reconstruct(bmnd))
+
+            # Rerender annotations
+            uas = old_soup.find('div', 'user_annotations')
+            if uas:
+                # Capture content
+                parent.opts.db.capture_content(uas, cid, transient_db)
+
+                # Regurgitate annotations with current CSS style
+                rerendered_annotations = BeautifulSoup(
+                    parent.opts.db.rerender_to_html(transient_db, cid))
+                uas.replaceWith(rerendered_annotations)
+
+            # Add stripped old_soup plus new_soup to destination field
+            um = mi.metadata_for_field(new_destination_field)
+            um['#value#'] = unicode(old_soup)
+            mi.set_user_metadata(new_destination_field, um)
+            return True
+
+    # custom -> custom
+    elif old_destination_field.startswith('#') and new_destination_field.startswith('#'):
+
+        if mi.get_user_metadata(old_destination_field, False)['#value#'] is not None:
+            old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
+
+            # Rerender book notes div
+            bnd = old_soup.find('div', 'book_note')
+            if bnd:
+                bnd.replaceWith(BookNotes().reconstruct(bnd))
+
+            # Rerender bookmark notes div
+            bmnd = old_soup.find('div', 'bookmark_notes')
+            if bmnd:
+                bmnd.replaceWith(BookmarkNotes().reconstruct(bmnd))
+
+            # Rerender annotations
+            uas = old_soup.find('div', 'user_annotations')
+            if uas:
+                # Capture content
+                parent.opts.db.capture_content(uas, cid, transient_db)
+
+                # Regurgitate content with current CSS style
+                rerendered_annotations = BeautifulSoup(
+                    parent.opts.db.rerender_to_html(transient_db, cid))
+                uas.replaceWith(rerendered_annotations)
+
+                # Save stripped custom field data
+                um = mi.metadata_for_field(old_destination_field)
+                um['#value#'] = None
+                mi.set_user_metadata(old_destination_field, um)
+
+                # Add updated soup to destination field
+                um = mi.metadata_for_field(new_destination_field)
+                um['#value#'] = unicode(old_soup)
+                mi.set_user_metadata(new_destination_field, um)
 
-                        # Capture content
-                        parent.opts.db.capture_content(uas, cid, transient_db)
+            return True
 
-                        # Regurgitate content with current CSS style
-                        new_soup = parent.opts.db.rerender_to_html(transient_db, cid)
+    return False
 
-                        # Add user_annotations to Comments
-                        if mi.comments is None:
-                            mi.comments = unicode(new_soup)
-                        else:
-                            mi.comments = mi.comments + \
-                                          unicode(comments_divider) + \
-                                          unicode(new_soup)
 
-                        # Update the record with stripped custom field, updated Comments
-                        db.set_metadata(cid, mi, set_title=False, set_authors=False,
-                                        commit=True, force_changes=True, notify=True)
-                        pb.increment()
+def move_annotations(parent, annotation_map, old_destination_field, new_destination_field,
+                     window_title="Moving annotations", resume=False):
+    '''
+    Move annotations from old_destination_field to new_destination_field
+    annotation_map precalculated in thread in config.py
+    Books are written in chunks of MOVE_ANNOTATIONS_CHUNK, each chunk written
+    with one set_field() per affected field and recorded in the checkpoint, so
+    that resume_move_annotations() can complete a move interrupted by a crash.
+    new_destination_field is always written before old_destination_field is
+    stripped: a crash between the two writes leaves a chunk's annotations in
+    both fields, never in neither, and resuming redoes the chunk.
+    resume: skip the books completed in the checkpoint
+    '''
+    import calibre_plugins.marvin_manager.config as cfg
 
-            else:
-                # Update custom field
-                old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
+    _log_location(annotation_map)
+    _log(" %s -> %s" % (repr(old_destination_field), repr(new_destination_field)))
 
-                # Rerender book notes div
-                bnd = old_soup.find('div', 'book_note')
-                if bnd:
-                    bnd.replaceWith(BookNotes().reconstruct(bnd))
+    db = parent.opts.gui.current_db
 
-                # Rerender bookmark notes div
-                bmnd = old_soup.find('div', 'bookmark_notes')
-                if bmnd:
-                    bmnd.replaceWith(BookmarkNotes().reconstruct(bmnd))
+    # Record the move before touching any books
+    checkpoint = JSONConfig(MOVE_ANNOTATIONS_CHECKPOINT)
+    completed = checkpoint.get('completed', 0) if resume else 0
+    if not resume:
+        checkpoint.clear()
+        set_json_config_items(checkpoint, [('annotation_map', list(annotation_map)),
+                                           ('completed', 0),
+                                           ('library_path', db.library_path),
+                                           ('new_destination_field', new_destination_field),
+                                           ('old_destination_field', old_destination_field),
+                                           ('window_title', window_title)])
 
-                # Rerender annotations
-                uas = old_soup.find('div', 'user_annotations')
-                if uas:
-                    # Capture content
-                    parent.opts.db.capture_content(uas, cid, transient_db)
-
-                    # Regurgitate annotations with current CSS style
-                    #new_soup = parent.opts.db.rerender_to_html(transient_db, cid)
-                    rerendered_annotations = BeautifulSoup(
-                        parent.opts.db.rerender_to_html(transient_db, cid))
-                    uas.replaceWith(rerendered_annotations)
+    # Show progress
+    pb = ProgressBar(parent=parent.gui, window_title=window_title)
+    total_books = len(annotation_map)
+    pb.set_maximum(total_books)
+    pb.set_value(completed)
+    if old_destination_field == new_destination_field:
+        verb = 'Updating'
+    else:
+        verb = 'Moving'
+    pb.set_label('{:^100}'.format('%s annotations for %d books' % (verb, total_books)))
+    pb.show()
 
-                # Add stripped old_soup plus new_soup to destination field
-                um = mi.metadata_for_field(new_destination_field)
-                um['#value#'] = unicode(old_soup)
-                mi.set_user_metadata(new_destination_field, um)
+    # Prepare a new COMMENTS_DIVIDER
+    comments_divider = '<div class="comments_divider"><p style="text-align:center;margin:1em 0 1em 0">{0}</p></div>'.format(
+        cfg.plugin_prefs.get('COMMENTS_DIVIDER', '&middot;  &middot;  &bull;  &middot;  &#x2726;  &middot;  &bull;  &middot; &middot;'))
 
-                # Update the record
+    # Fields changed by _move_book_annotations(), destination first
+    fields = ['comments' if field == 'Comments' else field
+              for field in [new_destination_field, old_destination_field]]
+    if fields[0] == fields[1]:
+        fields = fields[:1]
+    api = getattr(db, 'new_api', None)
+
+    start = time.time()
+    for i in range(completed, total_books, MOVE_ANNOTATIONS_CHUNK):
+        changed = []
+        for cid in annotation_map[i:i + MOVE_ANNOTATIONS_CHUNK]:
+            mi = db.get_metadata(cid, index_is_id=True)
+            if _move_book_annotations(parent, cid, mi, old_destination_field,
+                                      new_destination_field, comments_divider):
+                changed.append((cid, mi))
+
+        if changed and api is not None:
+            for field in fields:
+                if field == 'comments':
+                    values = dict((cid, mi.comments) for cid, mi in changed)
+                else:
+                    values = dict((cid, mi.get_user_metadata(field, False)['#value#'])
+                                  for cid, mi in changed)
+                api.set_field(field, values)
+        elif changed:
+            for cid, mi in changed:
                 db.set_metadata(cid, mi, set_title=False, set_authors=False,
-                                commit=True, force_changes=True, notify=True)
-
-
-                pb.increment()
-
-        # custom -> custom
-        elif old_destination_field.startswith('#') and new_destination_field.startswith('#'):
+                                commit=False, force_changes=True, notify=False)
+            db.commit()
 
-            if mi.get_user_metadata(old_destination_field, False)['#value#'] is not None:
-                old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
+        # Checkpoint the completed chunk
+        done = min(i + MOVE_ANNOTATIONS_CHUNK, total_books)
+        checkpoint['completed'] = done
 
-                # Rerender book notes div
-                bnd = old_soup.find('div', 'book_note')
-                if bnd:
-                    bnd.replaceWith(BookNotes().reconstruct(bnd))
+        # Report throughput, ETA
+        rate = (done - completed) / max(time.time() - start, 0.001)
+        eta = int((total_books - done) / rate)
+        pb.set_value(done)
+        pb.set_label('{:^100}'.format('%s annotations: %d of %d books, %.1f books/sec, %d:%02d remaining' %
+                                      (verb, done, total_books, rate, eta // 60, eta % 60)))
 
-                # Rerender bookmark notes div
-                bmnd = old_soup.find('div', 'bookmark_notes')
-                if bmnd:
-                    bmnd.replaceWith(BookmarkNotes().reconstruct(bmnd))
-
-                # Rerender annotations
-                uas = old_soup.find('div', 'user_annotations')
-                if uas:
-                    # Capture content
-                    parent.opts.db.capture_content(uas, cid, transient_db)
-
-                    # Regurgitate content with current CSS style
-                    #new_soup = parent.opts.db.rerender_to_html(transient_db, cid)
-                    rerendered_annotations = BeautifulSoup(
-                        parent.opts.db.rerender_to_html(transient_db, cid))
-                    uas.replaceWith(rerendered_annotations)
-
-                    # Save stripped custom field data
-                    um = mi.metadata_for_field(old_destination_field)
-                    #um['#value#'] = unicode(old_soup)
-                    um['#value#'] = None
-                    mi.set_user_metadata(old_destination_field, um)
-
-                    # Add updated soup to destination field
-                    um = mi.metadata_for_field(new_destination_field)
-                    um['#value#'] = unicode(old_soup)
-                    mi.set_user_metadata(new_destination_field, um)
-
-                # Update the record
-                db.set_metadata(cid, mi, set_title=False, set_authors=False,
-                                commit=True, force_changes=True, notify=True)
-                pb.increment()
+    # The move is complete, remove the checkpoint
+    if os.path.exists(checkpoint.file_path):
+        os.remove(checkpoint.file_path)
+    _log("%d books in %.2fs" % (total_books - completed, time.time() - start))
 
     # Hide the progress bar
     pb.hide()
@@ -1934,6 +2693,25 @@ def restore_state(ui, prefs, restore_position=False):
                     _log("maximum of two chained methods")
 
 
+def resume_move_annotations(parent):
+    '''
+    Complete a move_annotations() interrupted in the current library
+    Return True if a move was resumed
+    '''
+    checkpoint = JSONConfig(MOVE_ANNOTATIONS_CHECKPOINT)
+    if (not checkpoint.get('annotation_map') or
+            checkpoint.get('library_path') != parent.opts.gui.current_db.library_path):
+        return False
+
+    _log_location("%d of %d books completed" % (checkpoint['completed'],
+                                                len(checkpoint['annotation_map'])))
+    move_annotations(parent, checkpoint['annotation_map'],
+                     checkpoint['old_destination_field'],
+                     checkpoint['new_destination_field'],
+                     window_title=checkpoint['window_title'], resume=True)
+    return True
+
+
 def save_state(ui, prefs, save_position=False):
     def _save_ui_position(ui, owner):
         prefs.set('%s_last_x' % owner, ui.pos().x())
@@ -1975,6 +2753,17 @@ def set_cc_mapping(cc_name, field=None, combobox=None):
     plugin_prefs.set('cc_mappings', cc_mappings)
 
 
+def set_json_config_items(config, items, commit=True):
+    '''
+    Set (key, value) items in a JSONConfig with a single write.
+    JSONConfig.__setitem__ writes the whole file for every key.
+    '''
+    for key, value in items:
+        dict.__setitem__(config, key, value)
+    if commit:
+        config.commit()
+
+
 def set_plugin_icon_resources(name, resources):
     '''
     Set our global store of plugin name and icon resources for sharing between
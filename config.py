@@ -11,7 +11,6 @@ from time import mktime
 
 from calibre.constants import islinux, isosx, iswindows
 from calibre.devices.usbms.driver import debug_print
-from calibre.ebooks.BeautifulSoup import BeautifulSoup
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.gui2 import show_restart_warning
 from calibre.gui2.ui import get_gui
@@ -21,7 +20,8 @@ from calibre_plugins.marvin_manager.appearance import (AnnotationsAppearance,
     default_elements, default_timestamp)
 
 from calibre_plugins.marvin_manager.common_utils import (Logger,
-    existing_annotations, get_cc_mapping, get_icon, move_annotations, set_cc_mapping)
+    annotated_books, annotations_date_range, existing_annotations, get_cc_mapping,
+    get_icon, move_annotations, set_cc_mapping)
 
 try:
     from PyQt5.Qt import (Qt, QCheckBox, QComboBox, QFont, QFontMetrics, QFrame,
@@ -978,6 +978,7 @@ class InventoryAnnotatedBooks(QThread, Logger):
     def __init__(self, gui, field, get_date_range=False):
         QThread.__init__(self, gui)
         self.annotation_map = []
+        self.annotation_values = {}
         self.cdb = gui.current_db
         self.get_date_range = get_date_range
         self.newest_annotation = 0
@@ -999,13 +1000,8 @@ class InventoryAnnotatedBooks(QThread, Logger):
         '''
         self._log_location("field: {0}".format(self.field))
         cids = self.cdb.search_getting_ids('formats:EPUB', '')
-        for cid in cids:
-            mi = self.cdb.get_metadata(cid, index_is_id=True)
-            raw = mi.get_user_metadata(self.field, False)
-            if raw['#value#'] is not None:
-                soup = BeautifulSoup(raw['#value#'])
-                if soup.find('div', 'user_annotations') is not None:
-                    self.annotation_map.append(mi.id)
+        self.annotation_values = annotated_books(self.cdb, self.field, cids)
+        self.annotation_map = [cid for cid in cids if cid in self.annotation_values]
 
     def get_annotations_date_range(self):
         '''
@@ -1013,25 +1009,10 @@ class InventoryAnnotatedBooks(QThread, Logger):
         initial values of self.oldest, self.newest are reversed to allow update comparisons
         if no annotations, restore to correct values
         '''
-        annotations_found = False
-
-        for cid in self.annotation_map:
-            mi = self.cdb.get_metadata(cid, index_is_id=True)
-            if self.field == 'Comments':
-                soup = BeautifulSoup(mi.comments)
-            else:
-                soup = BeautifulSoup(mi.get_user_metadata(self.field, False)['#value#'])
-
-            uas = soup.findAll('div', 'annotation')
-            for ua in uas:
-                annotations_found = True
-                timestamp = float(ua.find('td', 'timestamp')['uts'])
-                if timestamp < self.oldest_annotation:
-                    self.oldest_annotation = timestamp
-                if timestamp > self.newest_annotation:
-                    self.newest_annotation = timestamp
-
-        if not annotations_found:
+        date_range = annotations_date_range(self.annotation_values.values())
+        if date_range is not None:
+            self.oldest_annotation, self.newest_annotation = date_range
+        else:
             temp = self.newest_annotation
             self.newest_annotation = self.oldest_annotation
             self.oldest_annotation = temp
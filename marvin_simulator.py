@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2013, Greg Riker <griker@hotmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Local stand-in for an iDevice running Marvin, for developer use.
+
+LocalIDevice mimics the subset of libiMobileDevice used by the plugin against a
+folder on the local file system. SimulatedMarvin watches the staging folder,
+consumes command files, reports progress via status.xml with realistic delays
+and applies the command to a synthetic mainDb. SimulatorBenchmark drives full
+scans of the Marvin library and bulk commands through the stand-in, so
+performance work can be measured without a connected iDevice.
+'''
+
+import hashlib, os, random, shutil, sqlite3, time
+
+from functools import partial
+from lxml import etree
+from threading import Event, Thread
+
+try:
+    from PyQt5.Qt import QObject, pyqtSignal
+except ImportError:
+    from PyQt4.Qt import QObject, pyqtSignal
+
+from calibre.utils.zipfile import ZipFile, ZIP_STORED
+
+from calibre_plugins.marvin_manager.benchmarks import Benchmark
+from calibre_plugins.marvin_manager.book_status import BookStatusDialog
+from calibre_plugins.marvin_manager.common_utils import (CachedIDevice,
+    CommandHandler, Logger, MainDbLocalizer)
+
+
+class LocalIDevice(Logger):
+    '''
+    libiMobileDevice lookalike backed by a local folder.
+    Remote paths are '/'-separated and resolved below root. latency is added
+    to every call to approximate AFC round trips.
+    '''
+    def __init__(self, root, device_name='Marvin simulator', latency=0.0):
+        self.device_name = device_name
+        self.latency = latency
+        self.root = root
+
+    def copy_from_idevice(self, src, dst):
+        '''
+        dst is an open file object, as with libiMobileDevice
+        '''
+        self._delay()
+        with open(self._local(src), 'rb') as f:
+            shutil.copyfileobj(f, dst)
+
+    def copy_to_idevice(self, src, dst):
+        self._delay()
+        shutil.copyfile(src, self._local(dst))
+
+    def disconnect_idevice(self):
+        pass
+
+    def exists(self, path, silent=False):
+        '''
+        Return stats for path, or False if path does not exist
+        '''
+        self._delay()
+        if not os.path.exists(self._local(path)):
+            return False
+        return self._stats(path)
+
+    def listdir(self, path, get_stats=True):
+        self._delay()
+        ans = {}
+        for name in os.listdir(self._local(path)):
+            ans[name] = self._stats('/'.join([path, name])) if get_stats else {}
+        return ans
+
+    def mkdir(self, path):
+        self._delay()
+        local = self._local(path)
+        if not os.path.isdir(local):
+            os.makedirs(local)
+
+    def mount_ios_app(self, app_id=None, app_name=None):
+        pass
+
+    def read(self, path, mode='r'):
+        self._delay()
+        with open(self._local(path), 'rb') as f:
+            return f.read()
+
+    def remove(self, path):
+        self._delay()
+        local = self._local(path)
+        if os.path.isdir(local):
+            shutil.rmtree(local)
+        elif os.path.exists(local):
+            os.remove(local)
+
+    def rename(self, from_name, to_name):
+        self._delay()
+        os.rename(self._local(from_name), self._local(to_name))
+
+    def stat(self, path):
+        self._delay()
+        return self._stats(path)
+
+    def write(self, content, destination, mode='w'):
+        self._delay()
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        with open(self._local(destination), 'wb') as f:
+            f.write(content)
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _local(self, path):
+        return os.path.join(self.root, *[p for p in path.split('/') if p])
+
+    def _stats(self, path):
+        st = os.stat(self._local(path))
+        return {'st_birthtime': unicode(int(st.st_ctime)),
+                'st_blocks': unicode(int(st.st_size / 512) + 1),
+                'st_ifmt': 'S_IFDIR' if os.path.isdir(self._local(path)) else 'S_IFREG',
+                'st_mtime': unicode(st.st_mtime),
+                'st_nlink': unicode(st.st_nlink),
+                'st_size': unicode(st.st_size)}
+
+
+class SimulatedConnectedDevice(object):
+    '''
+    Stand-in for the iOSRA driver attributes used by CommandHandler, the
+    mainDb localizer and BookStatusDialog
+    '''
+    THUMBNAIL_HEIGHT = 675
+
+    def __init__(self, ios, temp_dir):
+        self.books_subpath = '/Library/mainDb.sqlite'
+        self.busy = False
+        self.cached_books = {}
+        self.ios = ios
+        self.local_db_path = os.path.join(temp_dir, 'mainDb.sqlite')
+        self.marvin_device_signals = SimulatedDeviceSignals()
+        self.staging_folder = '/Library/calibre'
+        self.status_fs = '/'.join([self.staging_folder, 'status.xml'])
+        self.temp_dir = temp_dir
+
+    def get_busy_flag(self):
+        return self.busy
+
+    def set_busy_flag(self, busy):
+        self.busy = busy
+
+    def _localize_database_path(self, remote_db_path):
+        with open(self.local_db_path, 'wb') as out:
+            self.ios.copy_from_idevice(remote_db_path, out)
+        return self.local_db_path
+
+
+class SimulatedDeviceSignals(QObject):
+    '''
+    Stand-in for the driver's marvin_device_signals, never emitted
+    '''
+    reader_app_status_changed = pyqtSignal(dict)
+
+
+class SimulatedParent(object):
+    '''
+    Stand-in for the plugin action passed to BookStatusDialog. The simulated
+    device replaces the connected one, everything else is the action's own.
+    installed_books is None, so each dialog performs a COLD START.
+    '''
+    def __init__(self, action, ios, connected_device):
+        self.action = action
+        self.connected_device = connected_device
+        self.installed_books = None
+        self.installed_books_metadata_changes = None
+        self.ios = ios
+        self.marvin_content_updated = False
+        self.mainDb = MainDbLocalizer(self)
+
+    def __getattr__(self, attr):
+        return getattr(self.action, attr)
+
+
+class SimulatedMarvin(Thread, Logger):
+    '''
+    Consume command files from the staging folder like Marvin does.
+    Each command is acknowledged after ack_delay, reports progress in steps
+    spaced by book_delay per manifest entry, then mutates mainDb.
+    '''
+    # Manifest <book> attributes mirrored to Books columns
+    BOOK_ATTRIBUTES = {
+        'newuuid': 'UUID',
+        'rating': 'Rating',
+        'wordcount': 'WordCount'
+        }
+
+    # General commands mirrored to Books columns for each manifest entry
+    GENERAL_COMMANDS = {
+        'GenerateDeepView': ('DeepViewPrepared', 1),
+        'LockBooks': ('Pin', 1),
+        'UnlockBooks': ('Pin', 0)
+        }
+
+    def __init__(self, ios, connected_device, ack_delay=0.25, book_delay=0.01):
+        Thread.__init__(self)
+        self.daemon = True
+        self.ack_delay = ack_delay
+        self.book_delay = book_delay
+        self.commands_processed = 0
+        self.connected_device = connected_device
+        self.ios = ios
+        self.responses = set()
+        self.stop_requested = Event()
+
+    def run(self):
+        staging_folder = self.connected_device.staging_folder
+        while not self.stop_requested.is_set():
+            for name in sorted(self.ios.listdir(staging_folder, get_stats=False)):
+                if (name.endswith('.xml') and
+                        name != 'status.xml' and
+                        name not in self.responses):
+                    self._process_command('/'.join([staging_folder, name]))
+            self.stop_requested.wait(0.05)
+
+    def stop(self):
+        self.stop_requested.set()
+        self.join()
+
+    def _apply_command(self, command, books):
+        '''
+        Mirror the command in the remote mainDb
+        '''
+        db_path = self.ios._local(self.connected_device.books_subpath)
+        con = sqlite3.connect(db_path)
+        with con:
+            cur = con.cursor()
+            general = self.GENERAL_COMMANDS.get(command.get('type'))
+            for book in books:
+                filename = book.get('filename')
+                if general is not None:
+                    cur.execute('''UPDATE Books SET {0} = ? WHERE FileName = ?
+                                '''.format(general[0]), (general[1], filename))
+                for attr, column in self.BOOK_ATTRIBUTES.items():
+                    if book.get(attr) is not None:
+                        cur.execute('''UPDATE Books SET {0} = ? WHERE FileName = ?
+                                    '''.format(column), (book.get(attr), filename))
+        con.close()
+
+    def _cancel_requested(self):
+        cancel = '/'.join([self.connected_device.staging_folder, 'cancel.command'])
+        if self.ios.exists(cancel):
+            self.ios.remove(cancel)
+            return True
+        return False
+
+    def _process_command(self, command_fs):
+        raw = self.ios.read(command_fs)
+        self.ios.remove(command_fs)
+        if raw.startswith(CommandHandler.UTF_8_BOM):
+            raw = raw[len(CommandHandler.UTF_8_BOM):]
+        command = etree.fromstring(raw)
+        books = command.findall('manifest/book')
+
+        time.sleep(self.ack_delay)
+        self._write_status('-1', 0.0)
+
+        code = '0'
+        steps = max(len(books), 1)
+        for i in range(steps):
+            if self._cancel_requested():
+                code = '3'
+                break
+            time.sleep(self.book_delay)
+            self._write_status('-1', (i + 1) / steps)
+
+        if code == '0':
+            self._apply_command(command, books)
+            if command.get('type') == 'BACKUPMANIFEST':
+                self._write_response('backup.xml', '<backup/>')
+
+        self._write_status(code, 1.0)
+        self.commands_processed += 1
+
+    def _write_response(self, name, content):
+        self.responses.add(name)
+        self.ios.write(content, '/'.join([self.connected_device.staging_folder, name]))
+
+    def _write_status(self, code, progress):
+        '''
+        Write status.xml atomically, as the handler may read it at any time
+        '''
+        status = etree.Element('status', code=code, timestamp=unicode(time.time()))
+        etree.SubElement(status, 'progress').text = unicode(progress)
+        etree.SubElement(status, 'messages')
+        tmp = '/'.join([self.connected_device.staging_folder, 'status.tmp'])
+        self.ios.write(etree.tostring(status, encoding='utf-8', xml_declaration=True), tmp)
+        self.ios.rename(tmp, self.connected_device.status_fs)
+
+
+class SimulatorBenchmark(Benchmark):
+    '''
+    Build a synthetic Marvin library, then time full scans and bulk commands
+    through the simulated Marvin. Scans open a BookStatusDialog against the
+    simulated device, so _scan_marvin_books() and _get_installed_books() run
+    as they do for a connected iDevice.
+    '''
+    CONTAINER_XML = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>'''
+
+    OPF_ITEM = '<item id="chapter{0}" href="chapter{0}.html" media-type="application/xhtml+xml"/>'
+    OPF_TEMPLATE = '''<?xml version="1.0"?>
+<package version="2.0" xmlns="http://www.idpf.org/2007/opf"><manifest>{0}</manifest></package>'''
+
+    TEMP_PREFIX = 'marvin_simulator_'
+
+    def __init__(self, parent, book_count=250, latency=0.002, ack_delay=0.25,
+                 book_delay=0.01, use_stat_cache=True):
+        Benchmark.__init__(self, parent)
+        self.ack_delay = ack_delay
+        self.book_count = book_count
+        self.book_delay = book_delay
+        self.latency = latency
+        self.marvin = None
+        self.use_stat_cache = use_stat_cache
+
+    def _format_results(self):
+        lines = Benchmark._format_results(self)
+        if self.use_stat_cache:
+            lines.append('')
+            lines.append(self.ios.format_metrics())
+        return lines
+
+    def _phases(self):
+        '''
+        The first scan computes every hash, the second reads them from the
+        hash cache the first left on the device
+        '''
+        return [
+            ("localize mainDb", self._localize_main_db),
+            ("scan Marvin library, cold", self._scan_library),
+            ("scan Marvin library, hash cache", self._scan_library),
+            ("bulk update_metadata_items", self._bulk_word_counts),
+            ("bulk LockBooks", partial(self._bulk_general_command, "LockBooks")),
+            ("bulk GenerateDeepView", partial(self._bulk_general_command, "GenerateDeepView")),
+            ("BACKUPMANIFEST round trip", self._backup_manifest),
+            ]
+
+    def _setup(self):
+        self._log("{0} books".format(self.book_count))
+        self.ios = LocalIDevice(self.root, latency=self.latency)
+        self.connected_device = SimulatedConnectedDevice(self.ios, self.root)
+        for folder in ['/Documents', '/Library', self.connected_device.staging_folder]:
+            self.ios.mkdir(folder)
+        self._timed("build synthetic library", self._build_library)
+
+        # Marvin works on the folder directly, bypassing the plugin's cache
+        self.marvin = SimulatedMarvin(self.ios, self.connected_device,
+                                      ack_delay=self.ack_delay, book_delay=self.book_delay)
+        self.marvin.start()
+
+        if self.use_stat_cache:
+            self.ios = CachedIDevice(self.ios,
+                                     volatile_folders=[self.connected_device.staging_folder],
+                                     verbose=self.verbose)
+
+    def _teardown(self):
+        if self.marvin is not None:
+            self.marvin.stop()
+
+    # Library construction
+    def _build_library(self):
+        con = sqlite3.connect(self.ios._local(self.connected_device.books_subpath))
+        with con:
+            cur = con.cursor()
+            self._create_schema(cur)
+            cur.execute('''INSERT INTO Collections (ID, Name) VALUES (1, 'Simulated')''')
+            for i in range(self.book_count):
+                filename = 'book_{0:05d}.epub'.format(i)
+                self._write_epub(filename, i)
+                cur.execute('''INSERT INTO Books
+                                (ID, Title, Author, AuthorSort, FileName, UUID, Pin,
+                                 Rating, WordCount, NewFlag, ReadingList, IsRead,
+                                 DeepViewPrepared, Progress, DateAdded, DateOpened)
+                               VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, 1, 0, 0, 0, 0.0, ?, ?)
+                            ''', (i + 1, 'Book {0}'.format(i), 'Author {0}'.format(i % 50),
+                                  'Author {0}'.format(i % 50), filename,
+                                  hashlib.md5(filename).hexdigest(), time.time(), time.time()))
+                if i % 3 == 0:
+                    cur.execute('''INSERT INTO BookCollections (BookID, CollectionID)
+                                   VALUES (?, 1)''', (i + 1,))
+                for h in range(i % 4):
+                    cur.execute('''INSERT INTO Highlights
+                                    (BookID, UUID, Colour, Deleted, Note, NoteDateTime,
+                                     Section, StartOffset, StartXPath, Text)
+                                   VALUES (?, ?, 0, 0, '', ?, 1, ?, ?, ?)
+                                ''', (i + 1, '{0}-{1}'.format(filename, h), time.time(),
+                                      h * 10, self.XPATH_TEMPLATE.format('p[{0}]'.format(h + 1)),
+                                      'highlight {0}'.format(h)))
+        con.close()
+
+    def _create_schema(self, cur):
+        '''
+        The subset of the Marvin mainDb schema read by the plugin
+        '''
+        cur.execute('''CREATE TABLE Books (ID INTEGER PRIMARY KEY, Title TEXT,
+                        Author TEXT, AuthorSort TEXT, CalibreCoverHash TEXT,
+                        CalibreSeries TEXT, CalibreSeriesIndex REAL,
+                        CalibreTitleSort TEXT, CoverFile TEXT, DateAdded REAL,
+                        DateOpened REAL, DatePublished REAL, DeepViewPrepared INTEGER,
+                        Description TEXT, FileName TEXT, Hash TEXT, IsRead INTEGER,
+                        MetadataUpdated REAL, NewFlag INTEGER, Note TEXT, Pin INTEGER,
+                        Progress REAL, Publisher TEXT, Rating INTEGER,
+                        ReadingList INTEGER, UUID TEXT, WordCount INTEGER)''')
+        cur.execute('''CREATE TABLE Bookmarks (BookID INTEGER, Text TEXT)''')
+        cur.execute('''CREATE TABLE BookCollections (BookID INTEGER, CollectionID INTEGER)''')
+        cur.execute('''CREATE TABLE BookSubjects (BookID INTEGER, Subject TEXT)''')
+        cur.execute('''CREATE TABLE Collections (ID INTEGER PRIMARY KEY, Name TEXT)''')
+        cur.execute('''CREATE TABLE Highlights (BookID INTEGER, UUID TEXT, Colour INTEGER,
+                        Deleted INTEGER, Note TEXT, NoteDateTime REAL, Section INTEGER,
+                        StartOffset INTEGER, StartXPath TEXT, Text TEXT)''')
+        cur.execute('''CREATE TABLE PinnedArticles (BookID INTEGER, Title TEXT, URL TEXT)''')
+        cur.execute('''CREATE TABLE Vocabulary (BookID INTEGER, Word TEXT)''')
+        cur.execute('''CREATE TABLE Wiki (BookID INTEGER, Title TEXT, Snippet TEXT)''')
+
+    def _write_epub(self, filename, seed):
+        '''
+        Write an epub with the container and OPF read by _compute_epub_hash()
+        '''
+        rnd = random.Random(seed)
+        local = self.ios._local('/'.join(['/Documents', filename]))
+        with ZipFile(local, 'w', ZIP_STORED) as zf:
+            zf.writestr('mimetype', 'application/epub+zip')
+            zf.writestr('META-INF/container.xml', self.CONTAINER_XML)
+            zf.writestr('OEBPS/content.opf', self.OPF_TEMPLATE.format(
+                ''.join(self.OPF_ITEM.format(chapter) for chapter in range(3))))
+            for chapter in range(3):
+                words = ' '.join(rnd.choice(self.CHAPTER_WORDS) for w in range(2000))
+                zf.writestr('OEBPS/chapter{0}.html'.format(chapter),
+                            '<html><body><p>{0}</p></body></html>'.format(words))
+        self.connected_device.cached_books[filename] = {'author': 'Author {0}'.format(seed % 50),
+                                                        'device_collections': [],
+                                                        'title': 'Book {0}'.format(seed),
+                                                        'uuid': hashlib.md5(filename).hexdigest()}
+
+    # Benchmarked phases
+    def _backup_manifest(self):
+        ch = self._command_handler()
+        ch.construct_general_command('BACKUPMANIFEST')
+        ch.issue_command(get_response="backup.xml")
+
+    def _bulk_general_command(self, command_type):
+        ch = self._command_handler()
+        ch.construct_general_command(command_type)
+        for filename in sorted(self.connected_device.cached_books):
+            ch.add_element(ch.get_manifest(), 'book', filename=filename)
+        ch.issue_command(timeout_override=max(ch.WATCHDOG_TIMEOUT, self.book_count * self.book_delay * 2))
+
+    def _bulk_word_counts(self):
+        ch = self._command_handler()
+        ch.construct_metadata_command(cmd_name='update_metadata_items',
+                                      cmd_element='updatemetadataitems')
+        for i, filename in enumerate(sorted(self.connected_device.cached_books)):
+            ch.add_element(ch.get_manifest(), 'book', filename=filename, wordcount=6000 + i)
+        ch.issue_command(timeout_override=max(ch.WATCHDOG_TIMEOUT, self.book_count * self.book_delay * 2))
+
+    def _command_handler(self):
+        return CommandHandler(self)
+
+    def _localize_main_db(self):
+        self.connected_device._localize_database_path(self.connected_device.books_subpath)
+
+    def _scan_library(self):
+        '''
+        Open the Marvin library as the plugin does, without showing it
+        '''
+        parent = SimulatedParent(self.parent, self.ios, self.connected_device)
+        dialog = BookStatusDialog(parent, 'marvin_library')
+        try:
+            dialog.initialize(parent)
+            return len(dialog.installed_books)
+        finally:
+            dialog.deleteLater()